@@ -0,0 +1,113 @@
+# Behavior of the mouse at the time of each spike.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import numpy as np
+from giocomo_lab_to_nwb.streaming import DEFAULT_CHUNK_SIZE
+
+# trial of the spikes outside of the behavioral recording
+NO_TRIAL = -1
+
+
+class SpikeAlignment(object):
+    """
+    The trial and position of the mouse at the time of each spike, computed when sliced.
+
+    A spike belongs to the trial of the last behavioral sample at or before it. Its position
+    is interpolated between that sample and the next one, unless the next sample starts a new
+    trial (the hallway position jumps back to 0 there). Spikes before the first or after the
+    last sample get NO_TRIAL and NaN.
+
+    Nothing is loaded: a slice of spikes reads only the behavioral samples around its times,
+    located with a coarse index of every `chunk_size`-th sample time. The spike times ('st')
+    are sorted, so a slice of spikes covers a short stretch of samples.
+
+    The `trial` and `position` attributes are the two per-spike arrays, to be grouped by unit
+    like the spike times (see tables.group_columns).
+    """
+
+    def __init__(self, spike_times, sample_times, position, trial, trial_nums, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Parameters
+        ----------
+        spike_times : array-like
+            the time of each spike ('sp/st')
+        sample_times : array-like
+            the time of each behavioral sample ('post')
+        position : array-like
+            the position in the hallway at each sample ('posx')
+        trial : array-like
+            the trial number of each sample ('trial')
+        trial_nums : np.ndarray
+            the trial numbers, in the order of the rows of the trials table (see tables.trial_boundaries)
+        chunk_size : int
+            number of samples between two entries of the coarse index
+        """
+        self.spike_times = spike_times
+        self.sample_times = sample_times
+        self.sample_position = position
+        self.sample_trial = trial
+        self.trial_nums = np.asarray(trial_nums)
+        self.step = max(1, int(chunk_size))
+        self.num_samples = len(sample_times)
+        self.coarse_times = np.asarray(sample_times[0:self.num_samples:self.step])
+        self.trial = _AlignedColumn(self, 'trial', np.int16)
+        self.position = _AlignedColumn(self, 'position', np.float32)
+        self._cached = (None, None)
+
+    def __len__(self):
+        return len(self.spike_times)
+
+    def align(self, start, stop):
+        """The trials table row and the position of the spikes start to stop."""
+        if self._cached[0] == (start, stop):
+            return self._cached[1]
+        times = np.ravel(self.spike_times[start:stop])
+        trial_rows = np.full(len(times), NO_TRIAL, dtype=np.int16)
+        position = np.full(len(times), np.nan, dtype=np.float32)
+        if len(times) and self.num_samples:
+            # the samples from the last one at or before the first spike to the first one after the last spike
+            first = max(np.searchsorted(self.coarse_times, times.min(), side='right') - 1, 0) * self.step
+            last = min(np.searchsorted(self.coarse_times, times.max(), side='right') * self.step + 1,
+                       self.num_samples)
+            sample_times = np.ravel(self.sample_times[first:last])
+            sample_position = np.ravel(self.sample_position[first:last])
+            sample_trial = np.ravel(self.sample_trial[first:last])
+
+            before = np.searchsorted(sample_times, times, side='right') - 1
+            end = sample_times[-1] if last == self.num_samples else np.inf
+            inside = (before >= 0) & (times <= end)
+            before = before[inside]
+            after = np.minimum(before + 1, len(sample_times) - 1)
+            # no interpolation across the end of a trial, nor past the last sample
+            same_trial = (after > before) & (sample_trial[after] == sample_trial[before])
+            span = np.where(same_trial, sample_times[after] - sample_times[before], 1.0)
+            fraction = np.where(same_trial, (times[inside] - sample_times[before]) / span, 0.0)
+            position[inside] = sample_position[before] + fraction * (sample_position[after] - sample_position[before])
+            trial_rows[inside] = np.searchsorted(self.trial_nums, sample_trial[before])
+        self._cached = ((start, stop), (trial_rows, position))
+        return trial_rows, position
+
+
+class _AlignedColumn(object):
+    """One of the per-spike arrays of a SpikeAlignment, sliceable like a MatArray."""
+
+    def __init__(self, alignment, name, dtype):
+        self.alignment = alignment
+        self.name = name
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def shape(self):
+        return (len(self.alignment),)
+
+    def __len__(self):
+        return len(self.alignment)
+
+    def __getitem__(self, index):
+        start, stop, _step = index.indices(len(self.alignment))
+        trial_rows, position = self.alignment.align(start, stop)
+        return trial_rows if self.name == 'trial' else position
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[0:len(self)]
+        return values if dtype is None else values.astype(dtype)
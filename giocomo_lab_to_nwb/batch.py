@@ -0,0 +1,265 @@
+# Parallel conversion of the sessions listed in a config file.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# memory needed by an in-memory conversion, per byte of .mat input
+MEMORY_PER_INPUT_BYTE = 4
+# memory needed by a streamed conversion (convert(stream=True)), in bytes
+STREAMING_MEMORY = 2 * 2 ** 30
+
+
+def available_memory():
+    """The physical memory currently available, in bytes, or None where it cannot be queried."""
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def estimate_memory(experiment_info):
+    """
+    Rough peak memory of converting one session, in bytes.
+
+    Parameters
+    ----------
+    experiment_info : dict
+        the keyword arguments of conversion.convert for the session
+
+    Returns
+    -------
+    memory : int
+    """
+    if experiment_info.get('stream', False):
+        return STREAMING_MEMORY
+    try:
+        return os.path.getsize(experiment_info['input_file']) * MEMORY_PER_INPUT_BYTE
+    except OSError:
+        return 0
+
+
+def convert_session(experiment_info):
+    """
+    Convert one session and report how it went, without raising.
+
+    Parameters
+    ----------
+    experiment_info : dict
+        the keyword arguments of conversion.convert for the session
+
+    Returns
+    -------
+    result : dict
+        input_file, status ('converted' or 'failed'), seconds and error (the traceback, if failed)
+    """
+    # imported here so that worker processes only load the conversion when they run one
+    from giocomo_lab_to_nwb.conversion import convert
+
+    start = time.time()
+    result = {'input_file': experiment_info.get('input_file'), 'status': 'converted', 'error': None}
+    try:
+        print('converting', experiment_info['input_file'])
+        convert(**experiment_info)
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.time() - start
+    return result
+
+
+def skipped_sessions(sessions, cache, force=False):
+    """
+    Find the sessions of a batch that need not be converted.
+
+    Only with a cache. A session is skipped if the cache records its .nwb file as converted from the
+    same input file and arguments, or if it duplicates an earlier session of the batch: the same
+    arguments but for input_file, and an input file with the same contents (e.g. a copy of the same
+    .mat file listed twice). Input files whose sampled fingerprints match are compared by a hash of
+    their whole contents before a session is skipped. A copy listed with other arguments, such as
+    other metadata, is converted, with a warning.
+
+    Parameters
+    ----------
+    sessions : list of dict
+        keyword arguments of conversion.convert for each session
+    cache : cache.ConversionCache or None
+        the manifest of converted sessions. Without one, nothing is skipped.
+    force : bool
+        skip nothing
+
+    Returns
+    -------
+    skipped : dict
+        the summary entry of each skipped session, by position in `sessions`
+    keys : dict
+        the cache.session_key of each session whose input file could be read, by position
+    """
+    from giocomo_lab_to_nwb.cache import content_hash, fingerprint, normalized_arguments, session_key
+    from giocomo_lab_to_nwb.conversion import nwb_path
+
+    skipped = {}
+    keys = {}
+    # the earlier sessions of the batch by sampled fingerprint, and the hash of whole input files by path
+    earlier = {}
+    hashes = {}
+
+    def whole_contents(input_file):
+        if input_file not in hashes:
+            hashes[input_file] = content_hash(input_file)
+        return hashes[input_file]
+
+    for index, experiment_info in enumerate(sessions):
+        input_file = experiment_info.get('input_file')
+        try:
+            contents = fingerprint(input_file, modification_time=False)
+            keys[index] = session_key(experiment_info)
+            arguments = normalized_arguments(experiment_info, exclude=('input_file',))
+        except (OSError, TypeError, KeyError):
+            # let the conversion report the missing file or bad arguments
+            continue
+        if force or cache is None:
+            continue
+        if cache.is_up_to_date(nwb_path(input_file), keys[index]):
+            skipped[index] = {'input_file': input_file, 'status': 'up to date', 'error': None, 'seconds': None}
+            continue
+        for earlier_file, earlier_arguments in earlier.get(contents, []):
+            if whole_contents(earlier_file) != whole_contents(input_file):
+                continue
+            if earlier_arguments == arguments:
+                skipped[index] = {'input_file': input_file, 'status': 'duplicate', 'error': None, 'seconds': None,
+                                  'duplicate_of': earlier_file}
+                break
+            print('warning: %s has the same contents as %s, but other arguments: converted again'
+                  % (input_file, earlier_file))
+        if index not in skipped:
+            earlier.setdefault(contents, []).append((input_file, arguments))
+    return skipped, keys
+
+
+def convert_batch(sessions, workers=1, memory_limit=None, cache=None, force=False, longest_first=True):
+    """
+    Convert several sessions, in parallel worker processes.
+
+    A failing session is reported in the summary and does not stop the others. A session only
+    starts when the estimated memory of all running sessions fits in `memory_limit`; sessions
+    further down the list that fit are started first. One session always runs, whatever its size.
+    With a cache, up-to-date and duplicate sessions are skipped, see skipped_sessions.
+
+    In parallel, the sessions expected to take longest (see preview.estimate_conversion) are started
+    first, so that a long session started last does not run alone while the other workers sit idle.
+
+    Parameters
+    ----------
+    sessions : iterable of dict
+        keyword arguments of conversion.convert for each session
+    workers : int
+        number of sessions converted at the same time. With 1, sessions are converted one
+        after the other in this process.
+    memory_limit : float
+        memory available to the batch, in bytes. Defaults to the memory currently available.
+    cache : cache.ConversionCache, optional
+        the manifest up-to-date sessions are looked up in and converted sessions recorded in
+    force : bool
+        convert every session, even if up to date or a duplicate
+    longest_first : bool
+        in parallel, start the sessions in order of expected conversion time, longest first, instead of
+        in the order of `sessions`. Sessions without an estimate keep their order, after the others.
+
+    Returns
+    -------
+    summary : list of dict
+        the result of convert_session for each session, in the order of `sessions`
+    """
+    from giocomo_lab_to_nwb.conversion import nwb_path
+
+    sessions = list(sessions)
+    skipped, keys = skipped_sessions(sessions, cache, force)
+    summary = [skipped.get(index) for index in range(len(sessions))]
+    queued = [index for index in range(len(sessions)) if index not in skipped]
+
+    def finished(index, result):
+        summary[index] = result
+        if cache is not None and result['status'] == 'converted' and index in keys:
+            input_file = sessions[index]['input_file']
+            cache.record(input_file, nwb_path(input_file), keys[index])
+
+    if workers <= 1:
+        for index in queued:
+            finished(index, convert_session(sessions[index]))
+        print_summary(summary)
+        return summary
+
+    if longest_first:
+        queued = order_by_cost(sessions, queued)
+    if memory_limit is None:
+        memory_limit = available_memory()
+    estimates = [estimate_memory(experiment_info) for experiment_info in sessions]
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while queued or running:
+            in_use = sum(estimates[index] for index in running.values())
+            for index in list(queued):
+                if len(running) >= workers:
+                    break
+                if running and memory_limit is not None and in_use + estimates[index] > memory_limit:
+                    continue
+                queued.remove(index)
+                running[pool.submit(convert_session, sessions[index])] = index
+                in_use += estimates[index]
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception:
+                    # e.g. the worker process was killed for running out of memory
+                    result = {'input_file': sessions[index].get('input_file'), 'status': 'failed',
+                              'error': traceback.format_exc(), 'seconds': None}
+                finished(index, result)
+
+    print_summary(summary)
+    return summary
+
+
+def order_by_cost(sessions, indices):
+    """
+    Sort sessions by expected conversion time, longest first.
+
+    Parameters
+    ----------
+    sessions : list of dict
+        keyword arguments of conversion.convert for each session
+    indices : list of int
+        the positions in `sessions` of the sessions to sort
+
+    Returns
+    -------
+    indices : list of int
+        sorted. The sessions without an estimate (unreadable or pre-v7.3 .mat files) come last, in
+        their order.
+    """
+    from giocomo_lab_to_nwb.preview import preview_sessions
+
+    previews = dict(zip(indices, preview_sessions([sessions[index] for index in indices])))
+    estimated = [index for index in indices if previews[index]['seconds'] is not None]
+    unknown = [index for index in indices if previews[index]['seconds'] is None]
+    return sorted(estimated, key=lambda index: -previews[index]['seconds']) + unknown
+
+
+def print_summary(summary):
+    """Print one line per session of a convert_batch summary, then the errors."""
+    print('%d of %d sessions converted' % (sum(result['status'] == 'converted' for result in summary),
+                                           len(summary)))
+    for result in summary:
+        seconds = '' if result['seconds'] is None else ' (%.1f s)' % result['seconds']
+        if result.get('duplicate_of'):
+            seconds = ' (same contents as %s)' % result['duplicate_of']
+        print('  %s  %s%s' % (result['status'], result['input_file'], seconds))
+    for result in summary:
+        if result['error']:
+            print('\n%s failed:\n%s' % (result['input_file'], result['error']))
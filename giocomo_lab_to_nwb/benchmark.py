@@ -0,0 +1,223 @@
+# Benchmark of the converters on synthetic sessions of growing size.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import yaml
+
+# numbers of spikes of the benchmarked sessions
+DEFAULT_SIZES = (10 ** 5, 10 ** 6, 10 ** 7, 10 ** 8)
+# a stage is slower than the baseline when it takes this fraction longer...
+DEFAULT_TOLERANCE = 0.25
+# ...and at least this many seconds longer, so that very short stages do not flag noise
+MIN_REGRESSION_SECONDS = 0.05
+# a stage scales worse than the baseline when its exponent grows by more than this
+EXPONENT_TOLERANCE = 0.15
+SESSION_START_TIME = 'April 4, 2017 10:00AM'
+SUBJECT_DATE_OF_BIRTH = 'April 4, 2016 12:15AM'
+
+
+def run_convert(input_file, stream=False, options=None):
+    """Convert a session with conversion.convert, given other `options` of it, and return its conversion report."""
+    from giocomo_lab_to_nwb.conversion import convert, nwb_path
+    from giocomo_lab_to_nwb.profiling import report_path
+
+    convert(input_file, SESSION_START_TIME, SUBJECT_DATE_OF_BIRTH, stream=stream, profile=True, **(options or {}))
+    with open(report_path(nwb_path(input_file))) as report:
+        return json.load(report)
+
+
+def run_conversion_function(input_file):
+    """Convert a session with conversion_module.conversion_function, which doesn't stream, and return its report."""
+    from giocomo_lab_to_nwb.conversion_tools.conversion_module import conversion_function
+    from giocomo_lab_to_nwb.profiling import report_path
+
+    metafile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conversion_tools', 'metafile.yml')
+    with open(metafile) as f:
+        metadata = yaml.safe_load(f)
+    output_file = os.path.splitext(input_file)[0] + '.nwb'
+    conversion_function(source_paths={'processed data': {'type': 'file', 'path': input_file}},
+                        f_nwb=output_file,
+                        metadata=metadata,
+                        add_processed=True,
+                        profile=True)
+    with open(report_path(output_file)) as report:
+        return json.load(report)
+
+
+CONVERTERS = {'convert': run_convert, 'conversion_function': run_conversion_function}
+
+
+def run_benchmark(sizes=DEFAULT_SIZES, converter='convert', stream=False, work_dir=None, keep_files=False,
+                  session_options=None, convert_options=None):
+    """
+    Convert synthetic sessions of each size and collect the time spent in each stage.
+
+    Every conversion runs in a fresh process, so that the peak memory of one size does not
+    hide the next.
+
+    Parameters
+    ----------
+    sizes : iterable of int
+        numbers of spikes of the sessions
+    converter : str
+        'convert' or 'conversion_function'
+    stream : bool
+        convert with stream=True. Only convert streams: True raises ValueError with conversion_function.
+    work_dir : str, optional
+        directory of the synthetic sessions and their .nwb files. Defaults to a temporary directory.
+    keep_files : bool
+        keep the sessions and .nwb files instead of deleting each after its conversion
+    session_options : dict, optional
+        other arguments of synthetic.write_session, e.g. num_channels
+    convert_options : dict, optional
+        other arguments of conversion.convert, e.g. rate_maps (convert only)
+
+    Returns
+    -------
+    results : dict
+        sizes, and for each stage the wall seconds at every size, plus the peak RSS, the size of the
+        .nwb file and the preview of the session (see preview.preview_session) of each size
+    """
+    from giocomo_lab_to_nwb.preview import preview_session
+    from giocomo_lab_to_nwb.synthetic import write_session
+
+    if convert_options and converter != 'convert':
+        raise ValueError('convert_options are arguments of convert, not of %s' % converter)
+    if stream and converter != 'convert':
+        raise ValueError('only convert streams, not %s' % converter)
+
+    sizes = [int(size) for size in sizes]
+    temporary = None
+    if work_dir is None:
+        temporary = tempfile.TemporaryDirectory(prefix='giocomo_benchmark_')
+        work_dir = temporary.name
+    results = {'converter': converter, 'stream': stream, 'options': convert_options or {}, 'sizes': sizes,
+               'stages': {}, 'peak_rss_bytes': [], 'output_bytes': [], 'sessions': []}
+    for size in sizes:
+        input_file = os.path.join(work_dir, 'synthetic_%d.mat' % size)
+        print('writing a synthetic session of %d spikes ...' % size)
+        write_session(input_file, num_spikes=size, **(session_options or {}))
+        arguments = (input_file, stream, convert_options) if converter == 'convert' else (input_file,)
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            report = pool.submit(CONVERTERS[converter], *arguments).result()
+        for stage, measured in report['stages'].items():
+            results['stages'].setdefault(stage, [None] * len(sizes))[sizes.index(size)] = measured['wall_seconds']
+        results['stages'].setdefault('total', [None] * len(sizes))[sizes.index(size)] = report['total']['wall_seconds']
+        results['peak_rss_bytes'].append(report['total']['peak_rss_bytes'])
+        results['output_bytes'].append(os.path.getsize(os.path.splitext(input_file)[0] + '.nwb'))
+        results['sessions'].append(preview_session(input_file))
+        if not keep_files:
+            for path in os.listdir(work_dir):
+                if path.startswith('synthetic_%d.' % size):
+                    os.remove(os.path.join(work_dir, path))
+    if temporary is not None:
+        temporary.cleanup()
+    results['exponents'] = {stage: scaling_exponent(sizes, seconds) for stage, seconds in results['stages'].items()}
+    return results
+
+
+def scaling_exponent(sizes, seconds):
+    """
+    The exponent k of seconds ~ size ** k, fitted on a log-log scale.
+
+    1 is linear scaling, 0 a constant cost. None with fewer than two measured sizes.
+    """
+    measured = [(size, second) for size, second in zip(sizes, seconds) if second]
+    if len(measured) < 2:
+        return None
+    size, second = np.log(np.array(measured)).T
+    return float(np.polyfit(size, second, 1)[0])
+
+
+def find_regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare benchmark results to a baseline of the same converter.
+
+    Returns
+    -------
+    regressions : list of str
+        one message per stage and size that is slower than the baseline by more than `tolerance`,
+        and per stage whose scaling exponent grew by more than EXPONENT_TOLERANCE. Exponents of
+        stages shorter than MIN_REGRESSION_SECONDS are too noisy to compare.
+    """
+    regressions = []
+    if (results['converter'], results['stream']) != (baseline['converter'], baseline['stream']):
+        regressions.append('the baseline benchmarks %s (stream=%s), not %s (stream=%s)'
+                           % (baseline['converter'], baseline['stream'], results['converter'], results['stream']))
+    for stage, seconds in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        baseline_seconds = dict(zip(baseline['sizes'], baseline['stages'][stage]))
+        for size, second in zip(results['sizes'], seconds):
+            before = baseline_seconds.get(size)
+            if second is None or before is None:
+                continue
+            if second > before * (1 + tolerance) and second - before > MIN_REGRESSION_SECONDS:
+                regressions.append('%s at %d spikes: %.3f s, baseline %.3f s (+%.0f%%)'
+                                   % (stage, size, second, before, 100 * (second / before - 1)))
+        exponent = results['exponents'].get(stage)
+        before = baseline.get('exponents', {}).get(stage)
+        longest = max(second for second in seconds if second is not None)
+        if (exponent is not None and before is not None and exponent > before + EXPONENT_TOLERANCE
+                and longest > MIN_REGRESSION_SECONDS):
+            regressions.append('%s scales as n^%.2f, baseline n^%.2f' % (stage, exponent, before))
+    return regressions
+
+
+def print_results(results):
+    """Print the seconds, throughput (spikes per second) and scaling exponent of each stage."""
+    sizes = results['sizes']
+    print('%s%s, seconds (spikes per second)' % (results['converter'], ' (streaming)' if results['stream'] else ''))
+    print('%-16s' % 'stage' + ''.join('%24s' % ('%.0e spikes' % size) for size in sizes) + '%10s' % 'exponent')
+    for stage, seconds in results['stages'].items():
+        cells = ''.join('%24s' % ('-' if second is None else '%.3f (%.3g)' % (second, size / max(second, 1e-9)))
+                        for size, second in zip(sizes, seconds))
+        exponent = results['exponents'].get(stage)
+        print('%-16s' % stage + cells + '%10s' % ('-' if exponent is None else '%.2f' % exponent))
+    print('%-16s' % 'peak RSS (MB)' + ''.join('%24s' % ('-' if rss is None else '%.0f' % (rss / 2 ** 20))
+                                            for rss in results['peak_rss_bytes']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the conversion stages on synthetic sessions.')
+    parser.add_argument('--sizes', type=float, nargs='+', default=DEFAULT_SIZES,
+                        help='numbers of spikes of the synthetic sessions (default: 1e5 1e6 1e7 1e8)')
+    parser.add_argument('--converter', choices=sorted(CONVERTERS), default='convert')
+    parser.add_argument('--stream', action='store_true', help='convert with stream=True (convert only)')
+    parser.add_argument('--channels', type=int, default=384, help='number of probe channels')
+    parser.add_argument('--work-dir', default=None, help='directory of the synthetic sessions (default: temporary)')
+    parser.add_argument('--keep-files', action='store_true', help='keep the synthetic sessions and .nwb files')
+    parser.add_argument('--option', nargs='+', default=[], metavar='NAME=VALUE',
+                        help='other arguments of convert, e.g. rate_maps=true (values are read as YAML)')
+    parser.add_argument('--baseline', default=None, help='JSON results of an earlier run to compare against')
+    parser.add_argument('--save-baseline', default=None, help='write the results to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='fraction a stage may be slower than the baseline (default: %(default)s)')
+    args = parser.parse_args()
+
+    results = run_benchmark(sizes=args.sizes, converter=args.converter, stream=args.stream,
+                            work_dir=args.work_dir, keep_files=args.keep_files,
+                            session_options={'num_channels': args.channels},
+                            convert_options=dict((name, yaml.safe_load(value)) for name, value
+                                                 in (option.split('=', 1) for option in args.option)))
+    print_results(results)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print('\nregressions against %s:' % args.baseline)
+            for regression in regressions:
+                print('  ' + regression)
+            sys.exit(1)
+        print('\nno regressions against %s' % args.baseline)
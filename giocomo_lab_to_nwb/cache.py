@@ -0,0 +1,145 @@
+# Manifest of converted sessions, to skip sessions whose output is up to date.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import datetime
+import hashlib
+import inspect
+import json
+import os
+
+# name of the manifest file, kept next to the config file
+MANIFEST_NAME = 'conversion_cache.json'
+# size and number of the blocks of the input file that are hashed
+SAMPLE_SIZE = 2 ** 16
+SAMPLE_COUNT = 16
+# size of the blocks a whole file is hashed by
+HASH_BLOCK_SIZE = 2 ** 24
+# convert() arguments that change how a session is converted but not the output. The number of raw_workers
+# doesn't change the output, but whether there are any does: the raw data are then compressed (see
+# normalized_arguments)
+EXECUTION_ARGUMENTS = ('stream', 'chunk_size', 'raw_workers', 'profile', 'progress')
+
+
+def fingerprint(path, modification_time=True):
+    """
+    Fast hash of a file: its size, modification time and SAMPLE_COUNT evenly spaced blocks.
+
+    Parameters
+    ----------
+    path : str
+    modification_time : bool
+        include the modification time. Without it, copies of the same file have the same hash.
+
+    Returns
+    -------
+    digest : str
+    """
+    stat = os.stat(path)
+    digest = hashlib.sha1(str(stat.st_size).encode())
+    if modification_time:
+        digest.update(str(stat.st_mtime_ns).encode())
+    with open(path, 'rb') as input_file:
+        step = max(stat.st_size // SAMPLE_COUNT, SAMPLE_SIZE)
+        for position in range(0, stat.st_size, step):
+            input_file.seek(position)
+            digest.update(input_file.read(SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+def content_hash(path):
+    """Hash of the whole contents of a file, read a block at a time. Slow on large files, unlike fingerprint."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def normalized_arguments(experiment_info, exclude=()):
+    """
+    The convert() arguments of a session with defaults filled in, as a canonical JSON string.
+
+    Arguments listed in EXECUTION_ARGUMENTS do not change the output and are left out, as are the
+    arguments named in `exclude`, e.g. 'input_file' to compare the other arguments of two sessions.
+    Instead of raw_workers, 'raw_compressed' tells whether the raw data are written compressed.
+    """
+    from giocomo_lab_to_nwb.conversion import convert
+
+    arguments = inspect.signature(convert).bind(**experiment_info)
+    arguments.apply_defaults()
+    values = arguments.arguments
+    normalized = {name: value for name, value in values.items()
+                  if name not in EXECUTION_ARGUMENTS and name not in exclude}
+    normalized['raw_compressed'] = bool(values['add_raw']) and values['raw_workers'] is not None
+    return json.dumps(normalized, sort_keys=True, default=str)
+
+
+def session_key(experiment_info):
+    """Hash of the input file fingerprint and the normalized convert() arguments of a session."""
+    digest = hashlib.sha1(fingerprint(experiment_info['input_file']).encode())
+    digest.update(normalized_arguments(experiment_info).encode())
+    return digest.hexdigest()
+
+
+class ConversionCache(object):
+    """
+    JSON manifest of the sessions converted so far, keyed by output path.
+
+    Each entry records the session key (see session_key) it was converted from, and the size
+    and modification time of the written .nwb file.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as manifest:
+                self.entries = json.load(manifest)
+        else:
+            self.entries = {}
+
+    def save(self):
+        with open(self.manifest_path, 'w') as manifest:
+            json.dump(self.entries, manifest, indent=2, sort_keys=True)
+
+    def is_up_to_date(self, output_file, key):
+        """Whether output_file was converted from a session with this key and is unchanged since."""
+        entry = self.entries.get(os.path.abspath(output_file))
+        if entry is None or entry['key'] != key or not os.path.exists(output_file):
+            return False
+        stat = os.stat(output_file)
+        return entry['output_size'] == stat.st_size and entry['output_mtime_ns'] == stat.st_mtime_ns
+
+    def record(self, input_file, output_file, key):
+        """Record a successful conversion and save the manifest."""
+        stat = os.stat(output_file)
+        self.entries[os.path.abspath(output_file)] = {
+            'input_file': os.path.abspath(input_file),
+            'input_fingerprint': fingerprint(input_file),
+            'key': key,
+            'output_size': stat.st_size,
+            'output_mtime_ns': stat.st_mtime_ns,
+            'converted': datetime.datetime.now().isoformat(),
+        }
+        self.save()
+
+    def evict_stale(self):
+        """
+        Remove the entries whose output or input file was deleted or changed since conversion.
+
+        Returns
+        -------
+        evicted : list of str
+            the output paths of the removed entries
+        """
+        evicted = []
+        for output_file, entry in list(self.entries.items()):
+            stale = not (os.path.exists(output_file) and os.path.exists(entry['input_file']))
+            if not stale:
+                stat = os.stat(output_file)
+                stale = (entry['output_size'] != stat.st_size or entry['output_mtime_ns'] != stat.st_mtime_ns
+                         or entry['input_fingerprint'] != fingerprint(entry['input_file']))
+            if stale:
+                evicted.append(output_file)
+                del self.entries[output_file]
+        self.save()
+        return evicted
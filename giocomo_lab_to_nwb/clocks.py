@@ -0,0 +1,40 @@
+# Timing of the TimeSeries sampled on the same clock.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+
+
+class Clock(object):
+    """
+    The sampling times shared by the TimeSeries recorded on one clock, e.g. 'post' for the behavior.
+
+    A clock is either regular, given by a starting time and a rate, or given by its timestamps.
+    The timestamps are then stored once: the first TimeSeries created on the clock holds them
+    and the next ones link to its timestamps dataset, instead of each storing a copy.
+
+    Create each series with the arguments of `timing()` and hand it to `add()`:
+
+        clock.add(position.create_spatial_series(name='Position', data=posx, **clock.timing()))
+    """
+
+    def __init__(self, timestamps=None, starting_time=None, rate=None):
+        if (timestamps is None) == (rate is None):
+            raise ValueError('a clock has either timestamps or a starting time and a rate')
+        self.timestamps = timestamps
+        self.starting_time = starting_time
+        self.rate = rate
+        self.series = None
+
+    def timing(self):
+        """The timing arguments of the next TimeSeries on this clock."""
+        if self.rate is not None:
+            return {'starting_time': self.starting_time, 'rate': self.rate}
+        if self.series is not None:
+            # a TimeSeries given as timestamps is written as a link to its timestamps
+            return {'timestamps': self.series}
+        return {'timestamps': self.timestamps}
+
+    def add(self, series):
+        """Record a TimeSeries created with timing(): the first one holds the timestamps of the clock."""
+        if self.rate is None and self.series is None:
+            self.series = series
+        return series
@@ -1,17 +1,23 @@
+import argparse
+import os
+import sys
+import tempfile
 import uuid
 from datetime import datetime
 import yaml
 
-import hdf5storage
-import numpy as np
 import pytz
-import sys
-from pynwb import NWBFile, NWBHDF5IO
-from pynwb.misc import Units
-from pynwb.file import Subject
-from pynwb.behavior import Position, BehavioralEvents
-from pynwb.image import ImageSeries
-from ndx_labmetadata_giocomo import LabMetaData_ext
+from giocomo_lab_to_nwb.batch import convert_batch
+from giocomo_lab_to_nwb.cache import MANIFEST_NAME, ConversionCache
+from giocomo_lab_to_nwb.clocks import Clock
+from giocomo_lab_to_nwb.defaults import DEFAULT_BIN_SIZE, DEFAULT_CHUNK_SIZE, ISI_THRESHOLD
+from giocomo_lab_to_nwb.profiling import ConversionProfile
+
+
+def nwb_path(input_file):
+    """The path convert() writes the .nwb file of input_file to: its last '.mat' replaced by '.nwb'."""
+    head, _sep, tail = input_file.rpartition('.mat')
+    return head + '.nwb' + tail
 
 
 def convert(input_file,
@@ -29,7 +35,30 @@ def convert(input_file,
             experimenter='Kei Masuda',
             experiment_description='Virtual Hallway Task',
             institution='Stanford University School of Medicine',
-            lab_name='Giocomo Lab'):
+            lab_name='Giocomo Lab',
+            stream=False,
+            chunk_size=DEFAULT_CHUNK_SIZE,
+            add_raw=False,
+            raw_path=None,
+            raw_workers=None,
+            profile=None,
+            share_spike_times=False,
+            io_profile=None,
+            io_goal=None,
+            io_min_write_speed=None,
+            store_templates=False,
+            template_channels=None,
+            shared_timestamps=False,
+            align_spikes=False,
+            rate_maps=False,
+            rate_map_bin_size=DEFAULT_BIN_SIZE,
+            rate_map_smoothing=None,
+            trial_rate_maps=False,
+            spike_count_matrix=False,
+            count_bin_width=None,
+            quality_metrics=False,
+            isi_threshold=ISI_THRESHOLD,
+            progress=None):
     """
     Read in the .mat file specified by input_file and convert to .nwb format.
 
@@ -67,6 +96,89 @@ def convert(input_file,
         what institution was the experiment performed in
     lab_name : string
         the lab where the experiment was performed
+    stream : bool
+        read spike times, templates, position and lick data from the .mat file chunk by chunk while
+        the .nwb file is written, instead of loading them first. Needs a MATLAB v7.3 input file.
+    chunk_size : int
+        number of values held in memory at a time per streamed array
+    add_raw : bool
+        also write the raw recording described by 'dat_path', 'n_channels_dat', 'dtype' and 'offset'
+        in 'sp' as an ElectricalSeries. The .dat file is memory-mapped and written chunk by chunk.
+    raw_path : str
+        path to the raw .dat file, if it moved since sorting. Defaults to 'dat_path'; relative
+        paths are relative to the folder of input_file.
+    raw_workers : int
+        number of threads compressing the raw data. By default the raw data are written uncompressed.
+        Otherwise they are gzip compressed, in parallel, after the rest of the file is written.
+    profile : bool or str
+        write the wall time, CPU time and peak memory of each stage of the conversion to a JSON report
+        next to the .nwb file ('session.report.json'). 'memory' also traces the memory allocated by each
+        stage with tracemalloc, which slows the conversion down. Defaults to the GIOCOMO_NWB_PROFILE
+        environment variable ('1' or 'memory'). When streaming, reading the large arrays is part of
+        the 'hdf5 write' stage.
+    share_spike_times : bool
+        store the spike times once, in the units table. The TemplateUnits table then has no spike_times
+        column (it is optional in a Units table): it holds the index of each of its spikes in
+        units/spike_times instead, in a ragged column 'spike_index'. Readers that expect TemplateUnits
+        spike_times must read them with tables.shared_spike_times. Only possible when every spike belongs
+        to one of the clusters in 'cids', otherwise the spike times are stored twice, as by default.
+    io_profile : str
+        chunking and compression of the spike times, waveforms, position, lick and raw data: 'archive'
+        (smallest file), 'fast-write', 'fast-read' or 'default' (contiguous and uncompressed, as by
+        default), see io_profiles.IO_PROFILES
+    io_goal : str
+        choose the io_profile instead, from trials of the HDF5 filters and chunk sizes on samples of the
+        session: 'size' for the smallest file, 'read' or 'write' for the fastest reads or writes (see
+        tuner.tune). The trials and the choice are printed and recorded in the conversion report.
+    io_min_write_speed : float
+        with io_goal, only choose settings writing at least this many MB per second
+    store_templates : bool
+        write each spike template once, in a 'templates' table of the 'ecephys' processing module (one
+        template per HDF5 chunk, unless io_profile says otherwise), instead of a copy of the template of
+        each cluster in the waveform_mean column. Both units tables then refer to it with a 'template'
+        column, see tables.template_waveform.
+    template_channels : int
+        with store_templates, only store each template on its template_channels channels of largest
+        amplitude, with their index in the electrodes table
+    shared_timestamps : bool
+        time the behavioral series sampled on 'post' by the 'post' timestamps, stored once by the first
+        series and linked to by the others (see clocks.Clock), instead of by its first time and the
+        rate of its first two samples
+    align_spikes : bool
+        add the trial and the hallway position of the mouse at each spike to the units table, as the
+        ragged columns 'spike_trial' (int16 row of the trials table, -1 outside of the behavioral
+        recording) and 'spike_position' (float32, in cm, interpolated within the trial), aligned with
+        spike_times. See alignment.SpikeAlignment.
+    rate_maps : bool
+        add the occupancy-normalized firing rate of each unit along the hallway (0 to 400 cm) to the
+        'ecephys' processing module: the 'rate_maps' table, one row per unit, and the 'rate_map_bins'
+        table of the position bins and the time spent in each. See ratemaps.rate_maps.
+    rate_map_bin_size : float
+        width of the position bins of the rate maps, in cm
+    rate_map_smoothing : float
+        standard deviation of the Gaussian smoothing of the rate maps along the hallway, in cm.
+        Not smoothed by default.
+    trial_rate_maps : bool
+        with rate_maps, also add the rate map of each unit in each trial ('trial_rate_map' column)
+    spike_count_matrix : bool
+        add the spike count of each unit in time bins of the behavioral clock ('post') to the 'ecephys'
+        processing module, as a sparse matrix: the 'spike_counts' table, whose ragged columns hold the
+        nonzero counts of each unit and their bins, and the 'spike_count_bins' table of the bin times.
+        See tables.make_spike_counts.
+    count_bin_width : float
+        width of the time bins of the spike count matrix, in seconds. By default each behavioral
+        sample is a bin.
+    quality_metrics : bool
+        add the quality metrics of each cluster to the units table, as float32 columns: firing_rate,
+        isi_violations (fraction of the inter-spike intervals shorter than isi_threshold),
+        amplitude_median and amplitude_iqr (of the template scaling amplitudes) and presence_ratio
+        (fraction of the trials with a spike). The firing rates are over the behavioral session, stretched
+        to the first or last spike if it falls outside. See metrics.quality_metrics.
+    isi_threshold : float
+        with quality_metrics, the refractory period of the isi_violations, in seconds
+    progress : callable
+        called with the name of each stage of the conversion as it starts (see profiling.ConversionProfile),
+        e.g. to report progress. An exception raised by it stops the conversion.
 
     Returns
     -------
@@ -74,247 +186,549 @@ def convert(input_file,
         The contents of the .mat file converted into the NWB format.  The nwbfile is saved to disk using NDWHDF5
     """
 
-    # input matlab data
-    matfile = hdf5storage.loadmat(input_file)
+    # pynwb, h5py and the lab extension take seconds to load: imported when a conversion starts, not with
+    # this module, so that the command line and the GUI come up at once (see import_check.HEAVY_MODULES)
+    import h5py
+    import numpy as np
+    from pynwb import NWBFile, NWBHDF5IO, H5DataIO
+    from pynwb.file import Subject
+    from pynwb.behavior import Position, BehavioralEvents
+    from pynwb.image import ImageSeries
+    from ndx_labmetadata_giocomo import LabMetaData_ext
+    from giocomo_lab_to_nwb.alignment import SpikeAlignment
+    from giocomo_lab_to_nwb.io_profiles import io_settings, wrap
+    from giocomo_lab_to_nwb.matfile import open_matfile
+    from giocomo_lab_to_nwb.metrics import quality_metrics as compute_quality_metrics, recording_duration
+    from giocomo_lab_to_nwb.ratemaps import rate_maps as compute_rate_maps
+    from giocomo_lab_to_nwb.raw import open_raw, raw_electrical_series, write_compressed
+    from giocomo_lab_to_nwb.spikecounts import time_bin_edges, binned_counts
+    from giocomo_lab_to_nwb.streaming import ChunkIterator, iterate
+    from giocomo_lab_to_nwb.tables import (group_columns, group_positions, index_dtype, make_units, largest_channels,
+                                           sparse_templates, make_templates, make_rate_maps, make_spike_counts,
+                                           make_electrodes, trial_boundaries, make_trials)
+    from giocomo_lab_to_nwb.tuner import tune_session
 
     # output path for nwb data
-    def replace_last(source_string, replace_what, replace_with):
-        head, _sep, tail = source_string.rpartition(replace_what)
-        return head + replace_with + tail
-    outpath = replace_last(input_file, '.mat', '.nwb')
-
-    create_date = datetime.today()
-    timezone_cali = pytz.timezone('US/Pacific')
-    create_date_tz = timezone_cali.localize(create_date)
-
-    # if loading data from config.yaml, convert string dates into datetime
-    if isinstance(session_start_time, str):
-        session_start_time = datetime.strptime(session_start_time, '%B %d, %Y %I:%M%p')
-        session_start_time = timezone_cali.localize(session_start_time)
-
-    if isinstance(subject_date_of_birth, str):
-        subject_date_of_birth = datetime.strptime(subject_date_of_birth, '%B %d, %Y %I:%M%p')
-        subject_date_of_birth = timezone_cali.localize(subject_date_of_birth)
-
-    # create unique identifier for this experimental session
-    uuid_identifier = uuid.uuid1()
-
-    # Create NWB file
-    nwbfile = NWBFile(session_description=experiment_description,  # required
-                      identifier=uuid_identifier.hex,  # required
-                      session_id=session_id,
-                      experiment_description=experiment_description,
-                      experimenter=experimenter,
-                      surgery=surgery,
-                      institution=institution,
-                      lab=lab_name,
-                      session_start_time=session_start_time,  # required
-                      file_create_date=create_date_tz)  # optional
-
-    # add information about the subject of the experiment
-    experiment_subject = Subject(subject_id=subject_id,
-                                 species=subject_species,
-                                 description=subject_description,
-                                 genotype=subject_genotype,
-                                 date_of_birth=subject_date_of_birth,
-                                 weight=subject_weight,
-                                 sex=subject_sex)
-    nwbfile.subject = experiment_subject
-
-    # adding constants via LabMetaData container
-    # constants
-    sample_rate = float(matfile['sp'][0]['sample_rate'][0][0][0])
-    n_channels_dat = int(matfile['sp'][0]['n_channels_dat'][0][0][0])
-    dat_path = matfile['sp'][0]['dat_path'][0][0][0]
-    offset = int(matfile['sp'][0]['offset'][0][0][0])
-    data_dtype = matfile['sp'][0]['dtype'][0][0][0]
-    hp_filtered = bool(matfile['sp'][0]['hp_filtered'][0][0][0])
-    vr_session_offset = matfile['sp'][0]['vr_session_offset'][0][0][0]
-    # container
-    lab_metadata = LabMetaData_ext(name='LabMetaData',
-                                   acquisition_sampling_rate=sample_rate,
-                                   number_of_electrodes=n_channels_dat,
-                                   file_path=dat_path,
-                                   bytes_to_skip=offset,
-                                   raw_data_dtype=data_dtype,
-                                   high_pass_filtered=hp_filtered,
-                                   movie_start_time=vr_session_offset)
-    nwbfile.add_lab_meta_data(lab_metadata)
-
-    # Adding trial information
-    nwbfile.add_trial_column('trial_contrast', 'visual contrast of the maze through which the mouse is running')
-    trial = np.ravel(matfile['trial'])
-    trial_nums = np.unique(trial)
-    position_time = np.ravel(matfile['post'])
-    # matlab trial numbers start at 1. To correctly index trial_contract vector,
-    # subtracting 1 from 'num' so index starts at 0
-    for num in trial_nums:
-        trial_times = position_time[trial == num]
-        nwbfile.add_trial(start_time=trial_times[0],
-                          stop_time=trial_times[-1],
-                          trial_contrast=matfile['trial_contrast'][num-1][0])
-
-
-    # Add mouse position inside:
-    position = Position()
-    position_virtual = np.ravel(matfile['posx'])
-    # position inside the virtual environment
-    sampling_rate = 1/(position_time[1] - position_time[0])
-    position.create_spatial_series(name='Position',
-                                   data=position_virtual,
-                                   starting_time=position_time[0],
-                                   rate=sampling_rate,
-                                   reference_frame='The start of the trial, which begins at the start '
-                                                   'of the virtual hallway.',
-                                   conversion=0.01,
-                                   description='Subject position in the virtual hallway.',
-                                   comments='The values should be >0 and <400cm. Values greater than '
-                                            '400cm mean that the mouse briefly exited the maze.',)
-
-    # physical position on the mouse wheel
-    physical_posx = position_virtual
-    trial_gain = np.ravel(matfile['trial_gain'])
-    for num in trial_nums:
-        physical_posx[trial == num] = physical_posx[trial == num]/trial_gain[num-1]
-
-    position.create_spatial_series(name='PhysicalPosition',
-                                   data=physical_posx,
-                                   starting_time=position_time[0],
-                                   rate=sampling_rate,
-                                   reference_frame='Location on wheel re-referenced to zero '
-                                                   'at the start of each trial.',
-                                   conversion=0.01,
-                                   description='Physical location on the wheel measured '
-                                               'since the beginning of the trial.',
-                                   comments='Physical location found by dividing the '
-                                            'virtual position by the "trial_gain"')
-    nwbfile.add_acquisition(position)
-
-    # Add timing of lick events, as well as mouse's virtual position during lick event
-    lick_events = BehavioralEvents()
-    lick_events.create_timeseries('LickEvents',
-                                  data=np.ravel(matfile['lickx']),
-                                  timestamps=np.ravel(matfile['lickt']),
-                                  unit='centimeter',
-                                  description='Subject position in virtual hallway during the lick.')
-    nwbfile.add_acquisition(lick_events)
-
-    # Add information on the visual stimulus that was shown to the subject
-    # Assumed rate=60 [Hz]. Update if necessary
-    # Update external_file to link to Unity environment file
-    visualization = ImageSeries(name='ImageSeries',
-                                unit='seconds',
-                                format='external',
-                                external_file=list(['https://unity.com/VR-and-AR-corner']),
-                                starting_time=vr_session_offset,
-                                starting_frame=[[0]],
-                                rate=float(60),
-                                description='virtual Unity environment that the mouse navigates through')
-    nwbfile.add_stimulus(visualization)
-
-    # Add the recording device, a neuropixel probe
-    recording_device = nwbfile.create_device(name='neuropixel_probes')
-    electrode_group_description = 'single neuropixels probe http://www.open-ephys.org/neuropixelscorded'
-    electrode_group_name = 'probe1'
-
-    electrode_group = nwbfile.create_electrode_group(electrode_group_name,
-                                                     description=electrode_group_description,
-                                                     location=subject_brain_region,
-                                                     device=recording_device)
-
-    # Add information about each electrode
-    xcoords = np.ravel(matfile['sp'][0]['xcoords'][0])
-    ycoords = np.ravel(matfile['sp'][0]['ycoords'][0])
-    data_filtered_flag = matfile['sp'][0]['hp_filtered'][0][0]
-    if data_filtered_flag:
-        filter_desc = 'The raw voltage signals from the electrodes were high-pass filtered'
-    else:
-        filter_desc = 'The raw voltage signals from the electrodes were not high-pass filtered'
-
-    num_recording_electrodes = xcoords.shape[0]
-    recording_electrodes = range(0, num_recording_electrodes)
-
-    # create electrode columns for the x,y location on the neuropixel  probe
-    # the standard x,y,z locations are reserved for Allen Brain Atlas location
-    nwbfile.add_electrode_column('rel_x', 'electrode x-location on the probe')
-    nwbfile.add_electrode_column('rel_y', 'electrode y-location on the probe')
-
-    for idx in recording_electrodes:
-        nwbfile.add_electrode(id=idx,
-                              x=np.nan,
-                              y=np.nan,
-                              z=np.nan,
-                              rel_x=float(xcoords[idx]),
-                              rel_y=float(ycoords[idx]),
-                              imp=np.nan,
-                              location='medial entorhinal cortex',
-                              filtering=filter_desc,
-                              group=electrode_group)
-
-
-    # Add information about each unit, termed 'cluster' in giocomo data
-    # create new columns in unit table
-    nwbfile.add_unit_column('quality', 'labels given to clusters during manual sorting in phy (1=MUA, '
-                                       '2=Good, 3=Unsorted)')
-
-    # cluster information
-    cluster_ids = matfile['sp'][0]['cids'][0][0]
-    cluster_quality = matfile['sp'][0]['cgs'][0][0]
-    # spikes in time
-    spike_times = np.ravel(matfile['sp'][0]['st'][0])  # the time of each spike
-    spike_cluster = np.ravel(matfile['sp'][0]['clu'][0])  # the cluster_id that spiked at that time
-
-    for i, cluster_id in enumerate(cluster_ids):
-        unit_spike_times = spike_times[spike_cluster == cluster_id]
-        waveforms = matfile['sp'][0]['temps'][0][cluster_id]
-        nwbfile.add_unit(id=int(cluster_id),
-                         spike_times=unit_spike_times,
-                         quality=cluster_quality[i],
-                         waveform_mean=waveforms,
-                         electrode_group=electrode_group)
-
-    # Trying to add another Units table to hold the results of the automatic spike sorting
-    # create TemplateUnits units table
-    template_units = Units(name='TemplateUnits',
-                           description='units assigned during automatic spike sorting')
-    template_units.add_column('tempScalingAmps', 'scaling amplitude applied to the template when extracting spike', index=True)
-
-    # information on extracted spike templates
-    spike_templates = np.ravel(matfile['sp'][0]['spikeTemplates'][0])
-    spike_template_ids = np.unique(spike_templates)
-    # template scaling amplitudes
-    temp_scaling_amps = np.ravel(matfile['sp'][0]['tempScalingAmps'][0])
-
-    for i, spike_template_id in enumerate(spike_template_ids):
-        template_spike_times = spike_times[spike_templates == spike_template_id]
-        temp_scaling_amps_per_template = temp_scaling_amps[spike_templates == spike_template_id]
-        template_units.add_unit(id=int(spike_template_id),
-                                spike_times=template_spike_times,
-                                electrode_group=electrode_group,
-                                tempScalingAmps=temp_scaling_amps_per_template)
-
-    # create ecephys processing module
-    spike_template_module = nwbfile.create_processing_module(
-        name='ecephys', description='units assigned during automatic spike sorting')
-
-    # add template_units table to processing module
-    spike_template_module.add(template_units)
-
-    print(nwbfile)
-    print('converted to NWB:N')
-    print('saving ...')
-
-    with NWBHDF5IO(outpath, 'w') as io:
-        io.write(nwbfile)
-        print('saved', outpath)
-
-
-def read_yaml(config_file='config.yaml'):
+    outpath = nwb_path(input_file)
+
+    profiler = ConversionProfile.from_setting(profile, progress)
+    profiler.info.update(input_file=input_file, output_file=outpath, stream=stream, io_profile=io_profile)
+
+    # the profiler is closed even if the conversion fails, so that tracemalloc does not keep tracing
+    try:
+        # input matlab data, only the variables used below are decoded
+        profiler.stage('mat load')
+        matfile = open_matfile(input_file)
+
+        # when streaming, large arrays are read from the .mat file only while the .nwb file is written.
+        # Spikes are grouped by unit through scratch files next to the output.
+        if stream:
+            scratch = tempfile.TemporaryDirectory(prefix='.scratch_', dir=os.path.dirname(os.path.abspath(outpath)))
+            scratch_dir = scratch.name
+        else:
+            scratch_dir = None
+
+        def read_vector(name):
+            if stream:
+                return iterate(matfile.source(name), chunk_size)
+            return matfile.vector(name)
+
+        profiler.stage('metadata')
+        create_date = datetime.today()
+        timezone_cali = pytz.timezone('US/Pacific')
+        create_date_tz = timezone_cali.localize(create_date)
+
+        # if loading data from config.yaml, convert string dates into datetime
+        if isinstance(session_start_time, str):
+            session_start_time = datetime.strptime(session_start_time, '%B %d, %Y %I:%M%p')
+            session_start_time = timezone_cali.localize(session_start_time)
+
+        if isinstance(subject_date_of_birth, str):
+            subject_date_of_birth = datetime.strptime(subject_date_of_birth, '%B %d, %Y %I:%M%p')
+            subject_date_of_birth = timezone_cali.localize(subject_date_of_birth)
+
+        # create unique identifier for this experimental session
+        uuid_identifier = uuid.uuid1()
+
+        # Create NWB file
+        nwbfile = NWBFile(session_description=experiment_description,  # required
+                          identifier=uuid_identifier.hex,  # required
+                          session_id=session_id,
+                          experiment_description=experiment_description,
+                          experimenter=experimenter,
+                          surgery=surgery,
+                          institution=institution,
+                          lab=lab_name,
+                          session_start_time=session_start_time,  # required
+                          file_create_date=create_date_tz)  # optional
+
+        # add information about the subject of the experiment
+        experiment_subject = Subject(subject_id=subject_id,
+                                     species=subject_species,
+                                     description=subject_description,
+                                     genotype=subject_genotype,
+                                     date_of_birth=subject_date_of_birth,
+                                     weight=subject_weight,
+                                     sex=subject_sex)
+        nwbfile.subject = experiment_subject
+
+        # adding constants via LabMetaData container
+        # constants
+        sample_rate = float(matfile.scalar('sp/sample_rate'))
+        n_channels_dat = int(matfile.scalar('sp/n_channels_dat'))
+        dat_path = matfile.string('sp/dat_path')
+        offset = int(matfile.scalar('sp/offset'))
+        data_dtype = matfile.string('sp/dtype')
+        hp_filtered = bool(matfile.scalar('sp/hp_filtered'))
+        vr_session_offset = matfile.scalar('sp/vr_session_offset')
+        # container
+        lab_metadata = LabMetaData_ext(name='LabMetaData',
+                                       acquisition_sampling_rate=sample_rate,
+                                       number_of_electrodes=n_channels_dat,
+                                       file_path=dat_path,
+                                       bytes_to_skip=offset,
+                                       raw_data_dtype=data_dtype,
+                                       high_pass_filtered=hp_filtered,
+                                       movie_start_time=vr_session_offset,
+                                       subject_brain_region=subject_brain_region)
+        nwbfile.add_lab_meta_data(lab_metadata)
+
+        # the raw recording is memory-mapped here, its data are only read when written
+        if add_raw:
+            if raw_path is None:
+                raw_path = dat_path
+            raw_path = os.path.join(os.path.dirname(os.path.abspath(input_file)), raw_path)
+            raw = open_raw(raw_path, n_channels_dat, data_dtype, offset)
+
+        # choose the chunking and filters of the large datasets on samples of this session
+        if io_goal is not None:
+            profiler.stage('io tuning')
+            io_profile, tuning = tune_session(matfile, io_goal, io_min_write_speed, raw=raw if add_raw else None)
+            profiler.info.update(io_profile=io_profile, io_tuning=tuning)
+            for kind, chosen in tuning['chosen'].items():
+                print('%s: %s, chunks of %d values (ratio %.2f, write %.0f MB/s, read %.0f MB/s)'
+                      % (kind, chosen['filter'], chosen['chunk_values'], chosen['ratio'], chosen['write_speed'],
+                         chosen['read_speed']))
+
+        # Adding trial information
+        profiler.stage('trials')
+        # when streaming, the per-sample vectors are only read in chunks and at the trial boundaries
+        if stream:
+            trial = matfile.source('trial')
+            position_time = matfile.source('post')
+        else:
+            trial = matfile.vector('trial')
+            position_time = matfile.vector('post')
+        trial_nums, trial_first, trial_last = trial_boundaries(trial, chunk_size)
+        # matlab trial numbers start at 1. To correctly index trial_contract vector,
+        # subtracting 1 from 'num' so index starts at 0
+        trial_contrast = matfile.vector('trial_contrast')[trial_nums.astype(int) - 1]
+        trial_start_times = position_time[trial_first]
+        trial_stop_times = position_time[trial_last]
+        nwbfile.trials = make_trials(start_times=trial_start_times,
+                                     stop_times=trial_stop_times,
+                                     trial_columns=[('trial_contrast',
+                                                     'visual contrast of the maze through which the mouse is running',
+                                                     trial_contrast)])
+
+        # Add mouse position inside:
+        profiler.stage('position')
+        position = Position()
+        position_virtual = read_vector('posx')
+        # the behavioral samples are timed by one clock, 'post'
+        if shared_timestamps:
+            post_clock = Clock(timestamps=wrap(iterate(position_time, chunk_size) if stream else position_time,
+                                               'position', io_profile))
+        else:
+            sampling_rate = 1/(position_time[1] - position_time[0])
+            post_clock = Clock(starting_time=position_time[0], rate=sampling_rate)
+        # position inside the virtual environment
+        virtual_series = position.create_spatial_series(name='Position',
+                                                        data=wrap(position_virtual, 'position', io_profile),
+                                                        reference_frame='The start of the trial, which begins at the '
+                                                                        'start of the virtual hallway.',
+                                                        conversion=0.01,
+                                                        description='Subject position in the virtual hallway.',
+                                                        comments='The values should be >0 and <400cm. Values '
+                                                                 'greater than 400cm mean that the mouse briefly '
+                                                                 'exited the maze.',
+                                                        **post_clock.timing())
+        post_clock.add(virtual_series)
+
+        # physical position on the mouse wheel
+        # divide every sample by the gain of its trial, leaving position_virtual untouched
+        trial_gain = matfile.vector('trial_gain')
+        if stream:
+            posx = matfile.source('posx')
+            physical_posx = ChunkIterator(read=lambda start, stop: (posx[start:stop] /
+                                                                   trial_gain[trial[start:stop].astype(int) - 1]),
+                                          shape=posx.shape,
+                                          dtype=np.float64,
+                                          chunk_size=chunk_size)
+        else:
+            physical_posx = position_virtual / trial_gain[trial.astype(int) - 1]
+
+        physical_series = position.create_spatial_series(name='PhysicalPosition',
+                                                         data=wrap(physical_posx, 'position', io_profile),
+                                                         reference_frame='Location on wheel re-referenced to zero '
+                                                                         'at the start of each trial.',
+                                                         conversion=0.01,
+                                                         description='Physical location on the wheel measured '
+                                                                     'since the beginning of the trial.',
+                                                         comments='Physical location found by dividing the '
+                                                                  'virtual position by the "trial_gain"',
+                                                         **post_clock.timing())
+        post_clock.add(physical_series)
+        nwbfile.add_acquisition(position)
+
+        # Add timing of lick events, as well as mouse's virtual position during lick event
+        profiler.stage('licks')
+        lick_events = BehavioralEvents()
+        # other series timed by the licks link to the timestamps of the lick events
+        lick_clock = Clock(timestamps=wrap(read_vector('lickt'), 'lick', io_profile))
+        lick_clock.add(lick_events.create_timeseries('LickEvents',
+                                                     data=wrap(read_vector('lickx'), 'lick', io_profile),
+                                                     unit='centimeter',
+                                                     description='Subject position in virtual hallway during the lick.',
+                                                     **lick_clock.timing()))
+        nwbfile.add_acquisition(lick_events)
+
+        # Add information on the visual stimulus that was shown to the subject
+        profiler.stage('stimulus')
+        # Assumed rate=60 [Hz]. Update if necessary
+        # Update external_file to link to Unity environment file
+        visualization = ImageSeries(name='ImageSeries',
+                                    unit='seconds',
+                                    format='external',
+                                    external_file=list(['https://unity.com/VR-and-AR-corner']),
+                                    starting_time=vr_session_offset,
+                                    starting_frame=[[0]],
+                                    rate=float(60),
+                                    description='virtual Unity environment that the mouse navigates through')
+        nwbfile.add_stimulus(visualization)
+
+        # Add the recording device, a neuropixel probe
+        profiler.stage('electrodes')
+        recording_device = nwbfile.create_device(name='neuropixel_probes')
+        electrode_group_description = 'single neuropixels probe http://www.open-ephys.org/neuropixelscorded'
+        electrode_group_name = 'probe1'
+
+        electrode_group = nwbfile.create_electrode_group(electrode_group_name,
+                                                         description=electrode_group_description,
+                                                         location=subject_brain_region,
+                                                         device=recording_device)
+
+        # Add information about each electrode
+        xcoords = matfile.vector('sp/xcoords')
+        ycoords = matfile.vector('sp/ycoords')
+        data_filtered_flag = matfile.scalar('sp/hp_filtered')
+        if data_filtered_flag:
+            filter_desc = 'The raw voltage signals from the electrodes were high-pass filtered'
+        else:
+            filter_desc = 'The raw voltage signals from the electrodes were not high-pass filtered'
+
+        # create electrode columns for the x,y location on the neuropixel  probe
+        # the standard x,y,z locations are reserved for Allen Brain Atlas location
+        nwbfile.electrodes = make_electrodes(electrode_group,
+                                             location='medial entorhinal cortex',
+                                             filtering=filter_desc,
+                                             probe_columns=[('rel_x', 'electrode x-location on the probe', xcoords),
+                                                            ('rel_y', 'electrode y-location on the probe', ycoords)])
+
+        # Add the raw voltage recording, streamed from the memory-mapped .dat file
+        if add_raw:
+            profiler.stage('raw')
+            raw_electrodes = nwbfile.create_electrode_table_region(list(range(len(xcoords))),
+                                                                   'electrodes recorded in the raw .dat file')
+            nwbfile.add_acquisition(raw_electrical_series(raw, raw_electrodes, sample_rate,
+                                                          description='raw voltage recording from ' + dat_path,
+                                                          chunk_size=chunk_size,
+                                                          compress=raw_workers is not None,
+                                                          io_profile=io_profile))
+
+        # Add information about each unit, termed 'cluster' in giocomo data
+        profiler.stage('units')
+        # cluster information
+        cluster_ids = matfile.vector('sp/cids')
+        cluster_quality = matfile.vector('sp/cgs')
+        # spikes in time: the time of each spike and the cluster_id that spiked at that time
+        if stream:
+            spike_times = matfile.source('sp/st')
+            spike_cluster = matfile.source('sp/clu')
+            # template scaling amplitudes
+            temp_scaling_amps = matfile.source('sp/tempScalingAmps')
+        else:
+            spike_times = matfile.vector('sp/st')
+            spike_cluster = matfile.vector('sp/clu')
+            temp_scaling_amps = matfile.vector('sp/tempScalingAmps')
+        num_spikes = len(spike_times)
+
+        # the trial and position at each spike, from the behavioral samples around it
+        if align_spikes or rate_maps:
+            alignment = SpikeAlignment(spike_times, position_time,
+                                       matfile.source('posx') if stream else position_virtual,
+                                       trial, trial_nums, chunk_size)
+        if align_spikes:
+            profiler.stage('spike alignment')
+            if stream:
+                # computed chunk by chunk while the spikes are grouped
+                aligned = [alignment.trial, alignment.position]
+            else:
+                aligned = [np.asarray(alignment.trial), np.asarray(alignment.position)]
+            profiler.stage('units')
+        else:
+            aligned = []
+
+        # group the spikes by cluster once, each unit is a contiguous run of the grouped spike times.
+        # The amplitudes of the quality metrics are grouped along.
+        metric_sources = [temp_scaling_amps] if quality_metrics else []
+        cluster_ids, cluster_spike_counts, grouped = group_columns(spike_cluster, cluster_ids,
+                                                                   [spike_times] + aligned + metric_sources,
+                                                                   scratch_dir, chunk_size)
+        cluster_spike_times = grouped[0]
+        if align_spikes:
+            cluster_spike_trial, cluster_spike_position = grouped[1:3]
+            aligned_columns = [('spike_trial', 'row of the trials table at each spike, -1 outside of the behavioral '
+                                               'recording', wrap(cluster_spike_trial, 'spike_times', io_profile)),
+                               ('spike_position', 'position of the mouse in the virtual hallway at each spike, in cm',
+                                wrap(cluster_spike_position, 'spike_times', io_profile))]
+        else:
+            aligned_columns = []
+
+        # the mean waveform of a cluster is the template with the same id
+        templates = matfile.source('sp/temps') if stream else matfile.array('sp/temps')
+        if store_templates:
+            # each template is written once and the units refer to it by its index
+            if template_channels:
+                channels = largest_channels(templates, template_channels, chunk_size)
+                template_waveforms = sparse_templates(templates, channels, chunk_size if stream else None)
+            else:
+                channels = None
+                template_waveforms = iterate(templates, chunk_size) if stream else templates
+            template_shape = (len(templates),) + tuple(template_waveforms.shape[1:])
+            template_settings = (io_settings(io_profile, 'waveforms', template_shape)
+                                 or {'chunks': (1,) + template_shape[1:]})
+            template_table = make_templates(np.arange(len(templates)),
+                                            H5DataIO(template_waveforms, **template_settings), channels)
+            waveform_columns = []
+            template_columns = [('template', 'the template of each unit, in the templates table of the ecephys module',
+                                 cluster_ids.astype(int), template_table)]
+        else:
+            if stream:
+                waveforms = ChunkIterator(read=lambda start, stop: np.stack(
+                                              [templates[int(cluster_id)] for cluster_id in cluster_ids[start:stop]]),
+                                          shape=(len(cluster_ids),) + tuple(templates.shape[1:]),
+                                          dtype=templates.dtype,
+                                          chunk_size=chunk_size)
+            else:
+                waveforms = templates[cluster_ids.astype(int)]
+            waveform_columns = [('waveform_mean', 'the spike waveform mean for each spike unit',
+                                 wrap(waveforms, 'waveforms', io_profile))]
+            template_columns = []
+
+        if quality_metrics:
+            profiler.stage('quality metrics')
+            # the recording covers the behavioral session, even when the last spike comes before its end
+            duration = recording_duration(position_time, spike_times)
+            metric_columns = compute_quality_metrics(cluster_spike_times, grouped[-1], cluster_spike_counts,
+                                                     trial_start_times, trial_stop_times, duration, isi_threshold,
+                                                     chunk_size)
+            profiler.stage('units')
+        else:
+            metric_columns = []
+
+        nwbfile.units = make_units(name='units',
+                                   description='clusters from manual spike sorting in phy',
+                                   ids=cluster_ids,
+                                   spike_times=wrap(cluster_spike_times, 'spike_times', io_profile),
+                                   spike_counts=cluster_spike_counts,
+                                   electrode_group=electrode_group,
+                                   columns=[('quality', 'labels given to clusters during manual sorting in phy (1=MUA, '
+                                                        '2=Good, 3=Unsorted)', cluster_quality)] + waveform_columns
+                                   + metric_columns,
+                                   ragged_columns=aligned_columns,
+                                   region_columns=template_columns)
+
+        # firing rate of every unit along the hallway, counted in one pass over the spikes
+        if rate_maps:
+            profiler.stage('rate maps')
+            if align_spikes and not stream:
+                spike_trial, spike_position = aligned
+            else:
+                spike_trial, spike_position = alignment.trial, alignment.position
+            edges, occupancy, rates, trial_occupancy, trial_rates = compute_rate_maps(
+                spike_cluster, cluster_ids, spike_trial, spike_position, position_time,
+                matfile.source('posx') if stream else position_virtual, trial, trial_nums,
+                bin_size=rate_map_bin_size, smoothing=rate_map_smoothing, by_trial=trial_rate_maps,
+                chunk_size=chunk_size)
+            analysis_tables = list(make_rate_maps(nwbfile.units, edges, occupancy, rates, trial_occupancy, trial_rates,
+                                                  smoothing=rate_map_smoothing))
+        else:
+            analysis_tables = []
+
+        # spike count of every unit in time bins of the behavioral clock, from the spike times grouped by unit
+        if spike_count_matrix:
+            profiler.stage('spike counts')
+            count_edges = time_bin_edges(position_time[0:len(position_time)], count_bin_width)
+            count_bins, bin_counts, bin_row_counts = binned_counts(cluster_spike_times, cluster_spike_counts,
+                                                                   count_edges, scratch_dir, chunk_size)
+            analysis_tables.extend(make_spike_counts(nwbfile.units, count_edges, count_bins, bin_counts,
+                                                     bin_row_counts))
+
+        # Trying to add another Units table to hold the results of the automatic spike sorting
+        profiler.stage('template units')
+        # information on extracted spike templates
+        if stream:
+            spike_templates = matfile.source('sp/spikeTemplates')
+        else:
+            spike_templates = matfile.vector('sp/spikeTemplates')
+
+        if share_spike_times and int(cluster_spike_counts.sum()) != num_spikes:
+            print('not sharing spike times: %d spikes belong to no cluster of cids'
+                  % (num_spikes - int(cluster_spike_counts.sum())))
+            share_spike_times = False
+
+        # group the spikes by template once and hand the grouped columns to the TemplateUnits table
+        if share_spike_times:
+            # each template spike refers to its copy in the units table instead of storing the time again
+            spike_positions = group_positions(spike_cluster, cluster_ids, scratch_dir, chunk_size,
+                                              index_dtype(num_spikes))
+            spike_template_ids, template_spike_counts, (template_spike_index, template_scaling_amps) = group_columns(
+                spike_templates, None, [spike_positions, temp_scaling_amps], scratch_dir, chunk_size)
+            template_spike_times = None
+            # within a template the indices mostly run up one by one, which compresses to almost nothing
+            spike_index_columns = [('spike_index', 'index of each spike of the template in units/spike_times',
+                                    H5DataIO(template_spike_index, compression='gzip', compression_opts=1,
+                                             shuffle=True))]
+        else:
+            spike_template_ids, template_spike_counts, (template_spike_times, template_scaling_amps) = group_columns(
+                spike_templates, None, [spike_times, temp_scaling_amps], scratch_dir, chunk_size)
+            spike_index_columns = []
+        template_units = make_units(name='TemplateUnits',
+                                    description='units assigned during automatic spike sorting',
+                                    ids=spike_template_ids,
+                                    spike_times=wrap(template_spike_times, 'spike_times', io_profile),
+                                    spike_counts=template_spike_counts,
+                                    electrode_group=electrode_group,
+                                    ragged_columns=spike_index_columns + [
+                                        ('tempScalingAmps',
+                                         'scaling amplitude applied to the template when extracting spike',
+                                         wrap(template_scaling_amps, 'spike_times', io_profile))],
+                                    region_columns=[('template', 'the template of each unit, in the templates table',
+                                                     spike_template_ids.astype(int), template_table)]
+                                    if store_templates else [])
+
+        # create ecephys processing module
+        spike_template_module = nwbfile.create_processing_module(
+            name='ecephys', description='units assigned during automatic spike sorting')
+
+        # add template_units table to processing module
+        spike_template_module.add(template_units)
+        if store_templates:
+            spike_template_module.add(template_table)
+        for table in analysis_tables:
+            spike_template_module.add(table)
+
+        profiler.stage('hdf5 write')
+        print(nwbfile)
+        print('converted to NWB:N')
+        print('saving ...')
+
+        with NWBHDF5IO(outpath, 'w') as io:
+            io.write(nwbfile)
+            print('saved', outpath)
+        if add_raw and raw_workers is not None:
+            profiler.stage('raw compression')
+            print('compressing raw data ...')
+            with h5py.File(outpath, 'r+') as nwb_h5:
+                raw_data = nwb_h5['acquisition/ElectricalSeries/data']
+                write_compressed(raw_data, raw[:, :raw_data.shape[1]], workers=raw_workers)
+        matfile.close()
+        if stream:
+            scratch.cleanup()
+        report = profiler.write(outpath)
+        if report is not None:
+            print('conversion report saved', report)
+    finally:
+        profiler.close()
+
+
+def read_yaml(config_file='config.yaml', workers=1, memory_limit=None, use_cache=True, force=False):
+    """
+    Convert every session (YAML document) of a config file.
+
+    Converted sessions are recorded in a manifest (cache.MANIFEST_NAME) next to the config file.
+    Sessions whose .nwb file is up to date with their input file and arguments are skipped.
+
+    Parameters
+    ----------
+    config_file : str
+        path to the YAML config file, one document of convert() arguments per session
+    workers : int
+        number of sessions converted in parallel
+    memory_limit : float
+        memory available to the conversions, in bytes. Defaults to the memory currently available.
+    use_cache : bool
+        skip up-to-date sessions and record the converted ones in the manifest
+    force : bool
+        convert every session, even if up to date or a duplicate of another session
+
+    Returns
+    -------
+    summary : list of dict
+        whether each session was converted, see batch.convert_batch
+    """
+    with open(config_file, 'r') as input_file:
+        results = [experiment_info for experiment_info in yaml_as_python(input_file) if experiment_info]
+    cache = ConversionCache(manifest_path(config_file)) if use_cache else None
+    return convert_batch(results, workers=workers, memory_limit=memory_limit, cache=cache, force=force)
+
+
+def manifest_path(config_file):
+    """The conversion manifest of the sessions of a config file."""
+    return os.path.join(os.path.dirname(os.path.abspath(config_file)), MANIFEST_NAME)
+
+
+def clean_cache(config_file='config.yaml'):
+    """
+    Remove the entries of the conversion manifest whose .nwb or .mat file was deleted or changed.
+
+    Returns
+    -------
+    evicted : list of str
+        the .nwb paths of the removed entries
+    """
+    evicted = ConversionCache(manifest_path(config_file)).evict_stale()
+    print('%d stale entries removed from the conversion manifest' % len(evicted))
+    for output_file in evicted:
+        print('  ' + output_file)
+    return evicted
+
+
+def preview_config(config_file='config.yaml'):
+    """
+    Print the size of every session of a config file and the expected time and size of its conversion.
+
+    Only the headers of the .mat files are read, see preview.preview_sessions.
+
+    Returns
+    -------
+    previews : list of dict
+        the preview and estimate of each session
+    """
+    from giocomo_lab_to_nwb.preview import describe, format_bytes, format_seconds, preview_sessions
+
     with open(config_file, 'r') as input_file:
-        results = yaml_as_python(input_file)
-        for experiment_info in results:
-            print('converting', experiment_info['input_file'])
-            convert(**experiment_info)
+        sessions = [experiment_info for experiment_info in yaml_as_python(input_file) if experiment_info]
+    previews = preview_sessions(sessions)
+    for preview in previews:
+        print('%s: %s' % (preview['input_file'], describe(preview)))
+    estimated = [preview for preview in previews if preview['seconds'] is not None]
+    print('%d sessions: about %s and %s in all%s'
+          % (len(previews), format_seconds(sum(preview['seconds'] for preview in estimated)),
+             format_bytes(sum(preview['output_bytes'] for preview in estimated)),
+             '' if len(estimated) == len(previews) else ', %d without an estimate' % (len(previews) - len(estimated))))
+    return previews
 
 
 def yaml_as_python(val):
@@ -331,13 +745,32 @@ if __name__ == '__main__':
     -function calls with conversion.convert()
     -run interface_gui
     -run conversion.py in the terminal which will calls interface_config and convert the data listed in that file
-        e.g. *\PycharmProjects\giocomo-lab-to-nwb\giocomo_lab_to_nwb>conversion.py config.yaml
+        e.g. *\PycharmProjects\giocomo-lab-to-nwb\giocomo_lab_to_nwb>conversion.py config.yaml --workers 4
     '''
-
-    if len(sys.argv) > 1:
-        # this indicates conversion.py being called from terminal and should use path entered in terminal
-        config_file_path = sys.argv[1]
-        read_yaml(config_file_path)
-    else:
-        # indicates __main__ being run inside editor
-        read_yaml()
+    parser = argparse.ArgumentParser(description='Convert the sessions listed in a YAML config file to NWB.')
+    parser.add_argument('config_file', nargs='?', default='config.yaml',
+                        help='YAML file with one document of convert() arguments per session')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of sessions converted in parallel')
+    parser.add_argument('--memory-limit', type=float, default=None,
+                        help='memory available to the conversions, in GB (default: the available memory)')
+    parser.add_argument('--force', action='store_true',
+                        help='convert every session, even those whose .nwb file is up to date')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='neither skip nor record sessions in the conversion manifest')
+    parser.add_argument('--clean-cache', action='store_true',
+                        help='only remove stale entries from the conversion manifest, convert nothing')
+    parser.add_argument('--preview', action='store_true',
+                        help='only print the size of each session and the expected time and size of its conversion')
+    args = parser.parse_args()
+    if args.clean_cache:
+        clean_cache(args.config_file)
+        sys.exit(0)
+    if args.preview:
+        preview_config(args.config_file)
+        sys.exit(0)
+    memory_limit = None if args.memory_limit is None else args.memory_limit * 2 ** 30
+    summary = read_yaml(args.config_file, workers=args.workers, memory_limit=memory_limit,
+                        use_cache=not args.no_cache, force=args.force)
+    if any(result['status'] == 'failed' for result in summary):
+        sys.exit(1)
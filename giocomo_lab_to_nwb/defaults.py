@@ -0,0 +1,12 @@
+# Default values of the convert() arguments.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+# Kept apart from the modules using them, so that the signature of convert() is known,
+# e.g. by the command line and the conversion cache, without importing numpy or pynwb.
+
+# number of values read and written at a time
+DEFAULT_CHUNK_SIZE = 2 ** 20
+# width of the position bins of the rate maps, in cm
+DEFAULT_BIN_SIZE = 5.0
+# inter-spike intervals shorter than this, in seconds, violate the refractory period
+ISI_THRESHOLD = 0.0015
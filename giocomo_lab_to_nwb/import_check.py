@@ -0,0 +1,118 @@
+# Import-time check of the entry points of the command line and the GUI.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import argparse
+import json
+import subprocess
+import sys
+
+# the modules loaded when the command line or the GUI starts, before a conversion is run
+ENTRY_MODULES = ('giocomo_lab_to_nwb.conversion', 'giocomo_lab_to_nwb.batch', 'giocomo_lab_to_nwb.cache',
+                 'giocomo_lab_to_nwb.worker', 'giocomo_lab_to_nwb.interface_gui')
+# modules that take long to import, left to the conversion itself
+HEAVY_MODULES = ('pynwb', 'hdmf', 'h5py', 'hdf5storage', 'ndx_labmetadata_giocomo', 'numpy', 'pandas', 'scipy',
+                 'tkcalendar')
+# imports of each module, in fresh processes: the fastest is kept, the others pay for a cold disk cache
+DEFAULT_REPEATS = 3
+# import time allowed to an entry module, in seconds. pynwb alone takes about a second.
+DEFAULT_MAX_SECONDS = 0.3
+
+_IMPORT_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import %s
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'modules': sorted(sys.modules)}))
+'''
+
+
+def import_time(module, repeats=DEFAULT_REPEATS):
+    """
+    Import a module in fresh interpreters and return the fastest import time and the modules it loaded.
+
+    Returns
+    -------
+    seconds : float
+        the fastest of `repeats` imports, in seconds
+    modules : list of str
+        the names of sys.modules after the import
+    """
+    results = []
+    for _repeat in range(repeats):
+        output = subprocess.run([sys.executable, '-c', _IMPORT_SCRIPT % module], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, universal_newlines=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    fastest = min(results, key=lambda result: result['seconds'])
+    return fastest['seconds'], fastest['modules']
+
+
+def importable(module):
+    """Whether a module can be imported at all, e.g. tkinter for the GUI, in a fresh interpreter."""
+    return subprocess.run([sys.executable, '-c', 'import %s' % module], stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL).returncode == 0
+
+
+def check_imports(modules=ENTRY_MODULES, max_seconds=DEFAULT_MAX_SECONDS, repeats=DEFAULT_REPEATS):
+    """
+    Check that the entry modules import fast and without loading any of HEAVY_MODULES.
+
+    Parameters
+    ----------
+    modules : iterable of str
+        the modules checked. A module that fails to import, e.g. the GUI without tkinter, is skipped.
+    max_seconds : float, optional
+        the import time allowed to each module, not checked if None
+    repeats : int
+        imports of each module, the fastest is kept
+
+    Returns
+    -------
+    measured : list of dict
+        module, seconds (None if skipped) and the heavy modules it loaded, for each module
+    failures : list of str
+        one message per module that is too slow or loads a heavy module
+    """
+    measured = []
+    failures = []
+    for module in modules:
+        if not importable(module):
+            measured.append({'module': module, 'seconds': None, 'heavy': []})
+            continue
+        seconds, loaded = import_time(module, repeats)
+        heavy = [name for name in HEAVY_MODULES if name in loaded]
+        measured.append({'module': module, 'seconds': seconds, 'heavy': heavy})
+        if heavy:
+            failures.append('%s loads %s at import' % (module, ', '.join(heavy)))
+        if max_seconds is not None and seconds > max_seconds:
+            failures.append('%s takes %.2f s to import (budget %.2f s)' % (module, seconds, max_seconds))
+    return measured, failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that the command line and the GUI start without loading '
+                                                 'pynwb, h5py or the lab extension.')
+    parser.add_argument('--modules', nargs='+', default=ENTRY_MODULES, help='the modules checked')
+    parser.add_argument('--max-seconds', type=float, default=DEFAULT_MAX_SECONDS,
+                        help='import time allowed to each module (default: %(default)s); 0 to not check it')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS,
+                        help='imports of each module, the fastest is kept (default: %(default)s)')
+    parser.add_argument('--compare', action='store_true', help='also time the import of pynwb, for comparison')
+    args = parser.parse_args()
+
+    measured, failures = check_imports(args.modules, args.max_seconds or None, args.repeats)
+    for result in measured:
+        if result['seconds'] is None:
+            print('  %-36s  skipped, not importable here' % result['module'])
+        else:
+            print('  %-36s  %6.3f s%s' % (result['module'], result['seconds'],
+                                          '  loads ' + ', '.join(result['heavy']) if result['heavy'] else ''))
+    if args.compare and importable('pynwb'):
+        print('  %-36s  %6.3f s' % ('pynwb', import_time('pynwb', args.repeats)[0]))
+    if failures:
+        print('\n' + '!' * 79)
+        print('SLOW IMPORT, a change probably brought a heavy import back to module level:')
+        for failure in failures:
+            print('  ' + failure)
+        print('!' * 79)
+        sys.exit(1)
+    print('\nimports within budget')
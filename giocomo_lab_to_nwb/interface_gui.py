@@ -1,17 +1,20 @@
 from tkinter import *
 from tkinter import ttk
-from tkcalendar import Calendar, DateEntry
 from tkinter.simpledialog import askstring
 import datetime
 from tkinter.filedialog import askopenfilename
 import tkinter.messagebox
 import pytz
-import conversion
 import os.path
+import sys
+from giocomo_lab_to_nwb.preview import format_seconds
+from giocomo_lab_to_nwb.worker import ConversionQueue
 
 
 # setup Stanford timezone timezones
 timezone_cali = pytz.timezone('US/Pacific')
+# how often the conversions running in the background are checked on, in milliseconds
+POLL_MILLISECONDS = 200
 
 def center(win):
     """
@@ -31,8 +34,8 @@ class guiMain():
         self.master = master
         self.master.iconbitmap('giocomo_lab.ico')
         self.master.option_add("*font", "Helvetica 10")
-        self.master.minsize(width=575, height=700)
-        self.master.maxsize(width=575, height=700)
+        self.master.minsize(width=575, height=840)
+        self.master.maxsize(width=575, height=840)
         self.master.title("Giocomo Lab")
         self.master.resizable(1, 1)  # Don't allow resizing in the x or y direction
         self.master.configure(background="#d3d3d3")
@@ -53,6 +56,7 @@ class guiMain():
         self.menubar.add_cascade(label="Setup", menu=self.menuOpt2)
         self.menubar.add_cascade(label="Help", menu=self.menuOpt3)
         self.master.config(menu=self.menubar)
+        self.master.protocol("WM_DELETE_WINDOW", self.close_windows)
 
 
         #Create frames
@@ -74,6 +78,11 @@ class guiMain():
                               textvariable=StringVar(value=""))
         self.file_name.config(font='Helvetica 10 italic', state='disabled')
         self.file_name.grid(row=0, column=1, padx=(0, 0), pady=(20, 0), sticky="senw")
+        # size of the selected session and expected time and size of its conversion
+        self.file_preview = None
+        self.label_preview = Label(self.FrameLeft, text='', background="#d3d3d3", font='Helvetica 8',
+                                   wraplength=300, justify=LEFT)
+        self.label_preview.grid(row=1, column=1, padx=0, pady=(2, 0), sticky='nw')
 
         #Subject Information
         self.label_subject = Label(self.FrameLeft, text='Subject Information:     ', background="#d3d3d3")
@@ -255,6 +264,20 @@ class guiMain():
 
         self.run_button = Button(self.FrameLeft, text="RUN", command=self.button_run, background = "#d3d3d3")
         self.run_button.grid(row=20, column=1, padx=30, pady=(20,20), sticky='NESW')
+        self.cancel_button = Button(self.FrameLeft, text="Cancel", command=self.button_cancel, background="#d3d3d3",
+                                    state='disabled')
+        self.cancel_button.grid(row=20, column=0, padx=20, pady=(20, 20), sticky='NESW')
+
+        # Conversions run one after the other in a worker process, the form stays usable meanwhile
+        self.conversions = ConversionQueue()
+        self.progress_bar = ttk.Progressbar(self.FrameLeft, orient='horizontal', mode='determinate', maximum=1.0)
+        self.progress_bar.grid(row=21, column=0, columnspan=2, padx=20, pady=0, sticky='NESW')
+        self.label_status = Label(self.FrameLeft, text='No conversion running', background="#d3d3d3",
+                                  font='Helvetica 10 italic')
+        self.label_status.grid(row=22, column=0, columnspan=2, padx=20, pady=5, sticky='nsw')
+        self.list_sessions = Listbox(self.FrameLeft, height=4)
+        self.list_sessions.grid(row=23, column=0, columnspan=2, padx=20, pady=(0, 20), sticky='NESW')
+        self.master.after(POLL_MILLISECONDS, self.poll_conversions)
 
 
 
@@ -266,6 +289,8 @@ class guiMain():
         self.dob_date_picker.wm_title("Select Date")
         mindate = datetime.date(year=2015, month=1, day=1)
         maxdate = today + datetime.timedelta(days=1)
+        # tkcalendar loads babel, slow to import: only when a date is picked
+        from tkcalendar import Calendar
         self.cal_dob = Calendar(self.dob_date_picker, font="Arial 14", selectmode='day', locale='en_US',
         mindate=mindate, maxdate=maxdate, background='darkblue', foreground='white', borderwidth=2,
         cursor="hand1", year=2019, month=2, day=5)
@@ -291,6 +316,7 @@ class guiMain():
         self.session_date_picker.wm_title("Select Date and Time")
         mindate = datetime.date(year=2000, month=1, day=1)
         maxdate = today + datetime.timedelta(days=1)
+        from tkcalendar import Calendar
         self.cal_session = Calendar(self.session_date_picker, font="Arial 14", selectmode='day', locale='en_US',
                                     mindate=mindate, maxdate=maxdate, background='darkblue', foreground='white',
                                     borderwidth=2,
@@ -387,6 +413,19 @@ class guiMain():
         self.file_name.delete(0,END)
         self.file_name.config(font='Helvetica 10 italic', state='normal')
         self.file_name.insert(0,filename)
+        self.show_preview(filename)
+
+    # Read the header of the selected .mat file and show the size of the session and its expected conversion
+    def show_preview(self, filename):
+        # imported here: loads h5py, only needed once a file is selected
+        from giocomo_lab_to_nwb.preview import describe, preview_sessions
+
+        self.file_preview = None
+        if not filename:
+            self.label_preview.config(text='')
+            return
+        self.file_preview = preview_sessions([{'input_file': filename}])[0]
+        self.label_preview.config(text=describe(self.file_preview))
 
     #Prompt for a new species.  Add to OptionMenu and update file "species.txt"
     def button_add_species(self):
@@ -467,11 +506,54 @@ class guiMain():
 
         }
 
-        conversion.convert(**self.gio_dict)
-
-
+        # queued, converted in the background once the sessions queued before are done
+        session = self.conversions.add(dict(self.gio_dict))
+        if self.file_preview is not None and self.file_preview['input_file'] == self.gio_dict['input_file']:
+            session['expected_seconds'] = self.file_preview['seconds']
+        self.show_conversions()
+
+    # Cancel Button is selected: stop the running conversion, its partial .nwb file is deleted
+    def button_cancel(self):
+        self.conversions.cancel()
+        self.show_conversions()
+
+    # Check on the background conversions, then again in POLL_MILLISECONDS
+    def poll_conversions(self):
+        for session in self.conversions.poll():
+            if session['status'] == 'failed':
+                tkinter.messagebox.showerror('Conversion failed', '%s\n\n%s' % (
+                    session['experiment_info']['input_file'], session['error'].strip().splitlines()[-1]))
+        self.show_conversions()
+        self.master.after(POLL_MILLISECONDS, self.poll_conversions)
+
+    def show_conversions(self):
+        running = self.conversions.running
+        if running is None:
+            self.progress_bar['value'] = 0
+            self.label_status.config(text='No conversion running')
+            self.cancel_button.config(state='disabled')
+        else:
+            self.progress_bar['value'] = running['fraction']
+            self.label_status.config(text='Converting %s: %s' % (
+                os.path.basename(running['experiment_info']['input_file']), running['stage'] or 'starting'))
+            self.cancel_button.config(state='normal')
+        self.list_sessions.delete(0, END)
+        for session in self.conversions.sessions:
+            expected = ''
+            if session['status'] in ('queued', 'running') and session.get('expected_seconds') is not None:
+                expected = ' (about %s)' % format_seconds(session['expected_seconds'])
+            self.list_sessions.insert(END, '%s - %s%s' % (os.path.basename(session['experiment_info']['input_file']),
+                                                           session['status'], expected))
 
     def close_windows(self):
+        if self.conversions.busy():
+            if not tkinter.messagebox.askokcancel('Exit', 'Cancel the conversions and exit?'):
+                return
+            # wait for the running conversion to stop and delete its partial .nwb file
+            self.conversions.cancel_all()
+            while self.conversions.busy():
+                self.conversions.poll()
+                self.master.after(POLL_MILLISECONDS)
         self.master.destroy()
         sys.exit()
 
@@ -479,18 +561,20 @@ class guiMain():
 
 
 
-root = Tk()
-root.withdraw()
-w = 0
-h = 0
-x = 100
-y = 10
-root.geometry('%dx%d+%d+%d' % (w, h, x, y))
+# the conversions run in spawned worker processes, which import this module again
+if __name__ == '__main__':
+    root = Tk()
+    root.withdraw()
+    w = 0
+    h = 0
+    x = 100
+    y = 10
+    root.geometry('%dx%d+%d+%d' % (w, h, x, y))
 
-myGui = guiMain(root)
+    myGui = guiMain(root)
 
 
-center(root)
-root.mainloop()
+    center(root)
+    root.mainloop()
 
 
@@ -0,0 +1,109 @@
+# Chunking and compression of the large datasets of a converted session.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+
+# Each profile gives, for each kind of data, the HDF5 chunk size (in values, rounded to whole rows
+# of the first axis) and the filters. Only filters every HDF5 reader has (gzip, shuffle) are used,
+# so that the files stay readable from MATLAB.
+#   default     contiguous and uncompressed, as NWBHDF5IO writes by default
+#   archive     smallest file: large chunks, gzip level 9 with shuffle
+#   fast-write  large chunks without filters: no compression cost, data can be streamed
+#   fast-read   small chunks with light compression: reading one unit, a time window of the
+#               position or of the raw data only decompresses a little
+IO_PROFILES = {
+    'default': {},
+    'archive': {
+        'spike_times': {'chunk_values': 2 ** 20, 'compression': 'gzip', 'compression_opts': 9, 'shuffle': True},
+        'waveforms': {'chunk_values': 2 ** 20, 'compression': 'gzip', 'compression_opts': 9, 'shuffle': True},
+        'position': {'chunk_values': 2 ** 20, 'compression': 'gzip', 'compression_opts': 9, 'shuffle': True},
+        'lick': {'chunk_values': 2 ** 16, 'compression': 'gzip', 'compression_opts': 9, 'shuffle': True},
+        'raw': {'chunk_values': 2 ** 23, 'compression': 'gzip', 'compression_opts': 9, 'shuffle': True},
+    },
+    'fast-write': {
+        'spike_times': {'chunk_values': 2 ** 20},
+        'waveforms': {'chunk_values': 2 ** 20},
+        'position': {'chunk_values': 2 ** 20},
+        'lick': {'chunk_values': 2 ** 16},
+        'raw': {'chunk_values': 2 ** 23},
+    },
+    'fast-read': {
+        'spike_times': {'chunk_values': 2 ** 14, 'compression': 'gzip', 'compression_opts': 1, 'shuffle': True},
+        'waveforms': {'chunk_values': 1, 'compression': 'gzip', 'compression_opts': 1, 'shuffle': True},
+        'position': {'chunk_values': 2 ** 14, 'compression': 'gzip', 'compression_opts': 1, 'shuffle': True},
+        'lick': {'chunk_values': 2 ** 14, 'compression': 'gzip', 'compression_opts': 1, 'shuffle': True},
+        'raw': {'chunk_values': 2 ** 20, 'compression': 'gzip', 'compression_opts': 1, 'shuffle': True},
+    },
+}
+DEFAULT_PROFILE = 'default'
+
+
+def io_settings(profile, kind, shape):
+    """
+    The H5DataIO arguments of `profile` for data of `kind` and `shape`.
+
+    Parameters
+    ----------
+    profile : str, dict or None
+        a name of IO_PROFILES, None for the default profile, or a profile of the same format,
+        e.g. chosen by tuner.tune
+    kind : str
+        'spike_times', 'waveforms', 'position', 'lick' or 'raw'
+    shape : tuple
+        shape of the data
+
+    Returns
+    -------
+    settings : dict
+        chunks, compression, compression_opts and shuffle. Empty for contiguous, unfiltered data.
+    """
+    if profile is None:
+        profile = DEFAULT_PROFILE
+    if not isinstance(profile, dict):
+        if profile not in IO_PROFILES:
+            raise ValueError('unknown I/O profile %r, choose one of %s' % (profile, ', '.join(sorted(IO_PROFILES))))
+        profile = IO_PROFILES[profile]
+    settings = dict(profile.get(kind, {}))
+    if not settings:
+        return settings
+    shape = tuple(int(n) for n in shape)
+    if 0 in shape:
+        # HDF5 cannot chunk an empty dataset with a zero-size chunk, leave it contiguous
+        return {}
+    row_values = int(np.prod(shape[1:], dtype=np.int64))
+    rows = max(1, min(shape[0], settings.pop('chunk_values') // row_values))
+    # the last chunk is stored whole: spread the rows evenly over the chunks to keep it full
+    num_chunks = -(-shape[0] // rows)
+    rows = -(-shape[0] // num_chunks)
+    settings['chunks'] = (rows,) + shape[1:]
+    return settings
+
+
+def wrap(data, kind, profile, shape=None):
+    """
+    Wrap data in H5DataIO with the chunking and filters of `profile`.
+
+    Parameters
+    ----------
+    data : array-like
+        an array, list or AbstractDataChunkIterator (e.g. a streaming.ChunkIterator)
+    kind : str
+        see io_settings
+    profile : str, dict or None
+        see io_settings
+    shape : tuple, optional
+        shape of the data, by default taken from the data
+
+    Returns
+    -------
+    data : H5DataIO or the data itself, if the profile writes this kind of data contiguous (or data is None)
+    """
+    if data is None:
+        return None
+    if shape is None:
+        shape = data.shape if hasattr(data, 'shape') else np.shape(data)
+    settings = io_settings(profile, kind, shape)
+    if not settings:
+        return data
+    return H5DataIO(data, **settings)
@@ -0,0 +1,148 @@
+# Lazy access to the processed MATLAB data of a session.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import h5py
+import hdf5storage
+import numpy as np
+
+
+def open_matfile(input_file):
+    """
+    Open a processed .mat file for reading.
+
+    Parameters
+    ----------
+    input_file : str
+        path to the .mat file
+
+    Returns
+    -------
+    matfile : MatFile
+    """
+    return MatFile(input_file)
+
+
+class MatFile(object):
+    """
+    Read variables of a .mat file one at a time.
+
+    MATLAB v7.3 files are HDF5 files: they are opened with h5py and a variable is only
+    decoded when it is asked for, so fields of the 'sp' struct that are never written
+    are never read. Older files are not HDF5 and are loaded whole with hdf5storage.loadmat.
+
+    Variables are named by their path in the file, e.g. 'post' or 'sp/st' for the field
+    'st' of the struct 'sp'.
+    """
+
+    def __init__(self, input_file):
+        self.input_file = input_file
+        self.lazy = h5py.is_hdf5(input_file)
+        if self.lazy:
+            self._file = h5py.File(input_file, 'r')
+            self._contents = None
+        else:
+            self._file = None
+            self._contents = hdf5storage.loadmat(input_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __contains__(self, name):
+        if self.lazy:
+            return name in self._file
+        try:
+            self._loaded(name)
+        except (KeyError, ValueError, IndexError):
+            return False
+        return True
+
+    def dataset(self, name):
+        """The h5py.Dataset of a variable of a v7.3 file, in HDF5 (reversed MATLAB) axis order."""
+        if not self.lazy:
+            raise TypeError('%s is not a MATLAB v7.3 (HDF5) file' % self.input_file)
+        return self._file[name]
+
+    def source(self, name):
+        """
+        A variable that is only read when it is sliced, in MATLAB axis order (vectors are 1-D).
+
+        Pre-7.3 files are already loaded, so the array itself is returned.
+        """
+        if self.lazy:
+            return MatArray(self._file[name])
+        value = np.asarray(self._loaded(name))
+        if value.ndim == 2 and 1 in value.shape:
+            value = np.ravel(value)
+        return value
+
+    def array(self, name):
+        """A variable as an array in MATLAB axis order."""
+        if self.lazy:
+            # MATLAB writes column-major arrays, so HDF5 sees the axes in reverse order
+            return self._file[name][()].T
+        return np.asarray(self._loaded(name))
+
+    def vector(self, name):
+        """A variable flattened into a 1-D array."""
+        if self.lazy:
+            return np.ravel(self._file[name][()])
+        return np.ravel(self._loaded(name))
+
+    def scalar(self, name):
+        """The first element of a numeric or logical variable."""
+        return self.vector(name)[0].item()
+
+    def string(self, name):
+        """A char variable as a python string."""
+        if self.lazy:
+            # MATLAB chars are stored as uint16 character codes
+            return ''.join(chr(code) for code in self._file[name][()].T.ravel())
+        value = self._loaded(name)
+        if isinstance(value, np.ndarray):
+            value = np.ravel(value)[0]
+        return str(value)
+
+    def _loaded(self, name):
+        parts = name.split('/')
+        value = self._contents[parts[0]]
+        for field in parts[1:]:
+            # structs are loaded as 1x1 record arrays
+            value = np.ravel(value)[0][field]
+        if isinstance(value, np.ndarray) and value.dtype == object and value.size == 1:
+            value = np.ravel(value)[0]
+        return value
+
+
+class MatArray(object):
+    """
+    Read-on-slice view of a variable of a v7.3 file, in MATLAB axis order.
+
+    Row and column vectors are exposed as 1-D arrays. Slicing the first axis reads only the
+    requested rows from the HDF5 dataset.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        shape = dataset.shape[::-1]
+        self.is_vector = len(shape) == 2 and 1 in shape
+        self.shape = (int(np.prod(shape)),) if self.is_vector else shape
+        self.dtype = dataset.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if self.is_vector:
+            if self.dataset.shape[0] == 1:
+                return self.dataset[0, index]
+            return self.dataset[index, 0]
+        # the first MATLAB axis is the last HDF5 axis
+        return self.dataset[(Ellipsis, index)].T
@@ -0,0 +1,179 @@
+# Memory-budget check of convert() on synthetic sessions of growing size.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from giocomo_lab_to_nwb.defaults import DEFAULT_CHUNK_SIZE
+
+# sizes of the checked sessions, in spikes or in behavioral samples
+DEFAULT_SIZES = (10 ** 6, 4 * 10 ** 6, 16 * 10 ** 6)
+# bytes per element of one full copy of a per-spike or per-sample vector (float64)
+COPY_BYTES = 8
+# how many full copies the peak memory may grow by, per element added to the session.
+# The in-memory conversion holds about 7.8 copies per spike and 4.8 per behavioral sample,
+# the budget leaves less than one copy of margin. A streamed conversion holds several chunks of
+# every large array: below chunk_size elements these grow like full copies, so the streamed sessions
+# checked are at least chunk_size long.
+STREAMING_COPIES = 0.25
+IN_MEMORY_COPIES = {'spikes': 8.5, 'samples': 5.5}
+# growth allowed on top of the copies, for buffers that fill up with the first chunks. A streamed
+# conversion reaches its plateau (about 170 MB) near 4 * 10 ** 6 spikes or samples.
+SLACK_BYTES = 32 * 2 ** 20
+# the largest step must add at least this many slacks worth of full copies, otherwise the slack hides
+# a full copy brought back
+MIN_COPY_SLACKS = 2
+# length of the sessions of the samples check, in seconds
+SAMPLES_SESSION_DURATION = 3600.0
+
+
+def session_options(dimension, size):
+    """The arguments of synthetic.write_session for a session of `size` spikes or behavioral samples."""
+    if dimension == 'spikes':
+        return {'num_spikes': size, 'num_channels': 64}
+    return {'num_spikes': 10 ** 5, 'num_channels': 64, 'duration': SAMPLES_SESSION_DURATION,
+            'position_rate': size / SAMPLES_SESSION_DURATION}
+
+
+def measure(input_file, stream, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Convert a session in a fresh process and return its conversion report.
+
+    The peak RSS of a process never goes down, so every conversion needs a process of its own.
+    """
+    from giocomo_lab_to_nwb.benchmark import run_convert
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(run_convert, input_file, stream, {'chunk_size': chunk_size}).result()
+
+
+def check_memory(dimension='spikes', sizes=DEFAULT_SIZES, stream=True, copies=None, work_dir=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Check that the peak memory of convert() grows within budget with the size of the session.
+
+    Sessions of growing size are converted one after the other. Between two sizes, the peak RSS
+    may grow by `copies` full float64 copies of a vector of the added elements, plus SLACK_BYTES.
+    Streamed conversions get a fraction of a copy, i.e. their memory grows sub-linearly: a change
+    that loads or copies a whole per-spike or per-sample vector (such as dividing the whole
+    'posx' vector to get the physical position) breaks the budget of the largest step.
+
+    One full copy of the elements added by the largest step must weigh at least MIN_COPY_SLACKS
+    times SLACK_BYTES, so that the slack can't hide it. Streamed, the growth must also flatten:
+    between the two largest sizes the peak RSS may grow by `copies` per added element, without slack.
+
+    Parameters
+    ----------
+    dimension : str
+        'spikes' to grow the number of spikes, 'samples' to grow the number of behavioral samples
+    sizes : iterable of int
+        numbers of spikes or samples, in ascending order
+    stream : bool
+        check convert(stream=True), otherwise the in-memory conversion
+    copies : float, optional
+        the budget, in full copies per added element. Defaults to STREAMING_COPIES when streaming,
+        IN_MEMORY_COPIES otherwise.
+    work_dir : str, optional
+        directory of the synthetic sessions, by default a temporary directory
+    chunk_size : int
+        the chunk_size of the conversions. Streamed, every size must be at least chunk_size: the
+        chunks held in memory grow with sessions shorter than a chunk, as full copies would.
+
+    Returns
+    -------
+    measured : list of dict
+        size, peak_rss_bytes and the stage that raised the peak the most, for each size
+    failures : list of str
+        one message per step over budget
+    """
+    from giocomo_lab_to_nwb.synthetic import write_session
+
+    sizes = sorted(int(size) for size in sizes)
+    if stream and sizes and sizes[0] < chunk_size:
+        raise ValueError('the streamed sessions must have at least chunk_size (%d) %s, not %d: reduce chunk_size '
+                         'or check larger sessions' % (chunk_size, dimension, sizes[0]))
+    if len(sizes) > 1 and COPY_BYTES * (sizes[-1] - sizes[-2]) < MIN_COPY_SLACKS * SLACK_BYTES:
+        raise ValueError('the largest step adds %d %s, one full copy of them would hide in the slack of %.0f MB: '
+                         'check sessions of at least %d %s'
+                         % (sizes[-1] - sizes[-2], dimension, SLACK_BYTES / 2 ** 20,
+                            sizes[-2] + MIN_COPY_SLACKS * SLACK_BYTES // COPY_BYTES, dimension))
+    if copies is None:
+        copies = STREAMING_COPIES if stream else IN_MEMORY_COPIES[dimension]
+    temporary = None
+    if work_dir is None:
+        temporary = tempfile.TemporaryDirectory(prefix='giocomo_memory_check_')
+        work_dir = temporary.name
+    measured = []
+    for size in sizes:
+        input_file = os.path.join(work_dir, 'memory_check_%s_%d.mat' % (dimension, size))
+        write_session(input_file, **session_options(dimension, size))
+        report = measure(input_file, stream, chunk_size)
+        stage = max(report['stages'], key=lambda name: report['stages'][name]['rss_increase_bytes'] or 0)
+        measured.append({'size': size, 'peak_rss_bytes': report['total']['peak_rss_bytes'], 'stage': stage})
+        for name in os.listdir(work_dir):
+            if name.startswith('memory_check_%s_%d.' % (dimension, size)):
+                os.remove(os.path.join(work_dir, name))
+    if temporary is not None:
+        temporary.cleanup()
+
+    failures = []
+    for smaller, larger in zip(measured[:-1], measured[1:]):
+        if smaller['peak_rss_bytes'] is None or larger['peak_rss_bytes'] is None:
+            continue
+        growth = larger['peak_rss_bytes'] - smaller['peak_rss_bytes']
+        budget = copies * COPY_BYTES * (larger['size'] - smaller['size']) + SLACK_BYTES
+        if growth > budget:
+            failures.append('peak RSS grew by %.0f MB from %d to %d %s (%.1f full copies, budget %.1f + %.0f MB); '
+                            'the %r stage raised it the most'
+                            % (growth / 2 ** 20, smaller['size'], larger['size'], dimension,
+                               growth / (COPY_BYTES * (larger['size'] - smaller['size'])), copies,
+                               SLACK_BYTES / 2 ** 20, larger['stage']))
+    if stream and len(measured) > 2 and None not in (measured[-2]['peak_rss_bytes'], measured[-1]['peak_rss_bytes']):
+        smaller, larger = measured[-2:]
+        added = larger['size'] - smaller['size']
+        growth = larger['peak_rss_bytes'] - smaller['peak_rss_bytes']
+        if growth > copies * COPY_BYTES * added:
+            failures.append('peak RSS still grows by %.2f full copies per %s added from %d to %d, over the %.2f '
+                            'of a sub-linear growth; the %r stage raised it the most'
+                            % (growth / (COPY_BYTES * added), dimension[:-1], smaller['size'], larger['size'],
+                               copies, larger['stage']))
+    return measured, failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that the peak memory of convert() stays within budget '
+                                                 'on synthetic sessions of growing size.')
+    parser.add_argument('--dimension', choices=['spikes', 'samples', 'both'], default='both',
+                        help='grow the number of spikes, of behavioral samples, or check both')
+    parser.add_argument('--sizes', type=float, nargs='+', default=DEFAULT_SIZES,
+                        help='numbers of spikes or samples (default: 1e6 4e6 1.6e7)')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='check the in-memory conversion instead of convert(stream=True)')
+    parser.add_argument('--copies', type=float, default=None,
+                        help='budget, in full copies of a float64 vector per added element')
+    parser.add_argument('--work-dir', default=None, help='directory of the synthetic sessions (default: temporary)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='chunk_size of the conversions, at most the smallest size (default: %(default)s)')
+    args = parser.parse_args()
+
+    all_failures = []
+    for dimension in (['spikes', 'samples'] if args.dimension == 'both' else [args.dimension]):
+        measured, failures = check_memory(dimension, args.sizes, stream=not args.in_memory, copies=args.copies,
+                                          work_dir=args.work_dir, chunk_size=args.chunk_size)
+        print('%s%s' % (dimension, '' if args.in_memory else ' (streaming)'))
+        for result in measured:
+            rss = '-' if result['peak_rss_bytes'] is None else '%.0f MB' % (result['peak_rss_bytes'] / 2 ** 20)
+            print('  %12d  peak RSS %10s  (%s)' % (result['size'], rss, result['stage']))
+        all_failures.extend(failures)
+    if all_failures:
+        print('\n' + '!' * 79)
+        print('MEMORY BUDGET EXCEEDED, a change probably brought back a full copy of a large array:')
+        for failure in all_failures:
+            print('  ' + failure)
+        print('!' * 79)
+        sys.exit(1)
+    print('\npeak memory within budget')
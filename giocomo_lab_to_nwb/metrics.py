@@ -0,0 +1,137 @@
+# Quality metrics of the sorted units.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import numpy as np
+from giocomo_lab_to_nwb.defaults import DEFAULT_CHUNK_SIZE, ISI_THRESHOLD
+from giocomo_lab_to_nwb.streaming import read_rows
+
+
+def unit_blocks(spike_counts, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Split the units into runs of consecutive units of at most chunk_size spikes in all.
+
+    A unit of more than chunk_size spikes is a run of its own.
+
+    Returns
+    -------
+    blocks : list of (int, int)
+        the first and last (exclusive) unit of each run
+    """
+    stops = np.cumsum(spike_counts)
+    blocks = []
+    first = 0
+    while first < len(stops):
+        start = stops[first - 1] if first else 0
+        last = max(int(np.searchsorted(stops, start + chunk_size, side='right')), first + 1)
+        blocks.append((first, last))
+        first = last
+    return blocks
+
+
+def _quantiles(values, rows, num_rows, quantiles):
+    """The quantiles of the values of each row, as np.percentile, NaN for the rows without values."""
+    order = np.lexsort((values, rows))
+    values = values[order]
+    counts = np.bincount(rows, minlength=num_rows)
+    starts = np.cumsum(counts) - counts
+    results = []
+    for quantile in quantiles:
+        position = starts + quantile * np.maximum(counts - 1, 0)
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        value = np.full(num_rows, np.nan)
+        filled = counts > 0
+        value[filled] = (values[low[filled]] + (position[filled] - low[filled])
+                         * (values[high[filled]] - values[low[filled]]))
+        results.append(value)
+    return results
+
+
+def recording_duration(*times):
+    """
+    The time from the earliest to the latest of several sorted time vectors, in seconds.
+
+    Only the first and last element of each vector are read, so they may be MatArrays. Empty
+    vectors are left out, the duration is 0 if all of them are empty.
+
+    Parameters
+    ----------
+    times : array-like
+        sorted times, e.g. the behavioral samples ('post') and the spike times ('sp/st')
+    """
+    bounds = np.concatenate([np.ravel(values[0:1]) for values in times if len(values)]
+                            + [np.ravel(values[len(values) - 1:len(values)]) for values in times if len(values)]
+                            + [np.empty(0)])
+    return float(bounds.max() - bounds.min()) if len(bounds) else 0.0
+
+
+def quality_metrics(spike_times, amplitudes, spike_counts, trial_starts, trial_stops, duration,
+                    isi_threshold=ISI_THRESHOLD, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Quality metrics of all units, from their spikes grouped by unit, a block of units at a time.
+
+    Parameters
+    ----------
+    spike_times : array-like or ChunkIterator
+        spike times of all units, grouped by unit and sorted within each unit, see tables.group_columns
+    amplitudes : array-like or ChunkIterator
+        template scaling amplitude of each spike ('tempScalingAmps'), grouped like spike_times
+    spike_counts : np.ndarray
+        number of spikes of each unit
+    trial_starts : np.ndarray
+        start time of each trial
+    trial_stops : np.ndarray
+        stop time of each trial
+    duration : float
+        duration of the recording, in seconds, see recording_duration. The firing rates are NaN if it is 0.
+    isi_threshold : float
+        inter-spike intervals shorter than this, in seconds, are refractory period violations
+    chunk_size : int
+        number of spikes read at a time. The spikes of a unit with more spikes are read at once.
+
+    Returns
+    -------
+    metrics : list of (str, str, np.ndarray)
+        name, description and float32 value for each unit of every metric, as columns of make_units
+    """
+    num_units = len(spike_counts)
+    num_trials = len(trial_starts)
+    violations = np.zeros(num_units)
+    trials_present = np.zeros(num_units)
+    amplitude_quartiles = [np.full(num_units, np.nan) for _quantile in range(3)]
+    stops = np.cumsum(spike_counts)
+    for first, last in unit_blocks(spike_counts, chunk_size):
+        start = int(stops[first - 1]) if first else 0
+        stop = int(stops[last - 1])
+        times = np.ravel(read_rows(spike_times, start, stop))
+        # the unit of each spike, counted from the first unit of the block
+        rows = np.repeat(np.arange(last - first), spike_counts[first:last])
+
+        same_unit = rows[1:] == rows[:-1]
+        violated = same_unit & (np.diff(times) < isi_threshold)
+        violations[first:last] = np.bincount(rows[1:][violated], minlength=last - first)
+
+        if num_trials:
+            trial_rows = np.searchsorted(trial_starts, times, side='right') - 1
+            in_trial = (trial_rows >= 0) & (times <= trial_stops[np.maximum(trial_rows, 0)])
+            present = np.unique(rows[in_trial] * np.int64(num_trials) + trial_rows[in_trial])
+            trials_present[first:last] = np.bincount(present // num_trials, minlength=last - first)
+
+        block_quartiles = _quantiles(np.ravel(read_rows(amplitudes, start, stop)).astype(np.float64), rows,
+                                     last - first, (0.25, 0.5, 0.75))
+        for quartiles, block_values in zip(amplitude_quartiles, block_quartiles):
+            quartiles[first:last] = block_values
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        isi_violations = np.where(spike_counts > 1, violations / (spike_counts - 1), np.nan)
+        presence_ratio = trials_present / num_trials if num_trials else np.full(num_units, np.nan)
+    firing_rate = spike_counts / duration if duration > 0 else np.full(num_units, np.nan)
+    first_quartile, median, third_quartile = amplitude_quartiles
+    metrics = [('firing_rate', 'mean firing rate over the recording, in Hz', firing_rate),
+               ('isi_violations', 'fraction of the inter-spike intervals shorter than %g ms' % (isi_threshold * 1e3),
+                isi_violations),
+               ('amplitude_median', 'median of the template scaling amplitudes of the spikes', median),
+               ('amplitude_iqr', 'interquartile range of the template scaling amplitudes of the spikes',
+                third_quartile - first_quartile),
+               ('presence_ratio', 'fraction of the trials with at least one spike', presence_ratio)]
+    return [(name, description, np.asarray(values, dtype=np.float32)) for name, description, values in metrics]
@@ -0,0 +1,345 @@
+# Preview of a session from the header of its .mat file, with the expected cost of its conversion.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import argparse
+import json
+import os
+
+# environment variable naming a JSON file of stage costs (see calibrate) used instead of DEFAULT_COSTS
+COSTS_ENV = 'GIOCOMO_NWB_COSTS'
+# what the time of each stage grows with: 'spikes', 'samples' (behavioral samples, 'post') or None (fixed)
+STAGE_SCALES = {'mat load': 'spikes', 'metadata': None, 'io tuning': None, 'trials': 'samples',
+                'position': 'samples', 'licks': 'samples', 'stimulus': None, 'electrodes': None, 'raw': None,
+                'units': 'spikes', 'spike alignment': 'spikes', 'quality metrics': 'spikes',
+                'rate maps': 'spikes', 'spike counts': 'spikes', 'template units': 'spikes',
+                'hdf5 write': 'spikes', 'raw compression': None}
+# the optional stages, run when one of these arguments of convert() is set
+STAGE_OPTIONS = {'io tuning': ('io_goal',), 'raw': ('add_raw',), 'spike alignment': ('align_spikes', 'rate_maps'),
+                 'quality metrics': ('quality_metrics',), 'rate maps': ('rate_maps',),
+                 'spike counts': ('spike_count_matrix',)}
+# bytes per spike the optional columns add to the .nwb file: the int16 trial and float32 position of
+# each spike, and at most one uint32 bin and uint16 count per spike in the spike count matrix
+OPTION_BYTES_PER_SPIKE = {'align_spikes': 6, 'spike_count_matrix': 6}
+# seconds per byte of raw data written uncompressed, and compressed by one raw worker, and the fraction
+# of the raw data left after compression: measured on 390 MB of int16 noise (standard deviation 30)
+RAW_WRITE_SECONDS_PER_BYTE = 1.0 / (600 * 2 ** 20)
+RAW_COMPRESSION_SECONDS_PER_BYTE = 1.0 / (32 * 2 ** 20)
+RAW_COMPRESSION_RATIO = 0.52
+# fixed seconds and seconds per unit of its scale of each stage, and the size of the .nwb file per byte
+# of data in the .mat file, fitted with calibrate on benchmark.run_benchmark results of 1e5, 1e6 and
+# 4e6 spikes with every optional stage on (384 channels, one hour of behavior at 50 Hz)
+DEFAULT_COSTS = {
+    'in memory': {
+        'stages': {
+            'mat load': [0.00102, 1.13e-11], 'metadata': [0.0199, 0.0], 'trials': [0.0, 3.25e-08],
+            'position': [0.0, 4.99e-08], 'licks': [0.0, 8.32e-09], 'stimulus': [0.000716, 0.0],
+            'electrodes': [0.00392, 0.0], 'units': [0.282, 4.7e-08], 'spike alignment': [0.0, 1.26e-07],
+            'quality metrics': [0.0172, 3.97e-07], 'rate maps': [0.0292, 1.15e-07], 'spike counts': [0.0295, 1.2e-07],
+            'template units': [0.0066, 7.94e-08], 'hdf5 write': [0.468, 1.22e-07]
+        },
+        'output_ratio': 0.772,
+    },
+    'stream': {
+        'stages': {
+            'mat load': [0.00127, 8.23e-11], 'metadata': [0.0169, 0.0], 'trials': [0.0, 2.8e-08],
+            'position': [0.0, 1.47e-08], 'licks': [0.0, 7.67e-09], 'stimulus': [0.000803, 0.0],
+            'electrodes': [0.00285, 0.0], 'units': [0.0113, 5.2e-07], 'spike alignment': [7.11e-05, 0.0],
+            'quality metrics': [0.0152, 3.81e-07], 'rate maps': [0.0, 2.45e-07], 'spike counts': [0.0258, 2.46e-07],
+            'template units': [0.0, 4.99e-07], 'hdf5 write': [0.525, 1.31e-07]
+        },
+        'output_ratio': 0.772,
+    },
+}
+
+
+def _dataset_size(mat, name):
+    """The number of values of a dataset of the .mat file, None if it has none."""
+    return int(mat[name].size) if name in mat else None
+
+
+def _string(mat, name):
+    """A char variable of the .mat file, stored as uint16 character codes."""
+    return ''.join(chr(code) for code in mat[name][()].ravel())
+
+
+def preview_session(input_file, raw_path=None):
+    """
+    The size of a session, read from the shapes and types of the datasets of its .mat file.
+
+    Only the HDF5 metadata of a MATLAB v7.3 file is read, not its data, so that the preview of a
+    file of any size takes a fraction of a second. Older .mat files must be loaded whole to be read:
+    only their size on disk is reported.
+
+    Parameters
+    ----------
+    input_file : str
+        path to the .mat file
+    raw_path : str, optional
+        path to the raw .dat file, as the raw_path argument of conversion.convert. Defaults to the
+        'dat_path' of the session.
+
+    Returns
+    -------
+    preview : dict
+        input_file, input_bytes (the size of the .mat file), hdf5 (whether it is a v7.3 file), then None
+        for older files: the number of spikes, clusters, templates, channels, samples (behavioral samples),
+        trials and licks, data_bytes (the bytes of all the datasets) and raw_bytes (the size of the raw
+        recording, None if not found)
+    """
+    import h5py
+
+    preview = {'input_file': input_file, 'input_bytes': os.path.getsize(input_file), 'hdf5': h5py.is_hdf5(input_file),
+               'spikes': None, 'clusters': None, 'templates': None, 'channels': None, 'samples': None,
+               'trials': None, 'licks': None, 'data_bytes': None, 'raw_bytes': None}
+    if not preview['hdf5']:
+        return preview
+
+    with h5py.File(input_file, 'r') as mat:
+        preview.update(spikes=_dataset_size(mat, 'sp/st'), clusters=_dataset_size(mat, 'sp/cids'),
+                       channels=_dataset_size(mat, 'sp/xcoords'), samples=_dataset_size(mat, 'post'),
+                       trials=_dataset_size(mat, 'trial_contrast'), licks=_dataset_size(mat, 'lickt'))
+        if 'sp/temps' in mat:
+            # MATLAB's templates x samples x channels, in reverse order in HDF5
+            preview['templates'] = int(mat['sp/temps'].shape[-1])
+
+        sizes = []
+
+        def add_size(name, item):
+            # the references of cells and strings hold no data of their own
+            if isinstance(item, h5py.Dataset) and not name.startswith('#refs#'):
+                sizes.append(item.size * item.dtype.itemsize)
+
+        mat.visititems(add_size)
+        preview['data_bytes'] = int(sum(sizes))
+
+        if raw_path is None and 'sp/dat_path' in mat:
+            raw_path = _string(mat, 'sp/dat_path')
+        offset = int(mat['sp/offset'][()].ravel()[0]) if 'sp/offset' in mat else 0
+    if raw_path is not None:
+        raw_path = os.path.join(os.path.dirname(os.path.abspath(input_file)), raw_path)
+        if os.path.isfile(raw_path):
+            preview['raw_bytes'] = max(os.path.getsize(raw_path) - offset, 0)
+    return preview
+
+
+def load_costs(costs_file=None):
+    """The stage costs of a JSON file written by calibrate, by default COSTS_ENV's, else DEFAULT_COSTS."""
+    if costs_file is None:
+        costs_file = os.environ.get(COSTS_ENV)
+    if not costs_file:
+        return DEFAULT_COSTS
+    with open(costs_file) as f:
+        return json.load(f)
+
+
+def _enabled(stage, experiment_info):
+    if stage == 'raw compression':
+        return bool(experiment_info.get('add_raw')) and experiment_info.get('raw_workers') is not None
+    return stage not in STAGE_OPTIONS or any(experiment_info.get(option) for option in STAGE_OPTIONS[stage])
+
+
+def estimate_conversion(preview, experiment_info=None, costs=None):
+    """
+    The expected time and output size of the conversion of a previewed session.
+
+    The time of each stage the conversion runs is a fixed cost plus a cost per spike or per behavioral
+    sample (STAGE_SCALES), fitted on benchmarks of synthetic sessions. Writing and compressing the raw
+    data is timed by its size. The estimates are rough, they say which sessions take minutes and which
+    take hours: the costs depend on the disk and the machine, calibrate them on the one converting.
+
+    Parameters
+    ----------
+    preview : dict
+        the preview of the session, see preview_session
+    experiment_info : dict, optional
+        the keyword arguments of conversion.convert for the session, for its optional stages
+    costs : dict, optional
+        the costs of the stages, see calibrate. Defaults to load_costs().
+
+    Returns
+    -------
+    estimate : dict
+        seconds, output_bytes and the seconds of each stage ('stages'). None for the seconds and
+        output bytes of a session that could not be previewed (a .mat file older than v7.3).
+    """
+    experiment_info = experiment_info or {}
+    if costs is None:
+        costs = load_costs()
+    if preview['spikes'] is None:
+        return {'seconds': None, 'output_bytes': None, 'stages': {}}
+    mode = costs['stream' if experiment_info.get('stream') else 'in memory']
+    add_raw = bool(experiment_info.get('add_raw')) and preview['raw_bytes'] is not None
+    stages = {}
+    for stage, scale in STAGE_SCALES.items():
+        if not _enabled(stage, experiment_info) or stage not in mode['stages']:
+            continue
+        fixed, per_unit = mode['stages'][stage]
+        stages[stage] = fixed + (per_unit * (preview[scale] or 0) if scale else 0.0)
+    output_bytes = mode['output_ratio'] * preview['data_bytes']
+    output_bytes += preview['spikes'] * sum(bytes_per_spike for option, bytes_per_spike
+                                            in OPTION_BYTES_PER_SPIKE.items() if experiment_info.get(option))
+    if add_raw:
+        stages['hdf5 write'] = stages.get('hdf5 write', 0.0) + RAW_WRITE_SECONDS_PER_BYTE * preview['raw_bytes']
+        if experiment_info.get('raw_workers') is not None:
+            stages['raw compression'] = (RAW_COMPRESSION_SECONDS_PER_BYTE * preview['raw_bytes']
+                                         / max(experiment_info['raw_workers'], 1))
+            output_bytes += RAW_COMPRESSION_RATIO * preview['raw_bytes']
+        else:
+            output_bytes += preview['raw_bytes']
+    return {'seconds': sum(stages.values()), 'output_bytes': int(output_bytes), 'stages': stages}
+
+
+def preview_sessions(sessions, costs=None):
+    """
+    Preview several sessions and estimate their conversions, without raising.
+
+    Parameters
+    ----------
+    sessions : iterable of dict
+        the keyword arguments of conversion.convert for each session
+    costs : dict, optional
+        the costs of the stages, see calibrate
+
+    Returns
+    -------
+    previews : list of dict
+        the preview of each session updated with its estimate (seconds, output_bytes, stages), or
+        input_file and error if its file could not be read, in the order of `sessions`
+    """
+    if costs is None:
+        costs = load_costs()
+    previews = []
+    for experiment_info in sessions:
+        input_file = experiment_info.get('input_file')
+        try:
+            preview = preview_session(input_file, experiment_info.get('raw_path'))
+        except (OSError, TypeError, KeyError) as error:
+            previews.append({'input_file': input_file, 'error': str(error), 'seconds': None, 'output_bytes': None})
+            continue
+        preview.update(estimate_conversion(preview, experiment_info, costs))
+        preview['error'] = None
+        previews.append(preview)
+    return previews
+
+
+def _fit(quantities, seconds):
+    """The fixed cost and cost per unit of a stage, from its seconds at several quantities."""
+    import numpy as np
+
+    measured = [(quantity, second) for quantity, second in zip(quantities, seconds) if second is not None]
+    if not measured:
+        return None
+    quantity, second = np.array(measured, dtype=np.float64).T
+    if len(set(quantity)) < 2:
+        # a single size: all of the cost is per unit
+        return [0.0, float(np.mean(second / quantity))] if quantity[0] else [float(np.mean(second)), 0.0]
+    per_unit, fixed = np.polyfit(quantity, second, 1)
+    if fixed < 0:
+        # a stage cannot take negative time on small sessions, fit it through zero instead
+        return [0.0, float(np.dot(quantity, second) / np.dot(quantity, quantity))]
+    return [float(fixed), float(max(per_unit, 0.0))]
+
+
+def calibrate(results, costs=None):
+    """
+    Fit the costs of the stages on benchmark results.
+
+    Parameters
+    ----------
+    results : dict or list of dict
+        the results of benchmark.run_benchmark with converter 'convert', e.g. one with and one
+        without stream. The stages a benchmark did not run keep their costs.
+    costs : dict, optional
+        the costs updated, by default a copy of DEFAULT_COSTS
+
+    Returns
+    -------
+    costs : dict
+        for 'in memory' and 'stream' conversions, the fixed seconds and seconds per unit of each stage
+        ('stages') and the bytes of the .nwb file per byte of data of the .mat file ('output_ratio'),
+        to be saved as JSON for load_costs
+    """
+    if isinstance(results, dict):
+        results = [results]
+    costs = json.loads(json.dumps(DEFAULT_COSTS if costs is None else costs))
+    for result in results:
+        if result['converter'] != 'convert':
+            raise ValueError('only the benchmarks of convert can be calibrated on, not %s' % result['converter'])
+        mode = costs['stream' if result['stream'] else 'in memory']
+        sessions = result['sessions']
+        for stage, seconds in result['stages'].items():
+            if stage not in STAGE_SCALES:
+                continue
+            scale = STAGE_SCALES[stage]
+            quantities = [session[scale] if scale else 0 for session in sessions]
+            fitted = _fit(quantities, seconds)
+            if fitted is not None:
+                mode['stages'][stage] = fitted
+        ratios = []
+        for session, output_bytes in zip(sessions, result['output_bytes']):
+            option_bytes = session['spikes'] * sum(bytes_per_spike for option, bytes_per_spike
+                                                   in OPTION_BYTES_PER_SPIKE.items()
+                                                   if result['options'].get(option))
+            ratios.append((output_bytes - option_bytes) / float(session['data_bytes']))
+        if ratios:
+            mode['output_ratio'] = sorted(ratios)[len(ratios) // 2]
+    return costs
+
+
+def format_bytes(size):
+    """A size in bytes as a short human-readable string, e.g. '1.2 GB'."""
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if size < 1000:
+            return '%.3g %s' % (size, unit)
+        size /= 1000.0
+    return '%.3g TB' % size
+
+
+def format_seconds(seconds):
+    """A duration as a short human-readable string, e.g. '3 min'."""
+    if seconds < 60:
+        return '%.0f s' % seconds
+    if seconds < 3600:
+        return '%.0f min' % (seconds / 60)
+    return '%.1f h' % (seconds / 3600)
+
+
+def describe(preview):
+    """One line describing a preview with its estimate, for the GUI and the command line."""
+    if preview.get('error'):
+        return 'cannot be read: %s' % preview['error']
+    if preview['spikes'] is None:
+        return '%s, not a v7.3 file: no preview' % format_bytes(preview['input_bytes'])
+    line = '%d spikes, %d clusters, %d templates, %d channels, %d samples' % tuple(
+        preview[name] or 0 for name in ('spikes', 'clusters', 'templates', 'channels', 'samples'))
+    if preview.get('seconds') is not None:
+        line += '; about %s, %s' % (format_seconds(preview['seconds']), format_bytes(preview['output_bytes']))
+    return line
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preview .mat files and estimate the time and size of their '
+                                                 'conversion, or calibrate the estimates on benchmark results.')
+    parser.add_argument('input_files', nargs='*', help='.mat files to preview')
+    parser.add_argument('--stream', action='store_true', help='estimate convert(stream=True)')
+    parser.add_argument('--costs', default=None, help='JSON file of stage costs (default: $%s)' % COSTS_ENV)
+    parser.add_argument('--calibrate', nargs='+', default=None, metavar='RESULTS',
+                        help='JSON results of benchmark.py --save-baseline to fit the stage costs on')
+    parser.add_argument('--save-costs', default=None, help='write the calibrated stage costs to this JSON file')
+    args = parser.parse_args()
+
+    costs = load_costs(args.costs)
+    if args.calibrate:
+        benchmarks = []
+        for results_file in args.calibrate:
+            with open(results_file) as f:
+                benchmarks.append(json.load(f))
+        costs = calibrate(benchmarks, costs)
+        print(json.dumps(costs, indent=2))
+        if args.save_costs:
+            with open(args.save_costs, 'w') as f:
+                json.dump(costs, f, indent=2)
+    for input_file, preview in zip(args.input_files,
+                                   preview_sessions([{'input_file': input_file, 'stream': args.stream}
+                                                     for input_file in args.input_files], costs)):
+        print('%s: %s' % (input_file, describe(preview)))
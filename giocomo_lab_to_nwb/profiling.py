@@ -0,0 +1,169 @@
+# Per-stage timing and memory report of a conversion.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is then not reported
+    resource = None
+
+# environment variable switching the report on when convert() is not given `profile`:
+# '1' for time and peak RSS, 'memory' to also trace python allocations with tracemalloc
+PROFILE_ENV = 'GIOCOMO_NWB_PROFILE'
+
+
+def peak_rss():
+    """The peak resident set size of this process so far, in bytes, or None where unknown."""
+    # on Linux, getrusage keeps the peak of the parent process across fork and exec,
+    # the high water mark in /proc only covers this program
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def report_path(output_file):
+    """The path of the report of the conversion writing output_file: 'session.nwb' -> 'session.report.json'."""
+    return os.path.splitext(output_file)[0] + '.report.json'
+
+
+class ConversionProfile(object):
+    """
+    Record the wall time, CPU time and memory of the stages of a conversion.
+
+    Stages follow each other: `stage(name)` ends the running stage and starts the next,
+    `stop()` ends the last one. A stage entered more than once accumulates. When disabled,
+    nothing is measured and no report is written. `close()` ends the last stage and the tracing
+    of the memory: call it once the conversion is over, even if it failed.
+
+    For each stage the report gives wall_seconds, cpu_seconds, peak_rss_bytes (peak of the
+    process at the end of the stage) and rss_increase_bytes (how much the stage raised that
+    peak). With trace_memory, also traced_peak_bytes and traced_delta_bytes: the peak and net
+    change of the memory allocated by python and numpy during the stage. The peak needs
+    tracemalloc.reset_peak (python 3.9), it is None on older versions.
+
+    `progress`, if given, is called with the name of each stage as it starts, whether or not
+    the profile is enabled, e.g. to update a progress bar. An exception it raises stops the
+    conversion.
+    """
+
+    def __init__(self, enabled=True, trace_memory=False, progress=None):
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        self.progress = progress
+        self.stages = {}
+        self.info = {}
+        self._current = None
+        self._started_tracing = False
+
+    @classmethod
+    def from_setting(cls, profile=None, progress=None):
+        """
+        Create the profile selected by the `profile` argument of convert().
+
+        Parameters
+        ----------
+        profile : bool or str, optional
+            False for no report, True for time and peak RSS, 'memory' to also trace allocations.
+            None reads the PROFILE_ENV environment variable.
+        progress : callable, optional
+            called with the name of each stage as it starts
+        """
+        if profile is None:
+            profile = os.environ.get(PROFILE_ENV, '')
+            if profile.lower() in ('', '0', 'false', 'no'):
+                profile = False
+        return cls(enabled=bool(profile), trace_memory=profile == 'memory', progress=progress)
+
+    def stage(self, name):
+        """End the running stage and start the stage `name`."""
+        if self.progress is not None:
+            self.progress(name)
+        if not self.enabled:
+            return
+        self.stop()
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        self._current = (name, time.perf_counter(), time.process_time(), peak_rss(),
+                         tracemalloc.get_traced_memory()[0] if self.trace_memory else None)
+
+    def stop(self):
+        """End the running stage."""
+        if not self.enabled or self._current is None:
+            return
+        name, wall_start, cpu_start, rss_start, traced_start = self._current
+        self._current = None
+        rss = peak_rss()
+        measured = {'wall_seconds': time.perf_counter() - wall_start,
+                    'cpu_seconds': time.process_time() - cpu_start,
+                    'peak_rss_bytes': rss,
+                    'rss_increase_bytes': None if rss is None else rss - rss_start}
+        if self.trace_memory:
+            traced, traced_peak = tracemalloc.get_traced_memory()
+            if hasattr(tracemalloc, 'reset_peak'):
+                measured['traced_peak_bytes'] = traced_peak - traced_start
+            else:
+                measured['traced_peak_bytes'] = None
+            measured['traced_delta_bytes'] = traced - traced_start
+        if name in self.stages:
+            previous = self.stages[name]
+            for key in ('wall_seconds', 'cpu_seconds', 'rss_increase_bytes', 'traced_delta_bytes'):
+                if measured.get(key) is not None:
+                    measured[key] += previous[key]
+            if measured.get('traced_peak_bytes') is not None:
+                measured['traced_peak_bytes'] = max(measured['traced_peak_bytes'], previous['traced_peak_bytes'])
+        self.stages[name] = measured
+
+    def close(self):
+        """End the running stage, and stop tracemalloc if the profile started it."""
+        self.stop()
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def report(self):
+        """The stages measured so far and their totals, as a dict."""
+        self.stop()
+        total = {'wall_seconds': sum(stage['wall_seconds'] for stage in self.stages.values()),
+                 'cpu_seconds': sum(stage['cpu_seconds'] for stage in self.stages.values()),
+                 'peak_rss_bytes': peak_rss()}
+        report = dict(self.info)
+        report['stages'] = self.stages
+        report['total'] = total
+        return report
+
+    def write(self, output_file):
+        """
+        Write the report next to the .nwb file, see report_path.
+
+        Returns
+        -------
+        path : str or None
+            the path of the report, None if the profile is disabled
+        """
+        if not self.enabled:
+            return None
+        report = self.report()
+        self.close()
+        path = report_path(output_file)
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+        return path
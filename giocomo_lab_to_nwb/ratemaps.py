@@ -0,0 +1,148 @@
+# Occupancy-normalized firing rate of each unit along the virtual hallway.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import numpy as np
+from giocomo_lab_to_nwb.defaults import DEFAULT_BIN_SIZE, DEFAULT_CHUNK_SIZE
+
+# the rate maps cover the hallway, 0 to 400 cm. Beyond it the mouse briefly exited the maze.
+HALLWAY_LENGTH = 400.0
+# the smoothing kernel is cut off this many standard deviations from its center
+KERNEL_TRUNCATE = 4.0
+
+
+def bin_edges(bin_size=DEFAULT_BIN_SIZE, length=HALLWAY_LENGTH):
+    """The edges of the position bins, in cm: bin_size is rounded so that the bins tile the hallway."""
+    num_bins = max(1, int(round(length / float(bin_size))))
+    return np.linspace(0.0, length, num_bins + 1)
+
+
+def position_bins(position, edges):
+    """The bin of each position, -1 outside of the hallway or for NaN positions."""
+    position = np.asarray(position, dtype=np.float64)
+    # the end of the hallway belongs to the last bin
+    bins = np.minimum(np.searchsorted(edges, position, side='right') - 1, len(edges) - 2)
+    bins[~((position >= edges[0]) & (position <= edges[-1]))] = -1
+    return bins
+
+
+def smoothing_kernel(edges, smoothing):
+    """
+    The Gaussian smoothing of the bins as a matrix: smoothed = values @ kernel.
+
+    The kernel is not normalized. Counts and occupancy are smoothed alike before they are divided,
+    so that the bins near the ends of the hallway, which have fewer neighbours, are not biased.
+    """
+    centers = (edges[:-1] + edges[1:]) / 2
+    distance = (centers[:, np.newaxis] - centers[np.newaxis, :]) / smoothing
+    kernel = np.exp(-0.5 * distance ** 2)
+    kernel[np.abs(distance) > KERNEL_TRUNCATE] = 0
+    return kernel
+
+
+def rate_maps(spike_cluster, cluster_ids, spike_trial, spike_position, sample_times, position, trial, trial_nums,
+              bin_size=DEFAULT_BIN_SIZE, smoothing=None, by_trial=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    The firing rate of every unit in each position bin of the hallway, in one pass over the spikes.
+
+    The spikes of all units are counted by a single histogram over (unit, position bin), or over
+    (unit, trial, position bin) with by_trial, accumulated chunk by chunk. The occupancy of a bin is
+    the time spent in it: each behavioral sample lasts until the next one. Bins never visited have
+    a NaN rate.
+
+    Parameters
+    ----------
+    spike_cluster : array-like
+        the cluster of each spike ('sp/clu')
+    cluster_ids : np.ndarray
+        the clusters, in the order of the rows of the units table
+    spike_trial : array-like
+        the row of the trials table at each spike, see alignment.SpikeAlignment
+    spike_position : array-like
+        the hallway position at each spike, see alignment.SpikeAlignment
+    sample_times : array-like
+        the time of each behavioral sample ('post')
+    position : array-like
+        the hallway position at each sample ('posx')
+    trial : array-like
+        the trial number of each sample ('trial')
+    trial_nums : np.ndarray
+        the trial numbers, in the order of the rows of the trials table
+    bin_size : float
+        width of the position bins, in cm
+    smoothing : float, optional
+        standard deviation of the Gaussian smoothing of the counts and the occupancy along the
+        hallway, in cm. Not smoothed by default.
+    by_trial : bool
+        also compute the rate map of each unit in each trial
+    chunk_size : int
+        number of spikes and samples read at a time
+
+    Returns
+    -------
+    edges : np.ndarray (n_bins + 1,)
+        the bin edges, in cm
+    occupancy : np.ndarray (n_bins,)
+        the seconds spent in each bin
+    rates : np.ndarray (n_units, n_bins)
+        the firing rate of each unit in each bin, in Hz
+    trial_occupancy : np.ndarray (n_trials, n_bins)
+        with by_trial, the seconds spent in each bin in each trial, otherwise None
+    trial_rates : np.ndarray (n_units, n_trials, n_bins)
+        with by_trial, the firing rate of each unit in each bin in each trial, otherwise None
+    """
+    edges = bin_edges(bin_size)
+    num_bins = len(edges) - 1
+    num_trials = len(trial_nums) if by_trial else 1
+    trial_nums = np.asarray(trial_nums)
+
+    # time spent in each (trial, bin)
+    occupancy = np.zeros(num_trials * num_bins)
+    num_samples = len(sample_times)
+    for start in range(0, num_samples, chunk_size):
+        stop = min(start + chunk_size, num_samples)
+        times = np.ravel(sample_times[start:stop + 1])
+        durations = np.diff(times)
+        if stop == num_samples:
+            # the last sample lasts as long as the one before it
+            durations = np.append(durations, durations[-1] if len(durations) else 0.0)
+        bins = position_bins(np.ravel(position[start:stop]), edges)
+        if by_trial:
+            trial_rows = np.searchsorted(trial_nums, np.ravel(trial[start:stop]))
+            bins = np.where(bins >= 0, trial_rows * num_bins + bins, -1)
+        visited = bins >= 0
+        occupancy += np.bincount(bins[visited], weights=durations[visited], minlength=len(occupancy))
+
+    # spikes of each (unit, trial, bin)
+    cluster_ids = np.ravel(cluster_ids)
+    num_units = len(cluster_ids)
+    sorter = np.argsort(cluster_ids, kind='stable')
+    sorted_ids = cluster_ids[sorter]
+    counts = np.zeros(num_units * num_trials * num_bins, dtype=np.int64)
+    num_spikes = len(spike_cluster)
+    for start in range(0, num_spikes if num_units else 0, chunk_size):
+        labels = np.ravel(spike_cluster[start:start + chunk_size])
+        found = np.minimum(np.searchsorted(sorted_ids, labels), num_units - 1)
+        unit_rows = np.where(sorted_ids[found] == labels, sorter[found], -1)
+        bins = position_bins(spike_position[start:start + chunk_size], edges)
+        if by_trial:
+            bins = np.where(bins >= 0, np.asarray(spike_trial[start:start + chunk_size], dtype=np.int64) * num_bins
+                            + bins, -1)
+        counted = (unit_rows >= 0) & (bins >= 0)
+        counts += np.bincount(unit_rows[counted] * (num_trials * num_bins) + bins[counted], minlength=len(counts))
+
+    counts = counts.reshape(num_units, num_trials, num_bins).astype(np.float64)
+    occupancy = occupancy.reshape(num_trials, num_bins)
+    kernel = smoothing_kernel(edges, smoothing) if smoothing else None
+
+    def smooth(values):
+        return values if kernel is None else values @ kernel
+
+    def rates_of(unit_counts, seconds):
+        seconds = smooth(seconds)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(seconds > 0, smooth(unit_counts) / seconds, np.nan).astype(np.float32)
+
+    rates = rates_of(counts.sum(axis=1), occupancy.sum(axis=0))
+    if not by_trial:
+        return edges, occupancy[0], rates, None, None
+    return edges, occupancy.sum(axis=0), rates, occupancy, rates_of(counts, occupancy)
@@ -0,0 +1,161 @@
+# Ingestion of the raw Neuropixels .dat recording.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import itertools
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+from pynwb.ecephys import ElectricalSeries
+from giocomo_lab_to_nwb.io_profiles import io_settings
+from giocomo_lab_to_nwb.streaming import DEFAULT_CHUNK_SIZE, ChunkIterator
+
+# number of samples per HDF5 chunk of the raw data, each chunk holds all channels
+RAW_CHUNK_SAMPLES = 2 ** 14
+# gzip level of the compressed raw data
+RAW_COMPRESSION_LEVEL = 4
+
+
+def open_raw(dat_path, n_channels, dtype, offset=0):
+    """
+    Memory-map a flat binary recording, e.g. the .dat file given to kilosort.
+
+    Parameters
+    ----------
+    dat_path : str
+        path to the binary file
+    n_channels : int
+        number of interleaved channels in the file ('n_channels_dat')
+    dtype : str or np.dtype
+        data type of a sample ('dtype')
+    offset : int
+        number of header bytes to skip ('offset')
+
+    Returns
+    -------
+    raw : np.memmap (n_time, n_channels)
+    """
+    dtype = np.dtype(dtype)
+    n_samples = (os.path.getsize(dat_path) - offset) // (dtype.itemsize * n_channels)
+    return np.memmap(dat_path, dtype=dtype, mode='r', offset=offset, shape=(n_samples, n_channels))
+
+
+def raw_electrical_series(raw, electrodes, sample_rate, description, chunk_size=DEFAULT_CHUNK_SIZE, compress=False,
+                          io_profile=None):
+    """
+    Stream a memory-mapped recording into an ElectricalSeries without loading it.
+
+    The data are written in time-major chunks holding all channels of RAW_CHUNK_SAMPLES samples,
+    or of the size and with the filters of `io_profile`. Only the channels of the electrodes table
+    are kept, the remaining channels of the file (e.g. the sync channel) are dropped.
+
+    With `compress`, the series only allocates an empty compressed dataset, to be filled with
+    write_compressed once the file has been written. It has the filters of `io_profile`, or gzip
+    and shuffle if the profile does not compress the raw data.
+
+    Parameters
+    ----------
+    raw : np.memmap (n_time, n_channels)
+        the recording, as returned by open_raw
+    electrodes : DynamicTableRegion
+        the electrodes recorded, one per channel from the first channel on
+    sample_rate : float
+        sampling rate of the recording, in Hz
+    description : str
+        description of the ElectricalSeries
+    chunk_size : int
+        number of values held in memory at a time
+    compress : bool
+        allocate a compressed dataset instead of streaming the data
+    io_profile : str, optional
+        a name of io_profiles.IO_PROFILES
+
+    Returns
+    -------
+    electrical_series : ElectricalSeries
+    """
+    num_channels = len(electrodes.data)
+    if num_channels > raw.shape[1]:
+        raise ValueError('the raw data hold %d channels but %d electrodes were given' % (raw.shape[1], num_channels))
+    settings = io_settings(io_profile, 'raw', (raw.shape[0], num_channels))
+    chunk_shape = settings.pop('chunks', (min(RAW_CHUNK_SAMPLES, max(raw.shape[0], 1)), num_channels))
+    if compress:
+        if settings.get('compression') is None:
+            settings = {'compression': 'gzip', 'compression_opts': RAW_COMPRESSION_LEVEL, 'shuffle': True}
+        data = H5DataIO(shape=(raw.shape[0], num_channels),
+                        dtype=raw.dtype,
+                        chunks=chunk_shape,
+                        **settings)
+    else:
+        data = ChunkIterator(read=lambda start, stop: raw[start:stop, :num_channels],
+                             shape=(raw.shape[0], num_channels),
+                             dtype=raw.dtype,
+                             chunk_size=chunk_size,
+                             chunk_shape=chunk_shape)
+        if settings:
+            data = H5DataIO(data, **settings)
+    return ElectricalSeries(name='ElectricalSeries',
+                            data=data,
+                            electrodes=electrodes,
+                            starting_time=0.0,
+                            rate=float(sample_rate),
+                            description=description)
+
+
+def write_compressed(dataset, source, workers=1):
+    """
+    Fill a preallocated, chunked h5py dataset, compressing the chunks in parallel.
+
+    HDF5 compresses chunks one after the other in the writing thread. Here each chunk is read,
+    byte-shuffled and deflated by a pool of threads (zlib releases the GIL) and the compressed
+    chunks are stored in order with direct chunk writes, bypassing the HDF5 filter pipeline.
+    The stored chunks are exactly what the dataset's own gzip/shuffle filters would produce, so
+    any HDF5 reader decodes them. Datasets with other filters are written through h5py as usual.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+        the dataset to fill, open for writing
+    source : array-like
+        the data, of the same shape as the dataset, e.g. a np.memmap
+    workers : int
+        number of compression threads
+    """
+    chunk_shape = dataset.chunks
+    grid = [range(0, n, c) for n, c in zip(dataset.shape, chunk_shape)]
+    direct = (dataset.compression == 'gzip' and not dataset.fletcher32 and dataset.scaleoffset is None
+              and hasattr(dataset.id, 'write_direct_chunk'))
+    level = dataset.compression_opts
+    shuffle = dataset.shuffle
+
+    def selection(offset):
+        return tuple(slice(start, min(start + c, n)) for start, c, n in zip(offset, chunk_shape, dataset.shape))
+
+    def compress(offset):
+        data = np.asarray(source[selection(offset)], dtype=dataset.dtype)
+        # edge chunks are stored whole, padded with the fill value
+        chunk = np.zeros(chunk_shape, dtype=dataset.dtype)
+        chunk[tuple(slice(0, n) for n in data.shape)] = data
+        buffer = chunk.tobytes()
+        if shuffle:
+            buffer = np.frombuffer(buffer, dtype=np.uint8).reshape(-1, dataset.dtype.itemsize).T.tobytes()
+        return zlib.compress(buffer, level)
+
+    offsets = itertools.product(*grid)
+    if not direct:
+        for offset in offsets:
+            dataset[selection(offset)] = source[selection(offset)]
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # keep a bounded number of chunks in flight and store them in order
+        pending = []
+        for offset in offsets:
+            pending.append((offset, pool.submit(compress, offset)))
+            if len(pending) >= 2 * workers:
+                offset, future = pending.pop(0)
+                dataset.id.write_direct_chunk(offset, future.result())
+        for offset, future in pending:
+            dataset.id.write_direct_chunk(offset, future.result())
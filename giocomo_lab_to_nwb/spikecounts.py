@@ -0,0 +1,142 @@
+# Spike counts of every unit in time bins of the behavioral clock, as a sparse matrix.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import os
+import tempfile
+
+import numpy as np
+from giocomo_lab_to_nwb.streaming import DEFAULT_CHUNK_SIZE, ScratchArray, iterate, read_rows
+
+
+def time_bin_edges(sample_times, bin_width=None):
+    """
+    The edges of the time bins, aligned to the behavioral clock.
+
+    Parameters
+    ----------
+    sample_times : array-like
+        the time of each behavioral sample ('post')
+    bin_width : float, optional
+        width of the bins, in seconds, starting at the first sample. By default each behavioral
+        sample is a bin, from its time to the next sample.
+
+    Returns
+    -------
+    edges : np.ndarray (n_bins + 1,)
+    """
+    sample_times = np.ravel(np.asarray(sample_times, dtype=np.float64))
+    if len(sample_times) < 2:
+        raise ValueError('the time bins need at least two behavioral samples')
+    # the last sample lasts as long as the one before it
+    end = sample_times[-1] + (sample_times[-1] - sample_times[-2])
+    if bin_width is None:
+        return np.append(sample_times, end)
+    num_bins = int(np.ceil((end - sample_times[0]) / float(bin_width)))
+    return sample_times[0] + np.arange(num_bins + 1) * float(bin_width)
+
+
+def _count_runs(spike_times, spike_counts, edges, chunk_size):
+    """
+    Yield the nonzero counts of the (unit, time bin) matrix, in row-major order, chunk by chunk.
+
+    The spike times are grouped by unit and sorted within each unit, so the key unit * n_bins + bin
+    of the successive spikes never decreases: the nonzero entries are the runs of equal keys, and
+    need no sorting. A run cut by the end of a chunk is carried over to the next one.
+
+    Yields
+    ------
+    keys : np.ndarray
+        unit * n_bins + bin of each nonzero entry
+    counts : np.ndarray
+        the number of spikes of each entry
+    """
+    num_bins = len(edges) - 1
+    row_stops = np.cumsum(spike_counts)
+    total = int(row_stops[-1]) if len(row_stops) else 0
+    carried_key, carried_count = None, 0
+    for start in range(0, total, chunk_size):
+        times = np.ravel(read_rows(spike_times, start, start + chunk_size))
+        rows = np.searchsorted(row_stops, np.arange(start, start + len(times)), side='right')
+        bins = np.searchsorted(edges, times, side='right') - 1
+        inside = (bins >= 0) & (bins < num_bins)
+        keys = rows[inside] * np.int64(num_bins) + bins[inside]
+        if not len(keys):
+            continue
+        run_starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+        run_keys = keys[run_starts]
+        run_counts = np.diff(np.append(run_starts, len(keys)))
+        if carried_key is not None:
+            if run_keys[0] == carried_key:
+                run_counts[0] += carried_count
+            else:
+                yield np.array([carried_key]), np.array([carried_count])
+        carried_key, carried_count = run_keys[-1], run_counts[-1]
+        yield run_keys[:-1], run_counts[:-1]
+    if carried_key is not None:
+        yield np.array([carried_key]), np.array([carried_count])
+
+
+def binned_counts(spike_times, spike_counts, edges, scratch_dir=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    The spike count of each unit in each time bin, as a compressed sparse row (CSR) matrix.
+
+    Parameters
+    ----------
+    spike_times : array-like or ChunkIterator
+        spike times of all units, grouped by unit and sorted within each unit, e.g. the spike
+        times grouped by tables.group_columns
+    spike_counts : np.ndarray
+        number of spikes of each unit
+    edges : np.ndarray (n_bins + 1,)
+        the edges of the time bins, see time_bin_edges. Spikes outside of the bins are not counted.
+    scratch_dir : str, optional
+        if given, the matrix is computed in two passes over the spike times, counting then
+        writing the nonzero entries to scratch files in this directory, and returned as chunk
+        iterators, instead of being held in memory
+    chunk_size : int
+        number of spikes read at a time
+
+    Returns
+    -------
+    bins : array-like
+        the time bin of each nonzero entry, row by row (CSR indices)
+    counts : array-like
+        the number of spikes of each nonzero entry (CSR data)
+    row_counts : np.ndarray
+        the number of nonzero entries of each unit (the differences of the CSR indptr)
+    """
+    num_bins = len(edges) - 1
+    num_units = len(spike_counts)
+    bin_dtype = np.uint32 if num_bins < 2 ** 32 else np.uint64
+    row_counts = np.zeros(num_units, dtype=np.int64)
+    if scratch_dir is None:
+        runs = list(_count_runs(spike_times, spike_counts, edges, chunk_size))
+        keys = np.concatenate([np.empty(0, dtype=np.int64)] + [run_keys for run_keys, _counts in runs])
+        counts = np.concatenate([np.empty(0, dtype=np.int64)] + [run_counts for _keys, run_counts in runs])
+        row_counts += np.bincount(keys // num_bins, minlength=num_units)
+        count_dtype = np.uint16 if not len(counts) or counts.max() <= np.iinfo(np.uint16).max else np.uint32
+        return (keys % num_bins).astype(bin_dtype), counts.astype(count_dtype), row_counts
+
+    # first pass: the number of nonzero entries of each unit and the largest count
+    largest = 0
+    for run_keys, run_counts in _count_runs(spike_times, spike_counts, edges, chunk_size):
+        if len(run_keys):
+            row_counts += np.bincount(run_keys // num_bins, minlength=num_units)
+            largest = max(largest, int(run_counts.max()))
+    count_dtype = np.uint16 if largest <= np.iinfo(np.uint16).max else np.uint32
+    if not row_counts.sum():
+        return np.empty(0, dtype=bin_dtype), np.empty(0, dtype=count_dtype), row_counts
+
+    # second pass: write the entries
+    outputs = []
+    for dtype in (bin_dtype, count_dtype):
+        handle, path = tempfile.mkstemp(suffix='.dat', dir=scratch_dir)
+        os.close(handle)
+        outputs.append(ScratchArray(path, dtype, int(row_counts.sum())))
+    bins, counts = outputs
+    written = 0
+    for run_keys, run_counts in _count_runs(spike_times, spike_counts, edges, chunk_size):
+        bins.write_runs([written], [run_keys % num_bins])
+        counts.write_runs([written], [run_counts])
+        written += len(run_keys)
+    return iterate(bins, chunk_size), iterate(counts, chunk_size), row_counts
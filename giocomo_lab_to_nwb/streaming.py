@@ -0,0 +1,289 @@
+# Bounded-memory streaming of large arrays into the NWB file.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import os
+import tempfile
+
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+from giocomo_lab_to_nwb.defaults import DEFAULT_CHUNK_SIZE
+
+
+class ChunkIterator(AbstractDataChunkIterator):
+    """
+    Hand an array to NWBHDF5IO one chunk of rows at a time.
+
+    Rows are only read (and transformed) when the writer asks for them, so at most
+    about `chunk_size` values of the array are held in memory.
+    """
+
+    def __init__(self, read, shape, dtype, chunk_size=DEFAULT_CHUNK_SIZE, chunk_shape=None):
+        """
+        Parameters
+        ----------
+        read : callable
+            read(start, stop) returns rows start to stop (exclusive) of the array
+        shape : tuple
+            shape of the whole array
+        dtype : np.dtype
+            data type of the array
+        chunk_size : int
+            number of values read at a time, rounded down to whole rows
+        chunk_shape : tuple, optional
+            HDF5 chunk shape of the written dataset. By default h5py picks one.
+        """
+        self.read = read
+        self.shape = tuple(int(n) for n in shape)
+        self._dtype = np.dtype(dtype)
+        self.chunk_size = max(1, int(chunk_size) // int(np.prod(self.shape[1:], dtype=np.int64)))
+        self.chunk_shape = chunk_shape
+        self._start = 0
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._start >= self.shape[0]:
+            raise StopIteration
+        start = self._start
+        stop = min(start + self.chunk_size, self.shape[0])
+        self._start = stop
+        data = np.asarray(self.read(start, stop), dtype=self._dtype)
+        selection = (slice(start, stop),) + tuple(slice(0, n) for n in self.shape[1:])
+        return DataChunk(data=data, selection=selection)
+
+    def recommended_chunk_shape(self):
+        return self.chunk_shape
+
+    def recommended_data_shape(self):
+        return self.shape
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def maxshape(self):
+        # HDF5 chunks can't be larger than a fixed-size dataset: an empty array is written extendable
+        return self.shape if self.shape[0] else (None,) + self.shape[1:]
+
+
+def iterate(source, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Stream a sliceable array (e.g. a MatArray or a np.memmap) chunk by chunk.
+
+    Parameters
+    ----------
+    source : array-like
+        any object with shape, dtype and slicing along the first axis
+    chunk_size : int
+        number of values read at a time
+
+    Returns
+    -------
+    iterator : ChunkIterator
+    """
+    return ChunkIterator(read=lambda start, stop: source[start:stop],
+                         shape=source.shape,
+                         dtype=source.dtype,
+                         chunk_size=chunk_size)
+
+
+def read_rows(source, start, stop):
+    """
+    Rows start to stop of an array, or of the array streamed by a ChunkIterator.
+
+    The rows of a ChunkIterator are read again, e.g. by a second pass over grouped columns,
+    without advancing it.
+    """
+    if isinstance(source, ChunkIterator):
+        return source.read(start, stop)
+    return source[start:stop]
+
+
+def unique_labels(labels, chunk_size=DEFAULT_CHUNK_SIZE):
+    """The sorted unique values of a 1-D array, read chunk by chunk."""
+    label_ids = np.array([], dtype=labels.dtype)
+    for start in range(0, len(labels), chunk_size):
+        label_ids = np.union1d(label_ids, labels[start:start + chunk_size])
+    return label_ids
+
+
+class ScratchArray(object):
+    """
+    A 1-D array kept in a scratch file, written and read one slice at a time with plain file I/O.
+
+    Unlike a np.memmap, the pages written or read do not stay mapped into the process, so the
+    resident memory of a conversion does not grow with the size of its scratch files.
+    """
+
+    def __init__(self, path, dtype, length):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.shape = (int(length),)
+        with open(path, 'wb') as scratch:
+            scratch.truncate(self.shape[0] * self.dtype.itemsize)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def write_runs(self, starts, runs):
+        """Write each array of `runs` at its start position."""
+        with open(self.path, 'r+b') as scratch:
+            for start, values in zip(starts, runs):
+                scratch.seek(int(start) * self.dtype.itemsize)
+                scratch.write(np.ascontiguousarray(values, dtype=self.dtype).tobytes())
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError('ScratchArray only supports slices')
+        start, stop, step = index.indices(self.shape[0])
+        if stop <= start:
+            return np.empty(0, dtype=self.dtype)
+        with open(self.path, 'rb') as scratch:
+            scratch.seek(start * self.dtype.itemsize)
+            values = np.frombuffer(scratch.read((stop - start) * self.dtype.itemsize), dtype=self.dtype)
+        return values[::step]
+
+
+def group_to_scratch(labels, label_ids, sources, scratch_dir, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Group the values of per-element arrays by label without loading them.
+
+    Streaming counterpart of tables.group_by_label: a stable counting sort. A first pass over
+    `labels` counts the elements of each id, a second pass scatters every chunk of each source
+    to its grouped position in a ScratchArray. Memory use is bounded by `chunk_size`
+    and the number of ids. Elements whose label is not in `label_ids` are dropped.
+
+    Parameters
+    ----------
+    labels : array-like
+        1-D label of each element, e.g. the cluster id ('clu') of every spike
+    label_ids : array-like
+        the ids, in the order the groups should be written
+    sources : list of array-like
+        1-D arrays aligned with labels, e.g. the spike times ('st')
+    scratch_dir : str
+        directory for the scratch files, which should be removed once the output is written
+    chunk_size : int
+        number of elements read at a time
+
+    Returns
+    -------
+    counts : np.ndarray
+        number of elements of each id
+    grouped : list of ScratchArray
+        the values of each source, grouped by id in the order of `label_ids`
+    """
+    rows, counts = _count_labels(labels, label_ids, chunk_size)
+    num_ids = len(counts)
+    total = int(counts.sum())
+
+    grouped = []
+    for source in sources:
+        if total == 0:
+            grouped.append(np.empty(0, dtype=source.dtype))
+            continue
+        handle, path = tempfile.mkstemp(suffix='.dat', dir=scratch_dir)
+        os.close(handle)
+        grouped.append(ScratchArray(path, source.dtype, total))
+    if total == 0:
+        return counts, grouped
+
+    next_free = np.cumsum(counts) - counts
+    for start in range(0, len(labels), chunk_size):
+        chunk_rows = rows(start)
+        keep = np.flatnonzero(chunk_rows >= 0)
+        order = np.argsort(chunk_rows[keep], kind='stable')
+        keep = keep[order]
+        chunk_rows = chunk_rows[keep]
+        chunk_counts = np.bincount(chunk_rows, minlength=num_ids)
+        # the elements of each id are a contiguous run of the sorted chunk, appended to the id's group
+        present = np.flatnonzero(chunk_counts)
+        run_stops = np.cumsum(chunk_counts)[present]
+        run_starts = run_stops - chunk_counts[present]
+        for source, output in zip(sources, grouped):
+            values = np.ravel(source[start:start + chunk_size])[keep]
+            output.write_runs(next_free[present], [values[run_start:run_stop]
+                                                   for run_start, run_stop in zip(run_starts, run_stops)])
+        next_free += chunk_counts
+    return counts, grouped
+
+
+def grouped_positions(labels, label_ids, scratch_dir, dtype=np.int64, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    The position of every element in the grouping of group_to_scratch, without loading the labels.
+
+    Parameters
+    ----------
+    labels : array-like
+        1-D label of each element
+    label_ids : array-like
+        the ids, in the order the groups are written
+    scratch_dir : str
+        directory for the scratch file
+    dtype : np.dtype
+        integer type of the positions
+    chunk_size : int
+        number of elements read at a time
+
+    Returns
+    -------
+    positions : ScratchArray
+        for each element, in the order of `labels`, its index in the grouped arrays. Elements whose
+        label is not in `label_ids` get the largest value of `dtype`.
+    """
+    rows, counts = _count_labels(labels, label_ids, chunk_size)
+    handle, path = tempfile.mkstemp(suffix='.dat', dir=scratch_dir)
+    os.close(handle)
+    positions = ScratchArray(path, dtype, len(labels))
+    next_free = np.cumsum(counts) - counts
+    for start in range(0, len(labels), chunk_size):
+        label_rows = rows(start)
+        keep = np.flatnonzero(label_rows >= 0)
+        keep = keep[np.argsort(label_rows[keep], kind='stable')]
+        chunk_rows = label_rows[keep]
+        chunk_counts = np.bincount(chunk_rows, minlength=len(counts))
+        # rank of every element inside the run of its id within this chunk
+        rank = np.arange(len(chunk_rows)) - (np.cumsum(chunk_counts) - chunk_counts)[chunk_rows]
+        chunk_positions = np.full(len(label_rows), np.iinfo(dtype).max, dtype=dtype)
+        chunk_positions[keep] = next_free[chunk_rows] + rank
+        positions.write_runs([start], [chunk_positions])
+        next_free += chunk_counts
+    return positions
+
+
+def _count_labels(labels, label_ids, chunk_size):
+    """
+    Count the elements of each id in a first pass over the labels.
+
+    Returns
+    -------
+    rows : callable
+        rows(start) gives, for the chunk of labels starting at `start`, the index in `label_ids`
+        of each label, -1 for labels that are not in `label_ids`
+    counts : np.ndarray
+        number of elements of each id
+    """
+    label_ids = np.ravel(label_ids)
+    sorter = np.argsort(label_ids, kind='stable')
+    sorted_ids = label_ids[sorter]
+    num_ids = len(label_ids)
+
+    def rows(start):
+        chunk = np.ravel(labels[start:start + chunk_size])
+        if num_ids == 0:
+            return np.full(len(chunk), -1)
+        position = np.minimum(np.searchsorted(sorted_ids, chunk), num_ids - 1)
+        found = sorted_ids[position] == chunk
+        return np.where(found, sorter[position], -1)
+
+    counts = np.zeros(num_ids, dtype=np.int64)
+    if num_ids:
+        for start in range(0, len(labels), chunk_size):
+            chunk_rows = rows(start)
+            counts += np.bincount(chunk_rows[chunk_rows >= 0], minlength=num_ids)
+    return rows, counts
@@ -0,0 +1,158 @@
+# Synthetic processed sessions, for benchmarking the converters without lab data.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import time
+
+import h5py
+import numpy as np
+from giocomo_lab_to_nwb.streaming import DEFAULT_CHUNK_SIZE
+
+# x positions of the four electrode columns of a neuropixels probe, in um
+NEUROPIXELS_X = np.array([43.0, 11.0, 59.0, 27.0])
+CONTRASTS = np.array([100.0, 50.0, 20.0, 10.0, 5.0, 2.0, 0.0])
+GAINS = np.array([1.0, 0.8, 0.7, 0.6, 0.5])
+
+
+def write_session(path,
+                  num_spikes=10 ** 6,
+                  num_clusters=300,
+                  num_templates=400,
+                  num_channels=384,
+                  duration=3600.0,
+                  num_trials=100,
+                  position_rate=50.0,
+                  num_licks=None,
+                  template_samples=82,
+                  seed=0,
+                  chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Write a synthetic MATLAB v7.3 session with the layout of the lab's processed .mat files.
+
+    The 'sp' struct holds the kilosort/phy output (st, clu, cids, cgs, temps, spikeTemplates,
+    tempScalingAmps, probe coordinates and recording constants); post, posx, trial,
+    trial_contrast, trial_gain, lickt and lickx hold the behavior. Spikes are written chunk by
+    chunk, so sessions larger than the memory can be generated.
+
+    Spikes are spread evenly over the session and drawn from random templates. The first
+    `num_clusters` templates are clusters of their own, the others are merged into random clusters,
+    as after manual sorting in phy. The mouse runs the 400cm hallway once per trial.
+
+    Parameters
+    ----------
+    path : str
+        the .mat file to write
+    num_spikes : int
+    num_clusters : int
+        number of clusters ('cids'), at most num_templates
+    num_templates : int
+    num_channels : int
+        number of channels of the probe, the raw recording has one more (the sync channel)
+    duration : float
+        length of the session, in seconds
+    num_trials : int
+    position_rate : float
+        sampling rate of the behavior, in Hz
+    num_licks : int
+        defaults to 10 licks per trial
+    template_samples : int
+        number of samples of each template
+    seed : int
+        seed of the random generator, the same arguments give the same file
+    chunk_size : int
+        number of spikes generated at a time
+
+    Returns
+    -------
+    path : str
+    """
+    if num_clusters > num_templates:
+        raise ValueError('num_clusters (%d) cannot exceed num_templates (%d)' % (num_clusters, num_templates))
+    rng = np.random.default_rng(seed)
+    if num_licks is None:
+        num_licks = 10 * num_trials
+
+    with h5py.File(path, 'w', userblock_size=512) as mat:
+        sp = mat.create_group('sp')
+        sp.attrs['MATLAB_class'] = np.bytes_('struct')
+
+        # spikes
+        template_cluster = np.concatenate((np.arange(num_clusters),
+                                           rng.integers(0, max(num_clusters, 1), num_templates - num_clusters)))
+        spacing = duration / max(num_spikes, 1)
+        st = _column(sp, 'st', num_spikes, np.float64)
+        clu = _column(sp, 'clu', num_spikes, np.float64)
+        spike_templates = _column(sp, 'spikeTemplates', num_spikes, np.float64)
+        amplitudes = _column(sp, 'tempScalingAmps', num_spikes, np.float64)
+        for start in range(0, num_spikes, chunk_size):
+            stop = min(start + chunk_size, num_spikes)
+            templates = rng.integers(0, num_templates, stop - start)
+            st[0, start:stop] = (np.arange(start, stop) + rng.random(stop - start)) * spacing
+            spike_templates[0, start:stop] = templates
+            clu[0, start:stop] = template_cluster[templates]
+            amplitudes[0, start:stop] = rng.uniform(5.0, 30.0, stop - start)
+
+        # clusters and templates
+        _write(sp, 'cids', np.arange(num_clusters, dtype=np.float64))
+        _write(sp, 'cgs', rng.integers(1, 4, num_clusters).astype(np.float64))
+        temps = sp.create_dataset('temps', shape=(num_channels, template_samples, num_templates), dtype=np.float32,
+                                  chunks=(num_channels, template_samples, 1))
+        temps.attrs['MATLAB_class'] = np.bytes_('single')
+        waveform = -np.exp(-0.5 * ((np.arange(template_samples) - template_samples / 3) / 3) ** 2)
+        for template in range(num_templates):
+            # a spike on a few neighbouring channels, decaying with distance
+            peak = rng.integers(0, num_channels)
+            decay = np.exp(-np.abs(np.arange(num_channels) - peak) / 4.0)
+            temps[:, :, template] = (decay[:, None] * waveform[None, :]).astype(np.float32)
+
+        # probe and recording constants
+        _write(sp, 'xcoords', NEUROPIXELS_X[np.arange(num_channels) % 4])
+        _write(sp, 'ycoords', 20.0 * (np.arange(num_channels) // 2))
+        _write(sp, 'sample_rate', np.array([30000.0]))
+        _write(sp, 'n_channels_dat', np.array([float(num_channels + 1)]))
+        _write(sp, 'dat_path', 'synthetic.dat')
+        _write(sp, 'offset', np.array([0.0]))
+        _write(sp, 'dtype', 'int16')
+        _write(sp, 'hp_filtered', np.array([1], dtype=np.uint8))
+        _write(sp, 'vr_session_offset', np.array([0.0]))
+
+        # behavior, the hallway is run once per trial
+        num_samples = int(duration * position_rate)
+        post = np.arange(num_samples) / position_rate
+        trial_position = np.arange(num_samples) * num_trials / num_samples
+        trial = np.floor(trial_position) + 1
+        posx = 400.0 * (trial_position - np.floor(trial_position))
+        _write(mat, 'post', post)
+        _write(mat, 'posx', posx)
+        _write(mat, 'trial', trial)
+        _write(mat, 'trial_contrast', rng.choice(CONTRASTS, num_trials))
+        _write(mat, 'trial_gain', rng.choice(GAINS, num_trials))
+        lickt = np.sort(rng.uniform(0, post[-1], num_licks))
+        _write(mat, 'lickt', lickt)
+        _write(mat, 'lickx', np.interp(lickt, post, posx))
+
+    # the 128 byte header MATLAB writes in the user block of a v7.3 file
+    header = b'MATLAB 7.3 MAT-file, Platform: GLNXA64, Created on: %s HDF5 schema 1.00 .' % (
+        time.strftime('%a %b %d %H:%M:%S %Y').encode())
+    with open(path, 'r+b') as mat_file:
+        mat_file.write(header.ljust(116) + b'\x00' * 8 + b'\x00\x02IM')
+    return path
+
+
+def _column(group, name, length, dtype):
+    """Create an empty MATLAB column vector (stored as 1 x length in HDF5), to be filled in chunks."""
+    # HDF5 can't chunk an empty dataset, an empty column is contiguous
+    dataset = group.create_dataset(name, shape=(1, length), dtype=dtype,
+                                   chunks=(1, min(length, 2 ** 16)) if length else None)
+    dataset.attrs['MATLAB_class'] = np.bytes_('double')
+    return dataset
+
+
+def _write(group, name, value):
+    """Write a MATLAB column vector, logical vector or char array."""
+    if isinstance(value, str):
+        dataset = group.create_dataset(name, data=np.array([[ord(char) for char in value]], dtype=np.uint16).T)
+        dataset.attrs['MATLAB_class'] = np.bytes_('char')
+        dataset.attrs['MATLAB_int_decode'] = np.int32(2)
+        return
+    dataset = group.create_dataset(name, data=value[None, :])
+    dataset.attrs['MATLAB_class'] = np.bytes_('logical' if value.dtype == np.uint8 else 'double')
@@ -0,0 +1,620 @@
+# Helpers for filling the NWB tables from the sorted spike data.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import numpy as np
+from hdmf.common import DynamicTable, DynamicTableRegion, VectorData, VectorIndex, ElementIdentifiers
+from pynwb import H5DataIO
+from pynwb.epoch import TimeIntervals
+from pynwb.file import ElectrodesTable
+from pynwb.misc import Units
+from giocomo_lab_to_nwb.streaming import (DEFAULT_CHUNK_SIZE, ChunkIterator, iterate, unique_labels, group_to_scratch,
+                                          grouped_positions)
+
+
+def group_by_label(labels, label_ids=None):
+    """
+    Sort labels once and locate the contiguous run of each label id.
+
+    Replaces one boolean scan of `labels` per id with a single stable argsort,
+    so that `values[order][starts[i]:stops[i]]` equals `values[labels == label_ids[i]]`
+    (same elements, same order).
+
+    Parameters
+    ----------
+    labels : array-like
+        the label of each element, e.g. the cluster id ('clu') of every spike
+    label_ids : array-like, optional
+        the ids to locate, in the order the rows should be written. Ids that never occur
+        get an empty run. Defaults to the unique labels, in ascending order.
+
+    Returns
+    -------
+    order : np.ndarray
+        indices that stably sort `labels`
+    label_ids : np.ndarray
+        the located ids
+    starts : np.ndarray
+        start of each id's run in the sorted order
+    stops : np.ndarray
+        end (exclusive) of each id's run in the sorted order
+    """
+    labels = np.ravel(labels)
+    order = stable_argsort(labels)
+    sorted_labels = labels[order]
+    if label_ids is None:
+        label_ids, counts = np.unique(sorted_labels, return_counts=True)
+        stops = np.cumsum(counts)
+        starts = stops - counts
+    else:
+        label_ids = np.ravel(label_ids)
+        starts = np.searchsorted(sorted_labels, label_ids, side='left')
+        stops = np.searchsorted(sorted_labels, label_ids, side='right')
+    return order, label_ids, starts, stops
+
+
+def stable_argsort(labels):
+    """
+    np.argsort(labels, kind='stable'), sped up for small integer labels.
+
+    Cluster and template ids are small integers, even when stored as doubles. Cast to int16,
+    numpy sorts them with a radix sort in linear time, and the order is the same.
+    """
+    if labels.size and labels.dtype.kind in 'fiu':
+        low, high = labels.min(), labels.max()
+        if np.iinfo(np.int16).min <= low and high <= np.iinfo(np.int16).max:
+            small = labels.astype(np.int16)
+            if labels.dtype.kind != 'f' or np.array_equal(small, labels):
+                return np.argsort(small, kind='stable')
+    return np.argsort(labels, kind='stable')
+
+
+def group_columns(labels, label_ids, sources, scratch_dir=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Group per-spike arrays by label, for the ragged columns of a Units table.
+
+    Parameters
+    ----------
+    labels : array-like
+        the label of each spike, e.g. 'clu' or 'spikeTemplates'
+    label_ids : array-like or None
+        the ids, in the order the rows should be written. None for the unique labels.
+    sources : list of array-like
+        per-spike arrays to group, e.g. the spike times
+    scratch_dir : str, optional
+        if given, the arrays are grouped with streaming.group_to_scratch in scratch files
+        in this directory and returned as chunk iterators, instead of being grouped in memory
+    chunk_size : int
+        number of values read at a time when streaming
+
+    Returns
+    -------
+    label_ids : np.ndarray
+    counts : np.ndarray
+        number of spikes of each id
+    columns : list
+        the grouped values of each source
+    """
+    if scratch_dir is None:
+        order, label_ids, counts = _grouped_order(labels, label_ids)
+        return label_ids, counts, [np.asarray(source)[order] for source in sources]
+    if label_ids is None:
+        label_ids = unique_labels(labels, chunk_size)
+    counts, grouped = group_to_scratch(labels, label_ids, sources, scratch_dir, chunk_size)
+    return np.ravel(label_ids), counts, [iterate(values, chunk_size) for values in grouped]
+
+
+def group_positions(labels, label_ids, scratch_dir=None, chunk_size=DEFAULT_CHUNK_SIZE, dtype=np.uint32):
+    """
+    The index of every element in the columns grouped by group_columns(labels, label_ids, ...).
+
+    Lets a second grouping of the same elements refer to the values grouped by the first one
+    instead of storing them again: group the positions like any other column.
+
+    Parameters
+    ----------
+    labels : array-like
+        the label of each spike
+    label_ids : array-like
+        the ids, in the order the rows are written
+    scratch_dir : str, optional
+        if given, the positions are computed chunk by chunk into a scratch file in this directory
+    chunk_size : int
+        number of values read at a time when streaming
+    dtype : np.dtype
+        unsigned integer type of the positions, see index_dtype
+
+    Returns
+    -------
+    positions : array-like
+        for each element, in the order of `labels`, its index in the grouped columns. Elements whose
+        label is not in `label_ids` get the largest value of `dtype`.
+    """
+    if scratch_dir is not None:
+        return grouped_positions(labels, label_ids, scratch_dir, dtype, chunk_size)
+    order, _label_ids, counts = _grouped_order(labels, label_ids)
+    positions = np.full(len(labels), np.iinfo(dtype).max, dtype=dtype)
+    positions[order] = np.arange(len(order))
+    return positions
+
+
+def index_dtype(length):
+    """The smallest unsigned integer type indexing an array of `length` elements."""
+    return np.uint32 if length < 2 ** 32 else np.uint64
+
+
+def _grouped_order(labels, label_ids):
+    """The indices taking the elements of the requested ids out of `labels`, grouped by id."""
+    order, label_ids, starts, stops = group_by_label(labels, label_ids)
+    counts = stops - starts
+    # keep only the runs of the requested ids, in their order
+    row_starts = np.cumsum(counts) - counts
+    order = order[np.arange(counts.sum()) + np.repeat(starts - row_starts, counts)]
+    return order, label_ids, counts
+
+
+def ragged_column(name, description, data, counts):
+    """
+    Build a ragged (indexed) column from concatenated row data.
+
+    Parameters
+    ----------
+    name : str
+        name of the column
+    description : str
+        description of the column
+    data : array-like
+        the values of all rows, concatenated in row order
+    counts : array-like
+        number of values in each row
+
+    Returns
+    -------
+    column : VectorData
+    index : VectorIndex
+        the cumulative row ends, as written by `add_unit` for the same rows
+    """
+    column = VectorData(name=name, description=description, data=data)
+    index = VectorIndex(name=name + '_index', data=np.cumsum(counts), target=column)
+    return column, index
+
+
+def make_units(name, description, ids, spike_times, spike_counts, electrode_group, columns=(), ragged_columns=(),
+               region_columns=()):
+    """
+    Create a Units table from whole columns instead of appending one unit at a time.
+
+    Parameters
+    ----------
+    name : str
+        name of the Units table
+    description : str
+        description of the Units table
+    ids : array-like
+        the id of each unit
+    spike_times : array-like or None
+        spike times of all units, grouped by unit in the order of `ids`. None for a table whose
+        spike times are stored in another table (see shared_spike_times).
+    spike_counts : array-like
+        number of spikes of each unit
+    electrode_group : ElectrodeGroup
+        the electrode group all units were recorded on
+    columns : iterable of (str, str, array-like)
+        name, description and per-unit values of extra columns
+    ragged_columns : iterable of (str, str, array-like)
+        name, description and per-spike values of extra columns, ordered like `spike_times`
+    region_columns : iterable of (str, str, array-like, DynamicTable)
+        name, description, per-unit row indices and table of extra columns referring to the rows
+        of another table, e.g. the template of each unit in the table of make_templates
+
+    Returns
+    -------
+    units : Units
+    """
+    # each index is listed before the column it indexes: hdmf drops chunk-iterator columns from its
+    # length check as it meets them, and would then no longer find the target of a later index
+    unit_columns = []
+    if spike_times is not None:
+        unit_columns.extend(reversed(ragged_column('spike_times', 'the spike times for each unit',
+                                                   spike_times, spike_counts)))
+    unit_columns.append(VectorData(name='electrode_group',
+                                   description='the electrode group that each spike unit came from',
+                                   data=[electrode_group] * len(ids)))
+    for column_name, column_description, column_data in columns:
+        unit_columns.append(VectorData(name=column_name, description=column_description, data=column_data))
+    for column_name, column_description, column_data in ragged_columns:
+        unit_columns.extend(reversed(ragged_column(column_name, column_description, column_data, spike_counts)))
+    for column_name, column_description, rows, table in region_columns:
+        unit_columns.append(DynamicTableRegion(name=column_name, description=column_description,
+                                               data=np.asarray(rows, dtype=np.int64), table=table))
+    return Units(name=name,
+                 description=description,
+                 id=ElementIdentifiers(name='id', data=[int(unit_id) for unit_id in ids]),
+                 columns=unit_columns)
+
+
+def shared_spike_times(table, row, units):
+    """
+    The spike times of a row of a table that refers to the spike times of `units`.
+
+    convert(share_spike_times=True) stores the spike times once, in the Units table. The
+    TemplateUnits table then has a 'spike_index' column, the index of each of its spikes in
+    units.spike_times, instead of a spike_times column.
+
+    Parameters
+    ----------
+    table : Units
+        e.g. the TemplateUnits table of the 'ecephys' processing module
+    row : int
+        the row of `table`
+    units : Units
+        the table storing the spike times, nwbfile.units
+
+    Returns
+    -------
+    spike_times : np.ndarray
+    """
+    index = np.asarray(table['spike_index'][row], dtype=np.int64)
+    if len(index) == 0:
+        return np.empty(0)
+    # h5py reads a selection of elements in increasing order only
+    order = np.argsort(index, kind='stable')
+    spike_times = np.empty(len(index))
+    spike_times[order] = units.spike_times.data[index[order]]
+    return spike_times
+
+
+def largest_channels(templates, num_channels, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    The channels of largest peak-to-peak amplitude of each template.
+
+    Parameters
+    ----------
+    templates : array-like (n_templates, n_samples, n_channels)
+        e.g. 'sp/temps', read `chunk_size` values at a time
+    num_channels : int
+        number of channels kept per template
+    chunk_size : int
+        number of values read at a time
+
+    Returns
+    -------
+    channels : np.ndarray (n_templates, num_channels)
+        for each template, its `num_channels` largest channels in ascending order
+    """
+    num_templates, num_samples, all_channels = templates.shape
+    num_channels = min(num_channels, all_channels)
+    rows = max(1, chunk_size // (num_samples * all_channels))
+    channels = np.empty((num_templates, num_channels), dtype=np.uint16 if all_channels < 2 ** 16 else np.uint32)
+    for start in range(0, num_templates, rows):
+        chunk = np.asarray(templates[start:start + rows])
+        amplitude = chunk.max(axis=1) - chunk.min(axis=1)
+        largest = np.argpartition(-amplitude, num_channels - 1, axis=1)[:, :num_channels]
+        channels[start:start + len(chunk)] = np.sort(largest, axis=1)
+    return channels
+
+
+def sparse_templates(templates, channels, chunk_size=None):
+    """
+    The templates restricted to the channels of largest_channels.
+
+    Parameters
+    ----------
+    templates : array-like (n_templates, n_samples, n_channels)
+    channels : np.ndarray (n_templates, num_channels)
+    chunk_size : int, optional
+        if given, the templates are read and restricted chunk by chunk while the file is written
+
+    Returns
+    -------
+    waveforms : np.ndarray or ChunkIterator (n_templates, n_samples, num_channels)
+    """
+    def read(start, stop):
+        return np.take_along_axis(np.asarray(templates[start:stop]), channels[start:stop, None, :].astype(np.intp),
+                                  axis=2)
+
+    if chunk_size is None:
+        return read(0, len(channels))
+    return ChunkIterator(read=read,
+                         shape=(len(channels), templates.shape[1], channels.shape[1]),
+                         dtype=templates.dtype,
+                         chunk_size=chunk_size)
+
+
+def make_templates(ids, waveforms, channels=None):
+    """
+    Create the table holding each spike template once, for the units to refer to.
+
+    Parameters
+    ----------
+    ids : array-like
+        the id of each template, its index in 'sp/temps'
+    waveforms : array-like (n_templates, n_samples, n_channels)
+        the templates, or with `channels` their values on these channels only (see sparse_templates)
+    channels : np.ndarray (n_templates, num_channels), optional
+        the index in the electrodes table of the channels of each sparse template
+
+    Returns
+    -------
+    templates : DynamicTable
+    """
+    if channels is None:
+        description = 'the template, samples x channels'
+    else:
+        description = ('the template on its channels of largest amplitude, samples x channels of the channels '
+                       'column; zero on the other channels')
+    columns = [VectorData(name='waveform', description=description, data=waveforms)]
+    if channels is not None:
+        columns.append(VectorData(name='channels', description='index in the electrodes table of the channels of '
+                                                               'the waveform column, in ascending order',
+                                  data=channels))
+    return DynamicTable(name='templates',
+                        description='spike templates of the automatic spike sorting, referred to by the template '
+                                    'column of the units tables',
+                        id=ElementIdentifiers(name='id', data=[int(template_id) for template_id in ids]),
+                        columns=columns)
+
+
+def template_waveform(table, row, num_channels=None):
+    """
+    The waveform of a template stored by convert(store_templates=True), on all channels.
+
+    Parameters
+    ----------
+    table : DynamicTable
+        the 'templates' table of the 'ecephys' processing module
+    row : int
+        the row of the template, e.g. units['template'].data[i] for unit i
+    num_channels : int, optional
+        number of channels of the probe, len(nwbfile.electrodes). Needed for sparse templates.
+
+    Returns
+    -------
+    waveform : np.ndarray (n_samples, n_channels)
+    """
+    waveform = np.asarray(table['waveform'].data[row])
+    if 'channels' not in table.colnames:
+        return waveform
+    if num_channels is None:
+        raise ValueError('the templates are stored on their largest channels only, give num_channels')
+    dense = np.zeros((waveform.shape[0], num_channels), dtype=waveform.dtype)
+    dense[:, np.asarray(table['channels'].data[row], dtype=np.intp)] = waveform
+    return dense
+
+
+def make_rate_maps(units, edges, occupancy, rates, trial_occupancy=None, trial_rates=None, smoothing=None):
+    """
+    Create the tables of the rate maps: one row per position bin and one row per unit.
+
+    Parameters
+    ----------
+    units : Units
+        the units table, whose rows the rate maps follow
+    edges : np.ndarray (n_bins + 1,)
+        the bin edges, in cm
+    occupancy : np.ndarray (n_bins,)
+        the seconds spent in each bin
+    rates : np.ndarray (n_units, n_bins)
+        the firing rate of each unit in each bin, in Hz
+    trial_occupancy : np.ndarray (n_trials, n_bins), optional
+        the seconds spent in each bin in each trial
+    trial_rates : np.ndarray (n_units, n_trials, n_bins), optional
+        the firing rate of each unit in each bin in each trial, in Hz
+    smoothing : float, optional
+        standard deviation of the Gaussian smoothing of the rate maps, in cm
+
+    Returns
+    -------
+    bins : DynamicTable
+        'rate_map_bins', the start, stop and occupancy of each position bin
+    rate_maps : DynamicTable
+        'rate_maps', the rate map of each unit
+    """
+    smoothed = ('smoothed by a Gaussian of standard deviation %g cm' % smoothing) if smoothing else 'not smoothed'
+    # the maps are small but mostly repetitive, NaN for the bins never visited
+    compressed = dict(compression='gzip', compression_opts=4, shuffle=True)
+    bin_columns = [VectorData(name='start', description='start of the bin in the virtual hallway, in cm',
+                              data=edges[:-1]),
+                   VectorData(name='stop', description='end of the bin in the virtual hallway, in cm',
+                              data=edges[1:]),
+                   VectorData(name='occupancy', description='seconds spent in the bin, not smoothed',
+                              data=np.asarray(occupancy, dtype=np.float32))]
+    if trial_occupancy is not None:
+        bin_columns.append(VectorData(name='trial_occupancy', description='seconds spent in the bin in each trial, '
+                                                                          'by row of the trials table',
+                                      data=np.ascontiguousarray(np.transpose(trial_occupancy), dtype=np.float32)))
+    bins = DynamicTable(name='rate_map_bins',
+                        description='the position bins of the rate maps',
+                        id=ElementIdentifiers(name='id', data=np.arange(len(edges) - 1)),
+                        columns=bin_columns)
+
+    map_columns = [DynamicTableRegion(name='unit', description='the row of the unit in the units table',
+                                      data=np.arange(len(rates)), table=units),
+                   VectorData(name='rate_map', description='firing rate in each bin of rate_map_bins, in Hz, %s; '
+                                                           'NaN in the bins never visited' % smoothed,
+                              data=H5DataIO(np.asarray(rates, dtype=np.float32), **compressed))]
+    if trial_rates is not None:
+        map_columns.append(VectorData(name='trial_rate_map',
+                                      description='firing rate in each bin of rate_map_bins in each trial, by row of '
+                                                  'the trials table, in Hz, %s; NaN in the bins not visited during '
+                                                  'the trial' % smoothed,
+                                      data=H5DataIO(np.asarray(trial_rates, dtype=np.float32), **compressed)))
+    rate_maps = DynamicTable(name='rate_maps',
+                             description='occupancy-normalized firing rate of each unit along the virtual hallway',
+                             id=ElementIdentifiers(name='id', data=np.asarray(units.id.data, dtype=np.int64)),
+                             columns=map_columns)
+    return bins, rate_maps
+
+
+def make_spike_counts(units, edges, bins, counts, row_counts):
+    """
+    Create the tables of the sparse spike count matrix: one row per time bin and one row per unit.
+
+    The ragged columns of the 'spike_counts' table are the matrix in compressed sparse row form:
+    'spike_count' holds the data, 'time_bin' the column indices and their common index
+    ('spike_count_index') the row pointers, without their leading 0.
+
+    Parameters
+    ----------
+    units : Units
+        the units table, whose rows the matrix follows
+    edges : np.ndarray (n_bins + 1,)
+        the edges of the time bins, in seconds
+    bins : array-like
+        the time bin of each nonzero entry, row by row, see spikecounts.binned_counts
+    counts : array-like
+        the number of spikes of each nonzero entry
+    row_counts : np.ndarray
+        the number of nonzero entries of each unit
+
+    Returns
+    -------
+    time_bins : DynamicTable
+        'spike_count_bins', the start and stop time of each bin
+    spike_counts : DynamicTable
+        'spike_counts', the nonzero spike counts of each unit
+    """
+    compressed = dict(compression='gzip', compression_opts=4, shuffle=True)
+    time_bins = DynamicTable(name='spike_count_bins',
+                             description='the time bins of the spike count matrix, on the behavioral clock',
+                             id=ElementIdentifiers(name='id', data=np.arange(len(edges) - 1)),
+                             columns=[VectorData(name='start_time', description='start of the bin, in seconds',
+                                                 data=H5DataIO(edges[:-1], **compressed)),
+                                      VectorData(name='stop_time', description='end of the bin, in seconds',
+                                                 data=H5DataIO(edges[1:], **compressed))])
+    columns = [DynamicTableRegion(name='unit', description='the row of the unit in the units table',
+                                  data=np.arange(len(row_counts)), table=units)]
+    columns.extend(reversed(ragged_column('time_bin', 'row of spike_count_bins of each nonzero count of the unit',
+                                          H5DataIO(bins, **compressed), row_counts)))
+    columns.extend(reversed(ragged_column('spike_count', 'number of spikes of the unit in each bin of time_bin',
+                                          H5DataIO(counts, **compressed), row_counts)))
+    spike_counts = DynamicTable(name='spike_counts',
+                                description='spike count of each unit in each time bin of spike_count_bins, as a '
+                                            'sparse matrix: only the nonzero counts are stored',
+                                id=ElementIdentifiers(name='id', data=np.asarray(units.id.data, dtype=np.int64)),
+                                columns=columns)
+    return time_bins, spike_counts
+
+
+def make_electrodes(electrode_group, location, filtering, probe_columns):
+    """
+    Create the electrodes table of one probe from whole columns.
+
+    The standard x, y, z and imp columns are reserved for brain atlas coordinates and are
+    filled with NaN. The location, filtering and group values are shared by every electrode
+    and are broadcast to all rows.
+
+    Parameters
+    ----------
+    electrode_group : ElectrodeGroup
+        the probe all electrodes belong to
+    location : str
+        brain region of the electrodes
+    filtering : str
+        description of the filtering applied to the recorded signals
+    probe_columns : iterable of (str, str, array-like)
+        name, description and per-electrode values of the columns describing the
+        electrodes on the probe, e.g. the x,y location on the neuropixel probe
+
+    Returns
+    -------
+    electrodes : ElectrodesTable
+    """
+    probe_columns = [(name, description, np.ravel(data).astype(float))
+                     for name, description, data in probe_columns]
+    num_electrodes = len(probe_columns[0][2])
+    missing = np.full(num_electrodes, np.nan)
+    columns = [VectorData(name='x', description='the x coordinate of the channel location', data=missing),
+               VectorData(name='y', description='the y coordinate of the channel location', data=missing),
+               VectorData(name='z', description='the z coordinate of the channel location', data=missing),
+               VectorData(name='imp', description='the impedance of the channel', data=missing),
+               VectorData(name='location', description='the location of channel within the subject e.g. brain region',
+                          data=[location] * num_electrodes),
+               VectorData(name='filtering', description='description of hardware filtering',
+                          data=[filtering] * num_electrodes),
+               VectorData(name='group', description='a reference to the ElectrodeGroup this electrode is a part of',
+                          data=[electrode_group] * num_electrodes),
+               VectorData(name='group_name', description='the name of the ElectrodeGroup this electrode is a part of',
+                          data=[electrode_group.name] * num_electrodes)]
+    columns.extend(VectorData(name=name, description=description, data=data)
+                   for name, description, data in probe_columns)
+    return ElectrodesTable(id=ElementIdentifiers(name='id', data=np.arange(num_electrodes)),
+                           columns=columns)
+
+
+def trial_boundaries(trial, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Locate the first and last sample of every trial in the per-sample trial vector.
+
+    The trial vector is sorted in a regular session, so a single pass looking for changes
+    of the trial number finds all boundaries. The pass reads `chunk_size` samples at a time,
+    so `trial` may be a MatArray that is never loaded whole. Otherwise the samples are grouped
+    by trial number, which gives the same result as masking the vector once per trial.
+    An empty trial vector has no trials, and all three arrays returned are empty.
+
+    Parameters
+    ----------
+    trial : array-like
+        the trial number of each behavioral sample
+    chunk_size : int
+        number of samples read at a time
+
+    Returns
+    -------
+    trial_nums : np.ndarray
+        the trial numbers, in ascending order
+    first : np.ndarray
+        index of the first sample of each trial
+    last : np.ndarray
+        index of the last sample of each trial
+    """
+    num_samples = len(trial)
+    if not num_samples:
+        # a session without behavioral samples has no trials
+        return np.ravel(trial[0:0]), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    changes = [np.array([0])]
+    trial_nums = []
+    previous = None
+    for start in range(0, num_samples, chunk_size):
+        chunk = np.ravel(trial[start:start + chunk_size])
+        if previous is not None:
+            chunk = np.concatenate(([previous], chunk))
+        if np.any(chunk[1:] < chunk[:-1]):
+            order, trial_nums, starts, stops = group_by_label(trial[:])
+            return trial_nums, order[starts], order[stops - 1]
+        chunk_changes = np.flatnonzero(chunk[1:] != chunk[:-1]) + 1
+        trial_nums.append(chunk[chunk_changes])
+        changes.append(chunk_changes + (start if previous is None else start - 1))
+        previous = chunk[-1]
+    first = np.concatenate(changes)
+    last = np.concatenate((first[1:], [num_samples])) - 1
+    trial_nums = np.concatenate([np.ravel(trial[0:1])] + trial_nums)
+    return trial_nums, first, last
+
+
+def make_trials(start_times, stop_times, trial_columns=()):
+    """
+    Create the trials table from whole columns.
+
+    Parameters
+    ----------
+    start_times : array-like
+        start time of each trial
+    stop_times : array-like
+        stop time of each trial
+    trial_columns : iterable of (str, str, array-like)
+        name, description and per-trial values of extra columns
+
+    Returns
+    -------
+    trials : TimeIntervals
+    """
+    columns = [VectorData(name='start_time', description='Start time of epoch, in seconds',
+                          data=np.asarray(start_times, dtype=float)),
+               VectorData(name='stop_time', description='Stop time of epoch, in seconds',
+                          data=np.asarray(stop_times, dtype=float))]
+    columns.extend(VectorData(name=name, description=description, data=data)
+                   for name, description, data in trial_columns)
+    return TimeIntervals(name='trials',
+                         description='experimental trials',
+                         id=ElementIdentifiers(name='id', data=np.arange(len(columns[0].data))),
+                         columns=columns)
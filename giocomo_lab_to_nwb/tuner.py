@@ -0,0 +1,237 @@
+# Choice of the chunking and compression of the large datasets, measured on samples of a session.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import argparse
+import time
+import uuid
+
+import h5py
+import numpy as np
+
+try:
+    import hdf5plugin
+except ImportError:
+    # Blosc is then not tried
+    hdf5plugin = None
+
+from giocomo_lab_to_nwb.io_profiles import io_settings
+
+# bytes of each sample, read from the middle of its array
+SAMPLE_BYTES = 2 ** 22
+GZIP_LEVELS = (1, 4, 6, 9)
+BLOSC_CODECS = (('zstd', 1), ('zstd', 5), ('lz4', 5))
+# chunk sizes tried with the best filter, in values
+CHUNK_VALUES = (2 ** 14, 2 ** 17, 2 ** 20)
+# chunk size the filters are compared at
+FILTER_CHUNK_VALUES = 2 ** 17
+GOALS = ('size', 'read', 'write')
+# small samples are written and read again until this many seconds passed, the fastest run counts
+MIN_TRIAL_SECONDS = 0.05
+MAX_REPEATS = 10
+# the variables sampled for each kind of data of io_profiles.IO_PROFILES
+SAMPLED_VARIABLES = {'spike_times': 'sp/st', 'waveforms': 'sp/temps', 'position': 'posx', 'lick': 'lickt'}
+
+
+def candidate_filters():
+    """
+    The filters tried on each sample, as (name, H5 settings, portable).
+
+    Portable filters (gzip, shuffle) are built into every HDF5 library, lzf only into h5py and
+    Blosc needs the hdf5plugin package, to write and to read.
+    """
+    filters = [('none', {}, True)]
+    for shuffle in (False, True):
+        suffix = '+shuffle' if shuffle else ''
+        for level in GZIP_LEVELS:
+            filters.append(('gzip-%d%s' % (level, suffix),
+                            {'compression': 'gzip', 'compression_opts': level, 'shuffle': shuffle}, True))
+        filters.append(('lzf' + suffix, {'compression': 'lzf', 'shuffle': shuffle}, False))
+        if hdf5plugin is not None:
+            for cname, level in BLOSC_CODECS:
+                blosc = hdf5plugin.Blosc(cname=cname, clevel=level,
+                                         shuffle=hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE)
+                filters.append(('blosc-%s-%d%s' % (cname, level, suffix), dict(blosc), False))
+    return filters
+
+
+def session_samples(matfile, raw=None, sample_bytes=SAMPLE_BYTES):
+    """
+    Read a representative slice of each large array of a session.
+
+    Parameters
+    ----------
+    matfile : matfile.MatFile
+        the processed session
+    raw : np.memmap (n_time, n_channels), optional
+        the raw recording, as returned by raw.open_raw
+    sample_bytes : int
+        size of each sample
+
+    Returns
+    -------
+    samples : dict
+        kind of data (see io_profiles.IO_PROFILES) -> np.ndarray, contiguous rows from the middle
+        of the array
+    """
+    sources = {kind: matfile.source(name) for kind, name in SAMPLED_VARIABLES.items() if name in matfile}
+    if raw is not None:
+        sources['raw'] = raw
+    samples = {}
+    for kind, source in sources.items():
+        row_bytes = int(np.prod(source.shape[1:], dtype=np.int64)) * np.dtype(source.dtype).itemsize
+        rows = int(min(len(source), max(1, sample_bytes // row_bytes)))
+        start = (len(source) - rows) // 2
+        samples[kind] = np.ascontiguousarray(source[start:start + rows])
+    return samples
+
+
+def measure(sample, settings, chunks):
+    """
+    Write a sample to an in-memory HDF5 file with the given filters and read it back.
+
+    The chunk cache is off, so that the read decompresses every chunk. Small samples are measured
+    again, see MIN_TRIAL_SECONDS.
+
+    Returns
+    -------
+    ratio : float
+        size of the sample over its stored size
+    write_speed : float
+        MB of the sample written per second
+    read_speed : float
+        MB of the sample read per second
+    """
+    megabytes = sample.nbytes / 1e6
+    write_seconds = []
+    read_seconds = []
+    while len(write_seconds) < MAX_REPEATS and sum(write_seconds + read_seconds) < MIN_TRIAL_SECONDS:
+        with h5py.File(uuid.uuid4().hex, 'w', driver='core', backing_store=False, rdcc_nbytes=0) as h5:
+            start = time.perf_counter()
+            dataset = h5.create_dataset('sample', data=sample, chunks=chunks, **settings)
+            h5.flush()
+            write_seconds.append(time.perf_counter() - start)
+            stored = dataset.id.get_storage_size()
+            start = time.perf_counter()
+            dataset[()]
+            read_seconds.append(time.perf_counter() - start)
+    return (sample.nbytes / max(stored, 1), megabytes / max(min(write_seconds), 1e-9),
+            megabytes / max(min(read_seconds), 1e-9))
+
+
+def tune(samples, goal='size', min_write_speed=None, portable=True):
+    """
+    Choose the filters and chunk size of each kind of data for a goal, from trials on samples.
+
+    Every filter of candidate_filters is tried on each sample at FILTER_CHUNK_VALUES, then the
+    chunk sizes of CHUNK_VALUES are tried with the chosen filter.
+
+    Parameters
+    ----------
+    samples : dict
+        kind of data -> sample, see session_samples
+    goal : str
+        'size' for the smallest data, 'read' for the fastest reads, 'write' for the fastest writes
+    min_write_speed : float, optional
+        only choose settings writing at least this many MB per second, e.g. 'size' with 200 gives
+        the smallest data written at 200 MB/s. Without any such settings, the fastest writing is chosen.
+    portable : bool
+        only choose filters every HDF5 reader has, so that MATLAB reads the file. lzf and Blosc
+        are still tried and reported.
+
+    Returns
+    -------
+    profile : dict
+        kind of data -> settings, in the format of io_profiles.IO_PROFILES
+    trials : dict
+        kind of data -> list of dict, the filter, chunk_values, ratio, write_speed and read_speed
+        (MB/s) of every trial, and whether it was chosen
+    """
+    if goal not in GOALS:
+        raise ValueError('unknown goal %r, choose one of %s' % (goal, ', '.join(GOALS)))
+    score = {'size': 'ratio', 'read': 'read_speed', 'write': 'write_speed'}[goal]
+
+    def best(candidates):
+        allowed = [trial for trial in candidates if trial['portable'] or not portable]
+        fast = [trial for trial in allowed if min_write_speed is None or trial['write_speed'] >= min_write_speed]
+        if not fast:
+            return max(allowed, key=lambda trial: trial['write_speed'])
+        return max(fast, key=lambda trial: trial[score])
+
+    profile = {}
+    trials = {}
+    for kind, sample in samples.items():
+        trials[kind] = []
+
+        def trial(name, settings, is_portable, chunk_values):
+            chunks = io_settings({kind: {'chunk_values': chunk_values}}, kind, sample.shape).get('chunks')
+            ratio, write_speed, read_speed = measure(sample, settings, chunks)
+            trials[kind].append({'filter': name, 'chunk_values': chunk_values, 'chunks': chunks, 'ratio': ratio,
+                                 'write_speed': write_speed, 'read_speed': read_speed, 'portable': is_portable,
+                                 'chosen': False, 'settings': settings})
+            return trials[kind][-1]
+
+        chosen = best([trial(name, settings, is_portable, FILTER_CHUNK_VALUES)
+                       for name, settings, is_portable in candidate_filters()])
+        sized = [chosen]
+        for chunk_values in CHUNK_VALUES:
+            chunks = io_settings({kind: {'chunk_values': chunk_values}}, kind, sample.shape).get('chunks')
+            if chunks not in [tried['chunks'] for tried in sized]:
+                sized.append(trial(chosen['filter'], chosen['settings'], chosen['portable'], chunk_values))
+        chosen = best(sized)
+        chosen['chosen'] = True
+        settings = dict(chosen['settings'], chunk_values=chosen['chunk_values'])
+        if isinstance(settings.get('compression'), int):
+            settings['allow_plugin_filters'] = True
+        profile[kind] = settings
+    return profile, trials
+
+
+def tune_session(matfile, goal='size', min_write_speed=None, raw=None, portable=True):
+    """
+    Choose the I/O profile of a session, see tune.
+
+    Returns
+    -------
+    profile : dict
+        to be given as io_profile to convert()
+    report : dict
+        the goal, the chosen filter and chunk size of each kind of data and every trial,
+        for the conversion report
+    """
+    profile, trials = tune(session_samples(matfile, raw), goal, min_write_speed, portable)
+    trials = {kind: [{key: value for key, value in trial.items() if key != 'settings'} for trial in kind_trials]
+              for kind, kind_trials in trials.items()}
+    chosen = {kind: {key: trial[key] for key in ('filter', 'chunk_values', 'ratio', 'write_speed', 'read_speed')}
+              for kind, kind_trials in trials.items() for trial in kind_trials if trial['chosen']}
+    report = {'goal': goal, 'min_write_speed': min_write_speed, 'portable': portable, 'chosen': chosen,
+              'trials': trials}
+    return profile, report
+
+
+def print_trials(report):
+    """Print the trials of each kind of data, the chosen settings marked with '*'."""
+    for kind, kind_trials in report['trials'].items():
+        print('%s (goal: %s)' % (kind, report['goal']))
+        print('  %-26s%10s%8s%14s%14s' % ('filter', 'chunk', 'ratio', 'write MB/s', 'read MB/s'))
+        for trial in kind_trials:
+            mark = '*' if trial['chosen'] else ' '
+            print('%s %-26s%10d%8.2f%14.0f%14.0f' % (mark, trial['filter'] + ('' if trial['portable'] else ' (!)'),
+                                                     trial['chunk_values'], trial['ratio'], trial['write_speed'],
+                                                     trial['read_speed']))
+    print('(!) not readable without h5py or hdf5plugin, not chosen unless --not-portable')
+
+
+if __name__ == '__main__':
+    from giocomo_lab_to_nwb.matfile import open_matfile
+
+    parser = argparse.ArgumentParser(description='Try the HDF5 filters and chunk sizes on samples of a session '
+                                                 'and choose the best for a goal.')
+    parser.add_argument('input_file', help='the processed .mat file')
+    parser.add_argument('--goal', choices=GOALS, default='size')
+    parser.add_argument('--min-write-speed', type=float, default=None, help='in MB/s')
+    parser.add_argument('--not-portable', action='store_true', help='also choose lzf and Blosc')
+    args = parser.parse_args()
+
+    with open_matfile(args.input_file) as session:
+        _profile, tuning = tune_session(session, args.goal, args.min_write_speed, portable=not args.not_portable)
+    print_trials(tuning)
@@ -0,0 +1,226 @@
+# Conversions run in a worker process, for the GUI to stay responsive.
+# written for Giocomo Lab
+# ------------------------------------------------------------------------------
+import multiprocessing
+import os
+import queue
+import signal
+import time
+import traceback
+
+# the stages of convert(), in the order it enters them, for the fraction of the conversion done
+CONVERSION_STAGES = ('mat load', 'metadata', 'io tuning', 'trials', 'position', 'licks', 'stimulus', 'electrodes',
+                     'raw', 'units', 'spike alignment', 'quality metrics', 'rate maps', 'spike counts',
+                     'template units', 'hdf5 write', 'raw compression')
+# the stages during which the .nwb file is written: a conversion stopped then leaves a partial file
+WRITE_STAGES = ('hdf5 write', 'raw compression')
+# seconds a cancelled conversion has to stop at its next stage before it is terminated
+CANCEL_GRACE_SECONDS = 2.0
+# seconds a terminated conversion has to clean up before it is killed
+KILL_GRACE_SECONDS = 10.0
+
+
+class ConversionCancelled(Exception):
+    """Raised in the worker process to stop a cancelled conversion."""
+
+
+def stage_fraction(stage):
+    """The fraction of a conversion done when `stage` starts, by the position of the stage in CONVERSION_STAGES."""
+    if stage not in CONVERSION_STAGES:
+        return None
+    return CONVERSION_STAGES.index(stage) / float(len(CONVERSION_STAGES))
+
+
+def _terminated(_signum, _frame):
+    raise ConversionCancelled()
+
+
+def convert_in_worker(experiment_info, messages, cancel):
+    """
+    Convert one session in a worker process, reporting to the parent on a queue.
+
+    The messages are (kind, value) pairs: ('stage', name) as each stage starts, then ('converted', None),
+    ('cancelled', None) or ('failed', traceback). A cancelled conversion stops at its next stage, or as soon
+    as the process is terminated: SIGTERM raises ConversionCancelled, so that the files being written are
+    closed and the scratch files deleted.
+
+    Parameters
+    ----------
+    experiment_info : dict
+        the keyword arguments of conversion.convert for the session
+    messages : multiprocessing.Queue
+        where the messages are put
+    cancel : multiprocessing.Event
+        set by the parent to cancel the conversion
+    """
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, _terminated)
+
+    def progress(stage):
+        if cancel.is_set():
+            raise ConversionCancelled()
+        messages.put(('stage', stage))
+
+    try:
+        # imported here so that the parent never loads the conversion
+        from giocomo_lab_to_nwb.conversion import convert
+
+        convert(progress=progress, **experiment_info)
+        messages.put(('converted', None))
+    except Exception:
+        # the writer may wrap a ConversionCancelled raised by SIGTERM in an exception of its own
+        if cancel.is_set():
+            messages.put(('cancelled', None))
+        else:
+            messages.put(('failed', traceback.format_exc()))
+
+
+def remove_partial_output(input_file):
+    """Delete the .nwb file of input_file, written in part by a stopped conversion. Returns its path, if deleted."""
+    from giocomo_lab_to_nwb.conversion import nwb_path
+
+    output_file = nwb_path(input_file)
+    if os.path.exists(output_file):
+        os.remove(output_file)
+        return output_file
+    return None
+
+
+class ConversionQueue(object):
+    """
+    Sessions converted one after the other, each in a worker process.
+
+    The owner, e.g. the Tk event loop with `after`, calls `poll()` regularly: it reads the messages of
+    the running conversion without blocking and starts the next session when the worker is done.
+    Each session is a dict with its 'experiment_info', 'status' ('queued', 'running', 'converted',
+    'cancelled' or 'failed'), the last 'stage' started, the 'fraction' of the conversion done and the
+    'error' traceback of a failed conversion.
+    """
+
+    def __init__(self):
+        # spawned, not forked, workers: the parent runs the Tk event loop, whose state must not be copied
+        self.context = multiprocessing.get_context('spawn')
+        self.sessions = []
+        self.running = None
+        self._process = None
+        self._messages = None
+        self._cancel = None
+        self._cancelled_at = None
+        self._terminated_at = None
+
+    def add(self, experiment_info):
+        """Queue a session, given by the keyword arguments of conversion.convert. Returns its entry."""
+        session = {'experiment_info': experiment_info, 'status': 'queued', 'stage': None, 'fraction': 0.0,
+                   'error': None}
+        self.sessions.append(session)
+        return session
+
+    def busy(self):
+        """Whether a session is being converted or waits to be."""
+        return self.running is not None or any(session['status'] == 'queued' for session in self.sessions)
+
+    def poll(self):
+        """
+        Read the messages of the running conversion and start the next session when it is done.
+
+        Returns
+        -------
+        finished : list of dict
+            the sessions that finished since the last poll
+        """
+        finished = []
+        if self.running is not None:
+            self._read_messages()
+            self._enforce_cancel()
+            if not self._process.is_alive():
+                self._process.join()
+                # the last messages may arrive after the process exited
+                self._read_messages()
+                session = self.running
+                if session['status'] == 'running' and self._cancelled_at is not None:
+                    # killed before it reported
+                    session['status'] = 'cancelled'
+                elif session['status'] == 'running':
+                    session['status'] = 'failed'
+                    session['error'] = 'the worker process stopped (exit code %s)' % self._process.exitcode
+                # the .nwb file of an earlier conversion is kept if the writing did not start
+                if session['status'] in ('cancelled', 'failed') and session['stage'] in WRITE_STAGES:
+                    remove_partial_output(session['experiment_info']['input_file'])
+                if session['status'] == 'converted':
+                    session['fraction'] = 1.0
+                self.running = None
+                self._process = None
+                finished.append(session)
+        if self.running is None:
+            self._start_next()
+        return finished
+
+    def cancel(self, session=None):
+        """
+        Cancel a session, by default the running one.
+
+        A queued session is only taken off the queue. The running conversion is asked to stop at its next
+        stage, and terminated if it is still running CANCEL_GRACE_SECONDS later; its partial .nwb file is
+        deleted once it stopped, if the writing had started.
+        """
+        if session is None:
+            session = self.running
+        if session is None:
+            return
+        if session is not self.running:
+            if session['status'] == 'queued':
+                session['status'] = 'cancelled'
+            return
+        if self._cancelled_at is None:
+            self._cancel.set()
+            self._cancelled_at = time.time()
+
+    def cancel_all(self):
+        """Cancel the running session and every queued one."""
+        for session in self.sessions:
+            if session is not self.running:
+                self.cancel(session)
+        self.cancel()
+
+    def _start_next(self):
+        queued = [session for session in self.sessions if session['status'] == 'queued']
+        if not queued:
+            return
+        session = queued[0]
+        self._messages = self.context.Queue()
+        self._cancel = self.context.Event()
+        self._cancelled_at = None
+        self._terminated_at = None
+        self._process = self.context.Process(target=convert_in_worker,
+                                             args=(session['experiment_info'], self._messages, self._cancel))
+        self._process.daemon = True
+        self._process.start()
+        session['status'] = 'running'
+        self.running = session
+
+    def _read_messages(self):
+        session = self.running
+        while True:
+            try:
+                kind, value = self._messages.get_nowait()
+            except queue.Empty:
+                return
+            if kind == 'stage':
+                session['stage'] = value
+                fraction = stage_fraction(value)
+                if fraction is not None:
+                    session['fraction'] = max(session['fraction'], fraction)
+            else:
+                session['status'] = kind
+                session['error'] = value
+
+    def _enforce_cancel(self):
+        if self._cancelled_at is None or not self._process.is_alive():
+            return
+        now = time.time()
+        if self._terminated_at is None and now - self._cancelled_at > CANCEL_GRACE_SECONDS:
+            self._process.terminate()
+            self._terminated_at = now
+        elif self._terminated_at is not None and now - self._terminated_at > KILL_GRACE_SECONDS:
+            # terminate() raises ConversionCancelled in the worker, kill only if it did not stop
+            self._process.kill()
@@ -0,0 +1,62 @@
+import os
+
+from giocomo_lab_to_nwb.batch import skipped_sessions
+from giocomo_lab_to_nwb.cache import SAMPLE_SIZE, ConversionCache, fingerprint, session_key
+from giocomo_lab_to_nwb.conversion import nwb_path
+
+SESSION = {'session_start_time': 'April 4, 2017 10:00AM', 'subject_date_of_birth': 'April 4, 2016 12:15AM'}
+
+
+def write_files(directory, contents, names):
+    paths = []
+    for name in names:
+        path = os.path.join(str(directory), name)
+        with open(path, 'wb') as f:
+            f.write(contents)
+        paths.append(path)
+    return paths
+
+
+def test_duplicates_need_same_contents_and_arguments(tmp_path):
+    contents = os.urandom(4 * 2 ** 20)
+    first, other_metadata, copy = write_files(tmp_path, contents, ['a.mat', 'b.mat', 'c.mat'])
+    # same size and same sampled blocks, one byte differs between them
+    changed = bytearray(contents)
+    changed[SAMPLE_SIZE + 10] ^= 1
+    near_copy, = write_files(tmp_path, bytes(changed), ['d.mat'])
+    assert fingerprint(first, modification_time=False) == fingerprint(near_copy, modification_time=False)
+
+    sessions = [dict(SESSION, input_file=first),
+                dict(SESSION, input_file=other_metadata, subject_date_of_birth='April 4, 2016 12:10AM'),
+                dict(SESSION, input_file=copy),
+                dict(SESSION, input_file=near_copy)]
+    skipped, keys = skipped_sessions(sessions, ConversionCache(str(tmp_path / 'manifest.json')))
+    assert sorted(skipped) == [2]
+    assert skipped[2]['status'] == 'duplicate' and skipped[2]['duplicate_of'] == first
+    assert sorted(keys) == [0, 1, 2, 3]
+
+
+def test_nothing_skipped_without_cache(tmp_path):
+    first, copy = write_files(tmp_path, os.urandom(2 ** 20), ['a.mat', 'b.mat'])
+    sessions = [dict(SESSION, input_file=first), dict(SESSION, input_file=copy)]
+    skipped, _keys = skipped_sessions(sessions, None)
+    assert skipped == {}
+
+
+def test_compressing_the_raw_data_forces_a_reconversion(tmp_path):
+    input_file, = write_files(tmp_path, os.urandom(2 ** 20), ['a.mat'])
+    output_file = nwb_path(input_file)
+    write_files(tmp_path, b'converted', [os.path.basename(output_file)])
+    cache = ConversionCache(str(tmp_path / 'manifest.json'))
+    uncompressed = dict(SESSION, input_file=input_file, add_raw=True)
+    cache.record(input_file, output_file, session_key(uncompressed))
+
+    skipped, _keys = skipped_sessions([dict(uncompressed, raw_workers=None)], cache)
+    assert skipped[0]['status'] == 'up to date'
+    # raw_workers compresses the raw data, which changes the output
+    skipped, _keys = skipped_sessions([dict(uncompressed, raw_workers=4)], cache)
+    assert skipped == {}
+    # the number of workers does not
+    cache.record(input_file, output_file, session_key(dict(uncompressed, raw_workers=4)))
+    skipped, _keys = skipped_sessions([dict(uncompressed, raw_workers=2)], cache)
+    assert skipped[0]['status'] == 'up to date'
@@ -0,0 +1,8 @@
+import pytest
+
+from giocomo_lab_to_nwb.benchmark import run_benchmark
+
+
+def test_conversion_function_is_not_benchmarked_streamed(tmp_path):
+    with pytest.raises(ValueError):
+        run_benchmark(sizes=[1000], converter='conversion_function', stream=True, work_dir=str(tmp_path))
@@ -0,0 +1,8 @@
+from giocomo_lab_to_nwb.import_check import check_imports
+
+
+def test_entry_modules_load_no_heavy_module():
+    # the import time depends on the machine, only the heavy modules loaded are checked
+    measured, failures = check_imports(max_seconds=None, repeats=1)
+    assert failures == []
+    assert any(result['seconds'] is not None for result in measured)
@@ -0,0 +1,37 @@
+import pytest
+
+from giocomo_lab_to_nwb.memory_check import COPY_BYTES, STREAMING_COPIES, check_memory
+
+CHUNK_SIZE = 2 ** 16
+# streamed, the peak memory reaches its plateau near 2 ** 22 elements; from there to 2 ** 24 a full copy
+# weighs 96 MB, well over the slack of the budget
+SIZES = (2 ** 20, 2 ** 22, 2 ** 24)
+
+
+def growth_per_element(smaller, larger):
+    return (larger['peak_rss_bytes'] - smaller['peak_rss_bytes']) / float(larger['size'] - smaller['size'])
+
+
+@pytest.mark.parametrize('dimension', ['spikes', 'samples'])
+def test_streamed_memory_grows_sub_linearly(tmp_path, dimension):
+    measured, failures = check_memory(dimension, SIZES, stream=True, work_dir=str(tmp_path), chunk_size=CHUNK_SIZE)
+    assert [result['size'] for result in measured] == list(SIZES)
+    assert failures == []
+    # the growth per element flattens between the two largest sizes
+    assert growth_per_element(*measured[1:]) < STREAMING_COPIES * COPY_BYTES
+
+
+def test_in_memory_conversion_breaks_the_streaming_budget(tmp_path):
+    _measured, failures = check_memory('samples', SIZES[1:], stream=False, copies=STREAMING_COPIES,
+                                       work_dir=str(tmp_path), chunk_size=CHUNK_SIZE)
+    assert failures
+
+
+def test_sessions_shorter_than_a_chunk_are_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        check_memory('spikes', (CHUNK_SIZE // 2, 2 ** 24), work_dir=str(tmp_path), chunk_size=CHUNK_SIZE)
+
+
+def test_steps_hidden_by_the_slack_are_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        check_memory('spikes', (2 ** 17, 2 ** 19), work_dir=str(tmp_path), chunk_size=CHUNK_SIZE)
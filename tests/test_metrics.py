@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from pynwb import NWBHDF5IO
+
+from giocomo_lab_to_nwb.conversion import convert, nwb_path
+from giocomo_lab_to_nwb.metrics import recording_duration
+from giocomo_lab_to_nwb.synthetic import write_session
+
+
+def test_recording_duration_covers_the_session_and_the_spikes():
+    position_time = np.linspace(0.0, 60.0, 601)
+    # the last spike comes long before the end of the session
+    assert recording_duration(position_time, np.array([1.0, 2.0, 30.0])) == 60.0
+    assert recording_duration(position_time, np.array([-2.0, 62.0])) == 64.0
+    assert recording_duration(position_time, np.array([])) == 60.0
+    assert recording_duration(np.array([]), np.array([])) == 0.0
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_quality_metrics_of_a_session_without_spikes(tmp_path, stream):
+    input_file = write_session(str(tmp_path / 'session.mat'), num_spikes=0, num_clusters=5, num_templates=8,
+                               num_channels=8, duration=60.0, num_trials=4)
+    convert(input_file, 'April 4, 2017 10:00AM', 'April 4, 2016 12:15AM', stream=stream, chunk_size=1024,
+            quality_metrics=True)
+
+    with NWBHDF5IO(nwb_path(input_file), 'r') as io:
+        units = io.read().units
+        assert len(units) == 5
+        assert np.array_equal(units['firing_rate'].data[:], np.zeros(5))
+        assert np.array_equal(units['presence_ratio'].data[:], np.zeros(5))
+        for name in ('isi_violations', 'amplitude_median', 'amplitude_iqr'):
+            assert np.isnan(units[name].data[:]).all()
@@ -0,0 +1,24 @@
+import tracemalloc
+
+import pytest
+
+from giocomo_lab_to_nwb.conversion import convert
+from giocomo_lab_to_nwb.synthetic import write_session
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_memory_tracing_stops_when_the_conversion_fails(tmp_path):
+    input_file = write_session(str(tmp_path / 'session.mat'), num_spikes=2000, num_clusters=10, num_templates=20,
+                               num_channels=8, duration=60.0, num_trials=4)
+
+    def progress(stage):
+        if stage == 'units':
+            assert tracemalloc.is_tracing()
+            raise Interrupted(stage)
+
+    with pytest.raises(Interrupted):
+        convert(input_file, 'April 4, 2017 10:00AM', 'April 4, 2016 12:15AM', profile='memory', progress=progress)
+    assert not tracemalloc.is_tracing()
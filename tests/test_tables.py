@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+from pynwb import NWBHDF5IO
+from pynwb.ecephys import ElectrodeGroup
+from pynwb.device import Device
+
+from giocomo_lab_to_nwb.conversion import convert, nwb_path
+from giocomo_lab_to_nwb.matfile import open_matfile
+from giocomo_lab_to_nwb.streaming import read_rows
+from giocomo_lab_to_nwb.synthetic import write_session
+from giocomo_lab_to_nwb.tables import group_columns, make_units, shared_spike_times, trial_boundaries
+
+NUM_SPIKES = 20000
+# smaller than the number of spikes, so that the streamed grouping spans several chunks
+CHUNK_SIZE = 4096
+
+
+@pytest.fixture(scope='module')
+def session(tmp_path_factory):
+    return write_session(str(tmp_path_factory.mktemp('session') / 'session.mat'), num_spikes=NUM_SPIKES,
+                         num_clusters=40, num_templates=60, num_channels=8, duration=600.0, num_trials=10)
+
+
+def naive_spike_times(spike_times, labels, label_ids):
+    """The spike times of each id, one boolean mask per id, as before the grouping."""
+    return [spike_times[labels == label_id] for label_id in label_ids]
+
+
+def unit_spike_times(units):
+    return [np.asarray(units['spike_times'][row]) for row in range(len(units))]
+
+
+def electrode_group():
+    return ElectrodeGroup(name='probe', description='probe', location='MEC', device=Device(name='neuropixels'))
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_make_units_matches_per_cluster_masks(session, tmp_path, stream):
+    with open_matfile(session) as matfile:
+        spike_times = matfile.vector('sp/st')
+        spike_cluster = matfile.vector('sp/clu')
+        # a cluster without spikes, and the spikes of the clusters left out belong to no unit
+        cluster_ids = np.append(matfile.vector('sp/cids')[5:], 1000.0)
+        sources = [matfile.source('sp/st')] if stream else [spike_times]
+        labels = matfile.source('sp/clu') if stream else spike_cluster
+        ids, counts, (grouped,) = group_columns(labels, cluster_ids, sources,
+                                                str(tmp_path) if stream else None, CHUNK_SIZE)
+        if stream:
+            grouped = read_rows(grouped, 0, int(counts.sum()))
+        units = make_units('units', 'units', ids, grouped, counts, electrode_group())
+
+    expected = naive_spike_times(spike_times, spike_cluster, cluster_ids)
+    assert np.array_equal(ids, cluster_ids)
+    assert np.array_equal(units['spike_times_index'].data, np.cumsum([len(times) for times in expected]))
+    for times, expected_times in zip(unit_spike_times(units), expected):
+        assert np.array_equal(times, expected_times)
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_converted_units_match_per_cluster_masks(session, tmp_path, stream):
+    input_file = str(tmp_path / 'session.mat')
+    with open(session, 'rb') as source, open(input_file, 'wb') as copy:
+        copy.write(source.read())
+    convert(input_file, 'April 4, 2017 10:00AM', 'April 4, 2016 12:15AM', stream=stream, chunk_size=CHUNK_SIZE)
+
+    with open_matfile(input_file) as matfile:
+        spike_times = matfile.vector('sp/st')
+        spike_cluster = matfile.vector('sp/clu')
+        spike_templates = matfile.vector('sp/spikeTemplates')
+        amplitudes = matfile.vector('sp/tempScalingAmps')
+        cluster_ids = matfile.vector('sp/cids')
+    template_ids = np.unique(spike_templates)
+
+    with NWBHDF5IO(nwb_path(input_file), 'r') as io:
+        nwbfile = io.read()
+        units = nwbfile.units
+        assert np.array_equal(units.id.data[:], cluster_ids.astype(int))
+        for times, expected_times in zip(unit_spike_times(units),
+                                         naive_spike_times(spike_times, spike_cluster, cluster_ids)):
+            assert np.array_equal(times, expected_times)
+
+        # the TemplateUnits table groups the same spikes by template
+        template_units = nwbfile.processing['ecephys']['TemplateUnits']
+        assert np.array_equal(template_units.id.data[:], template_ids.astype(int))
+        expected_amplitudes = naive_spike_times(amplitudes, spike_templates, template_ids)
+        for row, expected_times in enumerate(naive_spike_times(spike_times, spike_templates, template_ids)):
+            assert np.array_equal(template_units['spike_times'][row], expected_times)
+            assert np.array_equal(template_units['tempScalingAmps'][row], expected_amplitudes[row])
+
+
+@pytest.mark.parametrize('trial', [np.array([1, 1, 2, 2, 2, 3, 5, 5]), np.array([2, 2, 1, 1, 3, 2])])
+def test_trial_boundaries_match_per_trial_masks(trial):
+    trial_nums, first, last = trial_boundaries(trial, chunk_size=3)
+    assert np.array_equal(trial_nums, np.unique(trial))
+    for trial_num, trial_first, trial_last in zip(trial_nums, first, last):
+        samples = np.flatnonzero(trial == trial_num)
+        assert (trial_first, trial_last) == (samples[0], samples[-1])
+
+
+def test_trial_boundaries_without_samples():
+    trial_nums, first, last = trial_boundaries(np.array([], dtype=np.float64))
+    assert len(trial_nums) == len(first) == len(last) == 0
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_shared_spike_times_match_per_template_masks(session, tmp_path, stream):
+    input_file = str(tmp_path / 'session.mat')
+    with open(session, 'rb') as source, open(input_file, 'wb') as copy:
+        copy.write(source.read())
+    convert(input_file, 'April 4, 2017 10:00AM', 'April 4, 2016 12:15AM', stream=stream, chunk_size=CHUNK_SIZE,
+            share_spike_times=True)
+
+    with open_matfile(input_file) as matfile:
+        spike_times = matfile.vector('sp/st')
+        spike_templates = matfile.vector('sp/spikeTemplates')
+    template_ids = np.unique(spike_templates)
+
+    with NWBHDF5IO(nwb_path(input_file), 'r') as io:
+        nwbfile = io.read()
+        template_units = nwbfile.processing['ecephys']['TemplateUnits']
+        # the spike times are stored once, in the units table
+        assert 'spike_times' not in template_units.colnames
+        assert 'spike_index' in template_units.colnames
+        for row, expected_times in enumerate(naive_spike_times(spike_times, spike_templates, template_ids)):
+            assert np.array_equal(shared_spike_times(template_units, row, nwbfile.units), expected_times)